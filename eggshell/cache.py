@@ -0,0 +1,403 @@
+"""
+Download cache.
+
+Files downloaded with ``eggshell.utils.download(url, cache=True)`` are stored
+below the server cache directory (:attr:`eggshell.config.Paths.cache`) at
+``<cache>/<host>/<url path>``. The :class:`DownloadCache` keeps an SQLite index
+of the cached URLs with size, ETag, Last-Modified and time of last access, so
+that
+
+* files are revalidated with a conditional request (If-None-Match /
+  If-Modified-Since) once they are older than `max_age` seconds,
+* the least recently used files are removed when the cache exceeds `max_bytes`,
+* concurrent processes lock a URL while it is downloaded and never fetch the
+  same file twice: the first one downloads into a temporary file which is
+  renamed when complete, the others wait for the lock and reuse the result,
+* a cached file is only served if its size (or, with ``verify = checksum``,
+  its SHA-256 checksum) matches the index, otherwise it is downloaded again.
+
+The limits are read from the `cache` section of the PyWPS configuration::
+
+    [cache]
+    max_bytes = 50G
+    max_age = 86400
+    verify = size
+    lock_timeout = 3600
+
+Example usage::
+
+    from eggshell.cache import get_cache
+    filename = get_cache().fetch('https://example.org/data/air.2018.nc')
+"""
+
+import fcntl
+import hashlib
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from email.utils import formatdate
+from urllib.parse import urlparse
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+_FIELDS_ = ('path', 'size', 'etag', 'last_modified', 'validated', 'last_access', 'checksum')
+
+_UNITS_ = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_bytes(value):
+    """
+    Convert a size like `500M` or `20G` to a number of bytes.
+
+    :param value: int or str with optional unit K, M, G or T (powers of 1024)
+
+    :return int: number of bytes, None for empty values
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in _UNITS_:
+        return int(float(value[:-1]) * _UNITS_[value[-1]])
+    return int(float(value))
+
+
+def sha256sum(filename, chunk_size=1024 * 1024):
+    """Return the hex SHA-256 checksum of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _flock(fd, flags, blocking, deadline, path):
+    """Lock a file descriptor, return False if the lock is held elsewhere and blocking is False."""
+    try:
+        fcntl.flock(fd, flags | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        if not blocking:
+            return False
+    LOGGER.info('waiting for lock on %s', os.path.basename(path))
+    if deadline is None:
+        fcntl.flock(fd, flags)
+        return True
+    while True:
+        try:
+            fcntl.flock(fd, flags | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.time() > deadline:
+                raise Exception('timed out waiting for lock on {}'.format(path))
+            time.sleep(0.1)
+
+
+def _is_current(fd, lockfile):
+    """Check that a file descriptor refers to the file at the path of the lock file."""
+    try:
+        st = os.stat(lockfile)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True, timeout=None):
+    """
+    Hold an advisory lock on `<path>.lock` (flock, shared between processes).
+
+    The lock file may be removed by the holder of the lock (see DownloadCache.remove),
+    a process which waited for the lock then locks the new lock file at the path.
+
+    :param path: path of the locked file
+    :param shared: take a shared instead of an exclusive lock
+    :param blocking: if False, yield False instead of waiting for the lock
+    :param timeout: seconds to wait for the lock before an exception is raised, None to wait forever
+
+    :return bool: True if the lock is held
+    """
+    lockfile = path + '.lock'
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not _flock(fd, flags, blocking, deadline, path):
+                yield False
+                return
+            if _is_current(fd, lockfile):
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                return
+            # the lock file was removed while we waited for it
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+
+class DownloadCache(object):
+    """Index of downloaded files with revalidation and LRU eviction."""
+
+    def __init__(self, root, max_bytes=None, max_age=None, db_path=None, verify='size', lock_timeout=None):
+        """
+        :param root: cache directory
+        :param max_bytes: byte budget of the cache (int or str like '20G'), None for no limit
+        :param max_age: seconds after which a cached file is revalidated with the server,
+                        None to never revalidate, 0 to revalidate on every access
+        :param db_path: SQLite index (default: `download_cache.sqlite` in root)
+        :param verify: integrity check before a file is served, 'size' or 'checksum' (SHA-256)
+        :param lock_timeout: seconds to wait for a download by another process, None to wait forever
+        """
+        if verify not in ('size', 'checksum'):
+            raise Exception('unknown cache verification {}, use size or checksum'.format(verify))
+        self.root = root
+        self.max_bytes = parse_bytes(max_bytes)
+        self.max_age = None if max_age in (None, '') else float(max_age)
+        self.verify = verify
+        self.lock_timeout = None if lock_timeout in (None, '') else float(lock_timeout)
+        self.db_path = db_path or os.path.join(root, 'download_cache.sqlite')
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._execute('CREATE TABLE IF NOT EXISTS entries '
+                      '(url TEXT PRIMARY KEY, path TEXT, size INTEGER, etag TEXT, '
+                      'last_modified TEXT, validated REAL, last_access REAL, checksum TEXT)')
+        columns = [row[1] for row in self._execute('PRAGMA table_info(entries)')]
+        if 'checksum' not in columns:
+            self._execute('ALTER TABLE entries ADD COLUMN checksum TEXT')
+
+    def _execute(self, sql, parameters=()):
+        """Run a single statement on the SQLite index and return all rows."""
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with con:
+                return con.execute(sql, parameters).fetchall()
+        finally:
+            con.close()
+
+    def path(self, url):
+        """
+        Return the path of an URL in the cache directory.
+
+        :param url: url adress of the target file location
+
+        :return str: path in cache
+        """
+        parsed_url = urlparse(url)
+        return os.path.join(self.root, parsed_url.netloc, parsed_url.path.strip('/'))
+
+    def entry(self, url):
+        """
+        Return the index entry of an URL.
+
+        :return dict: path, size, etag, last_modified, validated, last_access and checksum;
+                      None if not cached
+        """
+        rows = self._execute('SELECT path, size, etag, last_modified, validated, last_access, checksum '
+                             'FROM entries WHERE url = ?', (url,))
+        if not rows:
+            return None
+        return dict(zip(_FIELDS_, rows[0]))
+
+    def _valid(self, entry, filename):
+        """Check that a cached file exists and has the size (and checksum) recorded in the index."""
+        if not os.path.isfile(filename) or os.path.getsize(filename) != entry['size']:
+            return False
+        if self.verify == 'checksum' and entry['checksum'] and sha256sum(filename) != entry['checksum']:
+            return False
+        return True
+
+    def _checksum(self, filename):
+        return sha256sum(filename) if self.verify == 'checksum' else None
+
+    def _adopt(self, url, filename):
+        """Create an index entry for a file cached before the index existed."""
+        mtime = os.path.getmtime(filename)
+        entry = dict(path=filename, size=os.path.getsize(filename), etag=None,
+                     last_modified=formatdate(mtime, usegmt=True), validated=mtime, last_access=mtime,
+                     checksum=self._checksum(filename))
+        self._store(url, entry)
+        return entry
+
+    def _store(self, url, entry):
+        self._execute('INSERT OR REPLACE INTO entries (url, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(
+            ', '.join(_FIELDS_)), (url,) + tuple(entry[key] for key in _FIELDS_))
+
+    def _download(self, url, filename, entry=None, session=None, **kwargs):
+        """Download (or revalidate if `entry` is given) an URL and update the index."""
+        from eggshell.utils import fetch_file
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = fetch_file(url, filename, headers=headers, session=session, **kwargs)
+        now = time.time()
+        if r.status_code == 304:
+            LOGGER.debug('file in cache is up to date: %s', os.path.basename(filename))
+            entry.update(validated=now, last_access=now)
+        else:
+            LOGGER.info('downloaded to cache: %s', os.path.basename(filename))
+            entry = dict(path=filename, size=os.path.getsize(filename),
+                         etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'),
+                         validated=now, last_access=now, checksum=self._checksum(filename))
+        self._store(url, entry)
+        return entry
+
+    def fetch(self, url, session=None, **kwargs):
+        """
+        Return the cached file of an URL, downloading or revalidating it if needed.
+
+        :param url: url adress of the target file location
+        :param session: requests.Session (default: shared session, see eggshell.utils.get_session)
+        :param kwargs: options of the download, see eggshell.utils.fetch_file (e.g. cookies, max_nbytes)
+
+        :return str: path in cache
+        """
+        filename = self.path(url)
+        with file_lock(filename, timeout=self.lock_timeout):
+            # another process may have downloaded the file while we waited for the lock
+            entry = self.entry(url)
+            if entry is None and os.path.isfile(filename):
+                entry = self._adopt(url, filename)
+
+            if entry is None or not self._valid(entry, filename):
+                if entry is not None:
+                    LOGGER.warning('file in cache is corrupt: %s', os.path.basename(filename))
+                LOGGER.info('downloading: {}'.format(url))
+                try:
+                    self._download(url, filename, session=session, **kwargs)
+                except Exception:
+                    # no file and no partial download to resume: the lock file is not needed
+                    if not os.path.exists(filename) and not os.path.exists(filename + '.part'):
+                        self._remove_lock(filename)
+                    raise
+            elif self.max_age is not None and time.time() - entry['validated'] >= self.max_age:
+                LOGGER.info('revalidating file in cache: %s', os.path.basename(filename))
+                self._download(url, filename, entry=entry, session=session, **kwargs)
+            else:
+                LOGGER.info('file already in cache: %s', os.path.basename(filename))
+                self._execute('UPDATE entries SET last_access = ? WHERE url = ?', (time.time(), url))
+        self.evict(keep=url)
+        return filename
+
+    @contextmanager
+    def modify(self, url):
+        """
+        Lock the cached file of an URL for changes in place (e.g. added attributes) and
+        record its new size and checksum afterwards, so the file is still served as valid.
+        The ETag and Last-Modified of the server are kept for revalidation.
+
+        :param url: url adress of the target file location
+
+        :return str: path in cache
+        """
+        filename = self.path(url)
+        with file_lock(filename, timeout=self.lock_timeout):
+            yield filename
+            entry = self.entry(url)
+            if entry is not None and os.path.isfile(filename):
+                entry.update(size=os.path.getsize(filename), checksum=self._checksum(filename))
+                self._store(url, entry)
+
+    def update(self, url, **fields):
+        """
+        Update fields of the index entry of an URL, e.g. the ETag and Last-Modified
+        of the server after a file was updated in place (see modify).
+
+        :param url: url adress of the target file location
+        :param fields: values of path, size, etag, last_modified, validated, last_access or checksum
+        """
+        entry = self.entry(url)
+        if entry is None:
+            raise Exception('{} is not in the cache'.format(url))
+        entry.update(fields)
+        self._store(url, entry)
+
+    def remove(self, url):
+        """Remove an URL from the cache, together with its lock file."""
+        filename = self.path(url)
+        with file_lock(filename):
+            self._remove(url, filename)
+
+    def _remove(self, url, filename):
+        """Remove a file and its index entry, the caller holds the lock of the file."""
+        if os.path.exists(filename):
+            os.remove(filename)
+        self._execute('DELETE FROM entries WHERE url = ?', (url,))
+        self._remove_lock(filename)
+
+    def _remove_lock(self, filename):
+        """Remove the lock file of a file, the caller holds the lock (see file_lock)."""
+        try:
+            os.remove(filename + '.lock')
+        except FileNotFoundError:
+            pass
+
+    def size(self):
+        """Return the number of bytes of all indexed files."""
+        return self._execute('SELECT COALESCE(SUM(size), 0) FROM entries')[0][0]
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits into `max_bytes`.
+        Each file is removed with its lock held, files locked by other processes are skipped.
+        The lock files of the removed files are deleted.
+
+        :param keep: URL which is never removed (e.g. the one just fetched)
+
+        :return list: removed URLs
+        """
+        removed = []
+        if self.max_bytes is None:
+            return removed
+        total = self.size()
+        if total <= self.max_bytes:
+            return removed
+        for url, filename, size in self._execute('SELECT url, path, size FROM entries ORDER BY last_access'):
+            if total <= self.max_bytes:
+                break
+            if url == keep:
+                continue
+            with file_lock(filename, blocking=False) as locked:
+                if not locked:
+                    continue
+                LOGGER.info('removing least recently used file from cache: %s', os.path.basename(filename))
+                self._remove(url, filename)
+            total -= size
+            removed.append(url)
+        return removed
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the download cache of the server cache directory configured for PyWPS."""
+    global _cache
+    if _cache is None:
+        import eggshell
+        from eggshell.config import Paths
+        from pywps import configuration
+        _cache = DownloadCache(Paths(eggshell).cache,
+                               max_bytes=configuration.get_config_value("cache", "max_bytes"),
+                               max_age=configuration.get_config_value("cache", "max_age"),
+                               verify=configuration.get_config_value("cache", "verify") or 'size',
+                               lock_timeout=configuration.get_config_value("cache", "lock_timeout"))
+    return _cache
+
+
+def set_cache(cache):
+    """Replace the shared download cache, e.g. DownloadCache(root, max_bytes='10G')."""
+    global _cache
+    _cache = cache
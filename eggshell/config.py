@@ -8,10 +8,12 @@ with this.
 """
 
 from os.path import join, pardir, abspath
-from pywps import configuration
+from eggshell.dependencies import lazy_import
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+configuration = lazy_import('pywps.configuration')
+
 
 class Paths(object):
     """This class facilitates the configuration of WPS birds."""
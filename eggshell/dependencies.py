@@ -3,16 +3,159 @@
 """
 This module is used to manage optional dependencies.
 
+Heavy dependencies (netCDF4, ocgis, matplotlib, cartopy, pywps, ...) are not
+imported when an eggshell module is loaded, but on first use. :func:`lazy_import`
+returns a proxy of a module, or of module attributes like classes and functions,
+which imports the module when an attribute is accessed or the proxy is called.
+A process which only needs e.g. :func:`eggshell.utils.archive` does not pay
+the import time of the NetCDF and plotting stack.
+
 Example usage::
 
     from eggshell.dependencies import netCDF4 as nc
+    from eggshell.dependencies import lazy_import
+    plt = lazy_import('matplotlib.pyplot')
+    Dataset, MFDataset = lazy_import('netCDF4', 'Dataset', 'MFDataset')
+
+The optional dependencies listed in `OPTIONAL` are attributes of this module
+(PEP 562). They are `None` (with a warning) if the package is not installed.
 """
 
+import importlib
+import importlib.util
+import sys
+import threading
+import types
 import warnings
 
+# name of the attribute of this module -> module
+OPTIONAL = {
+    'netCDF4': 'netCDF4',
+    'ocgis': 'ocgis',
+    'requests': 'requests',
+    'pandas': 'pandas',
+    'pyplot': 'matplotlib.pyplot',
+    'ccrs': 'cartopy.crs',
+    'gdal': 'osgeo.gdal',
+}
+
+_proxies = {}
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """Proxy of a module which is imported on first attribute access."""
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            with _lock:
+                try:
+                    module = importlib.import_module(self.__name__)
+                except ImportError as e:
+                    raise ImportError('{} is required for this function: {}'.format(self.__name__, e))
+                # attributes of the module are found in the proxy without a call of __getattr__
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+        self.__dict__[attr] = value
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] is not None else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self.__name__, state)
+
+
+class LazyAttribute(object):
+    """Proxy of a module attribute (class, function, ...) which imports the module on first use."""
+
+    def __init__(self, module, name):
+        self.__dict__['_lazy_module'] = module
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_object'] = None
+
+    def _load(self):
+        obj = self.__dict__['_lazy_object']
+        if obj is None:
+            obj = getattr(self.__dict__['_lazy_module'], self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_object'] = obj
+        return obj
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._load())
+
+    def __repr__(self):
+        return '<lazy {}.{}>'.format(self.__dict__['_lazy_module'].__name__, self.__dict__['_lazy_name'])
+
+
+def lazy_import(name, *attributes):
+    """
+    Return a proxy of a module which is imported on first use.
+
+    :param name: name of the module, e.g. 'matplotlib.pyplot'
+    :param attributes: names of attributes of the module, e.g. 'Dataset', 'MFDataset'
+
+    :return: module proxy if no attributes are given, the proxy of the attribute for one name,
+             a list of proxies otherwise. Modules that are already imported are returned as they are.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        with _lock:
+            module = _proxies.setdefault(name, LazyModule(name))
+    if not attributes:
+        return module
+    if isinstance(module, LazyModule) and module.__dict__['_lazy_module'] is None:
+        objects = [LazyAttribute(module, attr) for attr in attributes]
+    else:
+        objects = [getattr(module, attr) for attr in attributes]
+    return objects[0] if len(attributes) == 1 else objects
+
+
+def is_available(name):
+    """
+    Check if a module can be imported, without importing it.
+
+    :param name: name of the module
+
+    :return bool: True if the top level package of the module is installed
+    """
+    if name in sys.modules:
+        return True
+    try:
+        return importlib.util.find_spec(name.partition('.')[0]) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def __getattr__(name):
+    if name not in OPTIONAL:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    if is_available(OPTIONAL[name]):
+        module = lazy_import(OPTIONAL[name])
+    else:
+        module = None
+        warnings.warn('{} is not available.'.format(OPTIONAL[name]))
+    globals()[name] = module
+    return module
+
 
-try:
-    import netCDF4
-except ImportError:
-    netCDF4 = None
-    warnings.warn('netCDF4 is not available.')
+def __dir__():
+    return sorted(list(globals()) + list(OPTIONAL))
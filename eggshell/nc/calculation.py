@@ -4,50 +4,64 @@ from os import path
 from os.path import basename, join
 from datetime import datetime as dt
 from shutil import copyfile
-from netCDF4 import Dataset
+from eggshell.dependencies import lazy_import
 
 import numpy as np
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+Dataset = lazy_import('netCDF4', 'Dataset')
 
-def fieldmean(resource):
+
+def fieldmean(resource, memory_limit=None):
     """
-    calculating of a weighted field mean
+    calculating of a weighted field mean.
+    The files are read in blocks of timesteps, so the memory usage is bound
+    by memory_limit instead of the size of the dataset.
 
     :param resource: str or list of str containing the netCDF files paths
+    :param memory_limit: maximum size of the data block read at once in MB (default: 256)
 
     :return list: timeseries of the averaged values per timestep
     """
     from numpy import radians, average, cos, sqrt, array
 
-    data = get_values(resource)  # np.squeeze(ds.variables[variable][:])
-    # dim = data.shape
-    LOGGER.debug(data.shape)
-
-    if len(data.shape) == 3:
-        # TODO if data.shape == 2 , 4 ...
-        lats, lons = get_coordinates(resource, unrotate=False)
-        lats = array(lats)
-        if len(lats.shape) == 2:
-            lats = lats[:, 0]
-        else:
-            LOGGER.debug('Latitudes not reduced to 1D')
-        # TODO: calculat weighed average with 2D lats (rotated pole coordinates)
-        # lats, lons = get_coordinates(resource, unrotate=False)
-        # if len(lats.shape) == 2:
-        #     lats, lons = get_coordinates(resource)
-
-        lat_index = get_index_lat(resource)
-        LOGGER.debug('lats dimension %s ' % len(lats.shape))
-        LOGGER.debug('lats index %s' % lat_index)
-
-        lat_w = sqrt(cos(lats * radians(1)))
-        meanLon = average(data, axis=lat_index, weights=lat_w)
-        meanTimeserie = average(meanLon, axis=1)
-        LOGGER.debug('fieldmean calculated')
+    if type(resource) != list:
+        resource = [resource]
+    variable = get_variable(resource)
+
+    lats, lons = get_coordinates(resource[0], variable=variable, unrotate=False)
+    lats = array(lats)
+    if len(lats.shape) == 2:
+        lats = lats[:, 0]
     else:
-        LOGGER.error('not 3D shaped data. Average can not be calculated')
+        LOGGER.debug('Latitudes not reduced to 1D')
+    # TODO: calculat weighed average with 2D lats (rotated pole coordinates)
+    lat_w = sqrt(cos(lats * radians(1)))
+    limit = (memory_limit or 256) * 1024. * 1024.
+
+    means = []
+    for nc in resource:
+        with Dataset(nc) as ds:
+            var = ds.variables[variable]
+            # drop dimensions of size one (e.g. a single level), keep time
+            shape = [n for d, n in zip(var.dimensions, var.shape) if d == 'time' or n > 1]
+            dims = [d for d, n in zip(var.dimensions, var.shape) if d == 'time' or n > 1]
+            if len(shape) != 3:
+                # TODO if data.shape == 2 , 4 ...
+                msg = 'not 3D shaped data. Average can not be calculated'
+                LOGGER.error(msg)
+                raise Exception(msg)
+            lat_index = dims.index(var.dimensions[get_index_lat(nc, variable=variable)])
+            LOGGER.debug('lats index %s' % lat_index)
+
+            step = max(1, int(limit // (shape[1] * shape[2] * var.dtype.itemsize)))
+            for i in range(0, shape[0], step):
+                data = var[i:i + step].reshape([-1] + shape[1:])
+                meanLon = average(data, axis=lat_index, weights=lat_w)
+                means.append(average(meanLon, axis=1))
+    meanTimeserie = np.ma.concatenate(means)
+    LOGGER.debug('fieldmean calculated')
     return meanTimeserie
 
 
@@ -107,7 +121,74 @@ def robustness_cc_signal(variable_mean, standard_deviation=None, variable=None):
 
     return out_cc_signal, out_mean_std
 
-def robustness_stats(resources, time_range=[None, None], dir_output=None, variable=None):
+def _member_median(args):
+    """Median over all timesteps of one ensemble member, executed by ocgis (used as process pool task)."""
+    resource, variable, time_range, dir_output = args
+    from ocgis import OcgOperations, RequestDataset, env
+    env.OVERWRITE = True
+
+    rd = RequestDataset(resource, variable)
+    prefix = basename(resource).replace('.nc', '')
+    LOGGER.debug('processing mean of {}'.format(prefix))
+    calc = [{'func': 'median', 'name': variable}]  #  {'func': 'median', 'name': 'monthly_median'}
+    ops = OcgOperations(dataset=rd, calc=calc, calc_grouping=['all'],
+                        output_format='nc', prefix='median_'+prefix, time_range=time_range, dir_output=dir_output)
+    return ops.execute()
+
+
+def ensemble_stats(resources, variable=None, dir_output=None, memory_limit=None):
+    """
+    calculating the median and standard deviation over an ensemble of 2D fields.
+    The fields are read one after another: the standard deviation is calculated from
+    running moments and the median over a memory-mapped stack, processed in tiles of rows.
+    Missing values are ignored (compare numpy.nanmedian, numpy.nanstd).
+
+    :param resources: list of netCDF files, each containing one 2D field
+    :param variable: variable name containing in netCDF file. If not set, variable name gets detected
+    :param dir_output: folder for the temporary memory-mapped stack (default: temporary folder)
+    :param memory_limit: maximum size of the data read at once for the median in MB (default: 256)
+
+    :return numpy.array: median, std
+    """
+    from tempfile import NamedTemporaryFile
+
+    if variable is None:
+        variable = get_variable(resources[0])
+    limit = (memory_limit or 256) * 1024. * 1024.
+
+    with NamedTemporaryFile(dir=dir_output, suffix='.npy') as tmp:
+        for i, resource in enumerate(resources):
+            with Dataset(resource) as ds:
+                val = np.ma.filled(np.squeeze(ds[variable][:]).astype('float64'), np.nan)
+            if i == 0:
+                stack = np.lib.format.open_memmap(tmp.name, mode='w+', dtype='float64',
+                                                  shape=(len(resources),) + val.shape)
+                count = np.zeros(val.shape)
+                mean = np.zeros(val.shape)
+                m2 = np.zeros(val.shape)
+            stack[i] = val
+
+            # running moments (Welford), skipping missing values
+            valid = ~np.isnan(val)
+            count += valid
+            delta = np.where(valid, val - mean, 0)
+            mean += np.where(valid, delta / np.maximum(count, 1), 0)
+            m2 += np.where(valid, delta * (np.where(valid, val, 0) - mean), 0)
+        stack.flush()
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            val_std = np.where(count > 0, np.sqrt(m2 / count), np.nan)
+
+        val_median = np.empty(stack.shape[1:])
+        rows = max(1, int(limit // (stack.shape[0] * np.prod(stack.shape[2:]) * 8)))
+        with np.errstate(invalid='ignore'):
+            for j in range(0, stack.shape[1], rows):
+                val_median[j:j + rows] = np.nanmedian(stack[:, j:j + rows], axis=0)
+        del stack
+    return val_median, val_std
+
+
+def robustness_stats(resources, time_range=[None, None], dir_output=None, variable=None, workers=None):
     """
     calculating the spatial mean and corresponding standard deviation for an ensemble of consistent datasets containing one variableself.
     If a time range is given the statistical values are calculated only in the disired timeperiod.
@@ -116,50 +197,27 @@ def robustness_stats(resources, time_range=[None, None], dir_output=None, variab
     :param time_range: sequence of two datetime.datetime objects to mark start and end point
     :param dir_output: path to folder to store ouput files  (default= curdir)
     :param variable: variable name containing in netCDF file. If not set, variable name gets detected
+    :param workers: number of processes to calculate the medians of the ensemble members (default: serial)
 
     :return netCDF files: out_ensmean.nc, out_ensstd.nc
     """
-
-    from ocgis import OcgOperations, RequestDataset, env
-    env.OVERWRITE = True
-
     if variable is None:
         variable = get_variable(resources[0])
 
-    out_means = []
-    for resource in resources:
-
-        rd = RequestDataset(resource, variable)
-        prefix = basename(resource).replace('.nc', '')
-        LOGGER.debug('processing mean of {}'.format(prefix))
-        calc = [{'func': 'median', 'name': variable}]  #  {'func': 'median', 'name': 'monthly_median'}
-        ops = OcgOperations(dataset=rd, calc=calc, calc_grouping=['all'],
-                            output_format='nc', prefix='median_'+prefix, time_range=time_range, dir_output=dir_output)
-        out_means.append(ops.execute())
+    tasks = [(resource, variable, time_range, dir_output) for resource in resources]
+    if workers and workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            out_means = list(pool.map(_member_median, tasks))
+    else:
+        out_means = [_member_median(task) for task in tasks]
     # nc_out = call(resource=resources, calc=[{'func': 'mean', 'name': 'ens_mean'}],
     #               calc_grouping='all', # time_region=time_region,
     #               dir_output=dir_output, output_format='nc')
 
-    ####
-    # read in numpy array
-
-    for i, out_mean in enumerate(out_means):
-        if i == 0:
-            ds = Dataset(out_mean)
-            var = ds[variable][:]
-            dims = [len(out_means), var[:].shape[-2], var[:].shape[-1]]
-            vals = np.empty(dims)
-            vals[i, :, :] = np.squeeze(var[:])
-            ds.close()
-        else:
-            ds = Dataset(out_mean)
-            vals[i, :, :] = np.squeeze(ds[variable][:])
-            ds.close()
-
     ####
     # calc median, std
-    val_median = np.nanmedian(vals, axis=0)
-    val_std = np.nanstd(vals, axis=0)
+    val_median, val_std = ensemble_stats(out_means, variable=variable, dir_output=dir_output)
 
     #####
     # prepare files by copying ...
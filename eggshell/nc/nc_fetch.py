@@ -31,7 +31,284 @@ _PRESSUREDATA_ = [
 _EOBSVARIABLES_ = ['tg', 'tx', 'tn', 'rr']
 
 
-def reanalyses(start=1948, end=None, variable='slp', dataset='NCEP', timres='day', getlevel=True):
+def reanalyses_url(year, variable='slp', dataset='NCEP', timres='day'):
+    """
+    Returns the URL of a yearly reanalysis file.
+
+    :param year: year of the file
+    :param variable: variable name (default='slp'), geopotential height is given as e.g. z700
+    :param dataset: 'NCEP', '20CRV2' or '20CRV2c'
+    :param timres: temporal resolution '6h' or 'day' (default)
+
+    :return str: url, None if the dataset is not known
+    """
+    url = None
+    if dataset == 'NCEP':
+        if variable == 'slp':
+            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/surface/%s.%s.nc' % (variable, year)  # noqa
+        if variable == 'pr_wtr':
+            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/surface/pr_wtr.eatm.%s.nc' % (year)  # noqa
+        if 'z' in variable:
+            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/pressure/hgt.%s.nc' % (year)  # noqa
+    elif dataset == '20CRV2':
+        if variable == 'prmsl':
+            if timres == '6h':
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/monolevel/prmsl.%s.nc' % year  # noqa
+            else:
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/Dailies/monolevel/prmsl.%s.nc' % year  # noqa
+        if 'z' in variable:
+            if timres == '6h':
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/pressure/hgt.%s.nc' % (year)  # noqa
+            else:
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/Dailies/pressure/hgt.%s.nc' % (year)  # noqa
+    elif dataset == '20CRV2c':
+        if variable == 'prmsl':
+            if timres == '6h':
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/monolevel/prmsl.%s.nc' % year  # noqa
+            else:
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/Dailies/monolevel/prmsl.%s.nc' % year  # noqa
+        if 'z' in variable:
+            if timres == '6h':
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/pressure/hgt.%s.nc' % (year)  # noqa
+            else:
+                url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/Dailies/pressure/hgt.%s.nc' % (year)  # noqa
+    else:
+        LOGGER.debug('Dataset %s not known' % dataset)
+    return url
+
+
+def _manifest_path(filename):
+    return filename + '.manifest.json'
+
+
+def read_manifest(filename):
+    """
+    Return the manifest of a cached reanalysis file (see update_reanalysis).
+
+    :param filename: path of the cached file
+
+    :return dict: url, size, etag and last_modified of the remote file, offset (number of bytes of the remote
+                  file the cached file holds unchanged, None if it was rewritten), updated and
+                  time (units, calendar, size, first, last); None if there is no manifest
+    """
+    import json
+    try:
+        with open(_manifest_path(filename)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(filename, url, headers=None, offset=None):
+    """
+    Write the manifest of a cached reanalysis file.
+
+    :param filename: path of the cached file
+    :param url: url of the remote file
+    :param headers: headers of a HEAD request of the remote file (Content-Length, ETag and Last-Modified)
+    :param offset: number of bytes of the remote file contained unchanged in the cached file
+                   (None if the cached file is not a byte copy of the remote one)
+    """
+    from netCDF4 import Dataset, num2date
+
+    with Dataset(filename) as ds:
+        time = ds.variables['time']
+        units, calendar = time.units, getattr(time, 'calendar', 'standard')
+        values = time[:]
+        steps = dict(units=units, calendar=calendar, size=len(values),
+                     first=str(num2date(values[0], units, calendar)) if len(values) else None,
+                     last=str(num2date(values[-1], units, calendar)) if len(values) else None)
+    headers = headers or {}
+    size = headers.get('Content-Length')
+    manifest = dict(url=url, size=int(size) if size is not None else None, etag=headers.get('ETag'),
+                    last_modified=headers.get('Last-Modified'), offset=offset,
+                    updated=dt.now().isoformat(), time=steps)
+    _save_manifest(filename, manifest)
+    return manifest
+
+
+def _save_manifest(filename, manifest):
+    import json
+    import os
+
+    tmp = _manifest_path(filename) + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp, _manifest_path(filename))
+
+
+def disable_byte_append(filename, reason):
+    """
+    Record in the manifest that a cached reanalysis file is no longer a byte copy of the
+    remote file (e.g. after normalize_time), so update_reanalysis appends over OPeNDAP.
+
+    :param filename: path of the cached file
+    :param reason: reason logged with the change
+    """
+    import os
+
+    manifest = read_manifest(filename)
+    if manifest is None or manifest.get('offset') is None:
+        return
+    LOGGER.info('Range append disabled for %s: %s', os.path.basename(filename), reason)
+    manifest['offset'] = None
+    _save_manifest(filename, manifest)
+
+
+def _append_bytes(url, filename, offset, remote_size, session):
+    """
+    Append the bytes added to a growing netCDF3 file with a Range request.
+
+    The records of netCDF3 files are appended at the end of the file, only the number
+    of records in the header changes. The bytes from `offset` (the size of the remote file
+    recorded in the manifest when the cached file was written) are appended. The update is
+    done only if the cached file still has this size (it was not rewritten, e.g. normalized)
+    and the head of the remote file equals the local one apart from the number of records,
+    otherwise False is returned.
+    """
+    import os
+
+    local_size = os.path.getsize(filename)
+    if offset is None:
+        LOGGER.info('no Range append for %s: the cached file is not a byte copy of the remote one', url)
+        return False
+    if local_size != offset:
+        LOGGER.info('no Range append for %s: the cached file has %s bytes, %s expected', url, local_size, offset)
+        return False
+    if remote_size <= offset:
+        return False
+    with open(filename, 'rb') as fp:
+        head = fp.read(min(local_size, 64 * 1024))
+    if head[:3] != b'CDF':
+        return False
+    numrecs = slice(4, 12) if head[3:4] == b'\x05' else slice(4, 8)  # 64-bit data format: 8 bytes
+
+    r = session.get(url, headers={'Range': 'bytes=0-{}'.format(len(head) - 1)})
+    remote_head = r.content
+    if r.status_code != 206 or len(remote_head) != len(head):
+        return False
+    if head[:numrecs.start] != remote_head[:numrecs.start] or head[numrecs.stop:] != remote_head[numrecs.stop:]:
+        LOGGER.debug('header of %s changed, no byte append', url)
+        return False
+
+    with open(filename, 'r+b') as fp:
+        try:
+            fp.seek(offset)
+            with session.get(url, stream=True, headers={'Range': 'bytes={}-'.format(offset)}) as r:
+                if r.status_code != 206:
+                    raise Exception('no partial content')
+                for chunk in r.iter_content(1024 * 1024):
+                    fp.write(chunk)
+            if fp.tell() != remote_size:
+                raise Exception('got {} of {} bytes'.format(fp.tell(), remote_size))
+            fp.seek(numrecs.start)
+            fp.write(remote_head[numrecs])
+        except Exception as ex:
+            LOGGER.warning('failed to append bytes of %s: %s', url, ex)
+            fp.truncate(offset)
+            return False
+    LOGGER.info('appended %s bytes of %s', remote_size - offset, url)
+    return True
+
+
+def _append_dap(dap_url, filename):
+    """Append the time steps of an OPeNDAP resource which are newer than the last one of a local file."""
+    from netCDF4 import Dataset, num2date, date2num
+    import numpy as np
+
+    with Dataset(dap_url) as src, Dataset(filename, 'a') as dst:
+        time = dst.variables['time']
+        if not dst.dimensions[time.dimensions[0]].isunlimited():
+            return False
+        calendar = getattr(time, 'calendar', 'standard')
+        remote = src.variables['time'][:]
+        if src.variables['time'].units != time.units:
+            remote = date2num(num2date(remote, src.variables['time'].units, calendar), time.units, calendar)
+        n = len(time)
+        new = np.where(remote > time[-1])[0] if n else np.arange(len(remote))
+        if len(new) == 0:
+            return True
+        i0, i1 = int(new[0]), int(new[-1]) + 1
+        for name, var in dst.variables.items():
+            if not var.dimensions or var.dimensions[0] != time.dimensions[0] or name == 'time':
+                continue
+            if name not in src.variables:
+                LOGGER.warning('variable %s not found in %s', name, dap_url)
+                return False
+            src.variables[name].set_auto_maskandscale(False)
+            var.set_auto_maskandscale(False)
+            var[n:n + i1 - i0] = src.variables[name][i0:i1]
+        time[n:n + i1 - i0] = remote[i0:i1]
+    LOGGER.info('appended %s time steps of %s', i1 - i0, dap_url)
+    return True
+
+
+def update_reanalysis(url, dap_url=None, session=None):
+    """
+    Updates the cached file of a growing (current year) reanalysis file incrementally.
+
+    The size, ETag and Last-Modified of the remote file are compared with the ones recorded
+    in the manifest of the cached file (the cached file itself may have been rewritten,
+    e.g. by normalize_time, and differ in size from the remote one). A changed file is
+    updated by appending the new bytes with a Range request (netCDF3 files not rewritten
+    since the download, if the server supports it) or the new time steps over OPeNDAP (if the
+    local time dimension is unlimited). Only if both fail the whole file is downloaded again.
+    The manifest (`<file>.manifest.json`) records the validators of the remote file, the
+    number of its bytes the cached file holds unchanged and the time steps of the cached file.
+
+    :param url: url of the reanalysis file (THREDDS fileServer)
+    :param dap_url: OPeNDAP url of the file (default: the url with fileServer replaced by dodsC)
+    :param session: requests.Session (default: shared session, see eggshell.utils.get_session)
+
+    :return str: path of the cached file
+    """
+    from os import path
+    import time
+    from eggshell.cache import get_cache
+
+    http = session or utils.get_session()
+    cache = get_cache()
+    dap_url = dap_url or url.replace('/fileServer/', '/dodsC/')
+    filename = cache.path(url)
+    if not path.exists(filename):
+        filename = cache.fetch(url, session=http)
+        write_manifest(filename, url, http.head(url).headers, offset=path.getsize(filename))
+        return filename
+
+    head = http.head(url)
+    head.raise_for_status()
+    remote_size = int(head.headers.get('Content-Length', -1))
+    manifest = read_manifest(filename) or {}
+
+    updated, offset = False, None
+    with cache.modify(url):
+        if all([manifest.get('size') == remote_size, manifest.get('etag') == head.headers.get('ETag'),
+                manifest.get('last_modified') == head.headers.get('Last-Modified')]):
+            LOGGER.debug('Rean data %s is up-to-date', path.basename(filename))
+            return filename
+        if head.headers.get('Accept-Ranges') == 'bytes' and remote_size > 0:
+            updated = _append_bytes(url, filename, manifest.get('offset'), remote_size, http)
+            offset = remote_size if updated else None
+        if not updated:
+            try:
+                updated = _append_dap(dap_url, filename)
+            except Exception as ex:
+                LOGGER.warning('failed to append time steps of %s: %s', dap_url, ex)
+        if updated:
+            write_manifest(filename, url, head.headers, offset=offset)
+
+    if updated:
+        cache.update(url, etag=head.headers.get('ETag'), last_modified=head.headers.get('Last-Modified'),
+                     validated=time.time())
+    else:
+        LOGGER.info('Rean data %s forced to update', path.basename(filename))
+        cache.remove(url)
+        filename = cache.fetch(url, session=http)
+        write_manifest(filename, url, head.headers, offset=path.getsize(filename))
+    return filename
+
+
+def reanalyses(start=1948, end=None, variable='slp', dataset='NCEP', timres='day', getlevel=True, workers=4):
     """
     Fetches the reanalysis data (NCEP, 20CR or ERA_20C) to local file system
 
@@ -39,15 +316,12 @@ def reanalyses(start=1948, end=None, variable='slp', dataset='NCEP', timres='day
     :param end: int for end year to fetch source data (if None, current year will be the end)
     :param variable: variable name (default='slp'), geopotential height is given as e.g. z700
     :param dataset: default='NCEP'
+    :param workers: number of concurrent downloads (default=4)
 
     :return list: list of path/files.nc
     """
-    # used for NETCDF convertion
-    from netCDF4 import Dataset
-    from os import path, system, remove
-    from eggshell.nc.ogc_utils import call
-    from shutil import move
-    # used for NETCDF convertion
+    from eggshell.cache import get_cache
+    from eggshell.nc.nc_utils import normalize_time
 
     try:
 
@@ -73,92 +347,39 @@ def reanalyses(start=1948, end=None, variable='slp', dataset='NCEP', timres='day
 
     LOGGER.info('level: %s' % level)
     cur_year = dt.now().year
-    cur_month = dt.now().month
-    cur_day = dt.now().day
     try:
+        urls = []
         for year in range(start, end + 1):
-            LOGGER.debug('fetching single file for %s year %s ' % (dataset, year))
-            try:
-                if dataset == 'NCEP':
-                    if variable == 'slp':
-                        url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/surface/%s.%s.nc' % (variable, year)  # noqa
-                    if variable == 'pr_wtr':
-                        url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/surface/pr_wtr.eatm.%s.nc' % (year)  # noqa
-                    if 'z' in variable:
-                        url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/ncep.reanalysis.dailyavgs/pressure/hgt.%s.nc' % (year)  # noqa
-                elif dataset == '20CRV2':
-                    if variable == 'prmsl':
-                        if timres == '6h':
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/monolevel/prmsl.%s.nc' % year  # noqa
-                        else:
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/Dailies/monolevel/prmsl.%s.nc' % year  # noqa
-                    if 'z' in variable:
-                        if timres == '6h':
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/pressure/hgt.%s.nc' % (year)  # noqa
-                        else:
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2/Dailies/pressure/hgt.%s.nc' % (year)  # noqa
-                elif dataset == '20CRV2c':
-                    if variable == 'prmsl':
-                        if timres == '6h':
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/monolevel/prmsl.%s.nc' % year  # noqa
-                        else:
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/Dailies/monolevel/prmsl.%s.nc' % year  # noqa
-                    if 'z' in variable:
-                        if timres == '6h':
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/pressure/hgt.%s.nc' % (year)  # noqa
-                        else:
-                            url = 'https://www.esrl.noaa.gov/psd/thredds/fileServer/Datasets/20thC_ReanV2c/Dailies/pressure/hgt.%s.nc' % (year)  # noqa
-                else:
-                    LOGGER.debug('Dataset %s not known' % dataset)
-                LOGGER.debug('url: %s' % url)
-            except Exception as ex:
-                msg = "could not set url: {}".format(ex)
-                LOGGER.exception(msg)
-            try:
-                # force updating of the current year dataset
-                if year == cur_year:
-                    import urlparse
-                    parsed_url = urlparse.urlparse(url)
-                    cur_filename = path.join(path.cache, parsed_url.netloc, parsed_url.path.strip('/'))
-                    if path.exists(cur_filename):
-                        fn_time = dt.fromtimestamp(path.getmtime(cur_filename))
-                        LOGGER.debug('Rean data for %s year creation time: %s' % (year, fn_time))
-                        if (fn_time.year == cur_year) and (fn_time.month == cur_month) and (fn_time.day == cur_day):
-                            LOGGER.debug('Rean data for %s year is up-to-date' % year)
-                        else:
-                            LOGGER.debug('Rean data for %s year forced to update' % year)
-                            remove(cur_filename)
-                # ###########################################
-                df = download(url, cache=True)
-                LOGGER.debug('single file fetched %s ' % year)
-                # convert to NETCDF4_CLASSIC
+            url = reanalyses_url(year, variable=variable, dataset=dataset, timres=timres)
+            LOGGER.debug('url: %s' % url)
+            if url is None:
+                continue
+            # update the current year dataset incrementally
+            if year == cur_year:
                 try:
-                    ds = Dataset(df)
-                    df_time = ds.variables['time']
-                    # Here, need to check not just calendar, but that file is ncdf_classic already...
-                    if (hasattr(df_time, 'calendar')) is False:
-                        p, f = path.split(path.abspath(df))
-                        LOGGER.debug("path = %s , file %s " % (p, f))
-                        # May be an issue if several users are working at the same time
-                        move(df, f)
-                        conv = call(resource=f,
-                                    output_format_options={'data_model': 'NETCDF4_CLASSIC'},
-                                    dir_output=p,
-                                    prefix=f.replace('.nc', ''))
-                        obs_data.append(conv)
-                        LOGGER.debug('file %s to NETCDF4_CLASSIC converted' % conv)
-                        # Cleaning, could be 50gb... for each (!) user
-                        # TODO Check how links work
-                        cmdrm = 'rm -f %s' % (f)
-                        system(cmdrm)
-                    else:
-                        obs_data.append(df)
-                    ds.close()
+                    update_reanalysis(url)
                 except Exception as ex:
-                    LOGGER.exception('failed to convert into NETCDF4_CLASSIC: {}'.format(ex))
+                    LOGGER.exception('failed to update Rean data for %s: %s' % (year, ex))
+            urls.append(url)
+
+        # ###########################################
+        LOGGER.debug('fetching %s files with %s concurrent downloads' % (len(urls), workers))
+        downloads = utils.download_files(urls, cache=True, workers=workers)
+
+        cache = get_cache()
+        for url, df in zip(urls, downloads):
+            if not df:
+                LOGGER.error('download failed on {}'.format(url))
+                continue
+            # add a missing calendar in place, rewrite only if the file is not NETCDF4_CLASSIC compatible
+            try:
+                with cache.modify(url):
+                    if normalize_time(df, calendar='standard', data_model='NETCDF4_CLASSIC'):
+                        LOGGER.debug('file %s normalized', df)
+                        disable_byte_append(df, 'normalized by normalize_time')
+                obs_data.append(df)
             except Exception as ex:
-                msg = "download failed on {}: {}".format(url, ex)
-                LOGGER.exception(msg)
+                LOGGER.exception('failed to convert into NETCDF4_CLASSIC: {}'.format(ex))
         LOGGER.info('Reanalyses data fetched for %s files' % len(obs_data))
     except Exception as ex:
         msg = "get reanalyses module failed to fetch data: {}".format(ex)
@@ -173,41 +394,134 @@ def reanalyses(start=1948, end=None, variable='slp', dataset='NCEP', timres='day
     return data
 
 
-def get_level(resource, level):
-    from flyingpigeon.ocgis_module import call
-    from netCDF4 import Dataset
-    from flyingpigeon.utils import get_variable
-    from numpy import squeeze
-    from os import path
+def _level_value(level):
+    """Return the pressure level of e.g. 500, '500', 'z500' or 'NCEP_z500' (see _PRESSUREDATA_)."""
+    return int(str(level).split('_')[-1].lstrip('z'))
 
+
+def get_levels(resource, levels, dir_output=None, memory_limit=256):
+    """
+    Extracts pressure levels of geopotential height files in one pass.
+
+    Each file is read once, in blocks of timesteps covering the requested levels,
+    and every level is written to its own file `z<level>_<random>.nc` with the
+    variable `z<level>` (dimensions time, lat, lon), so concurrent calls with the
+    same output folder do not overwrite each other. A missing calendar attribute
+    of the time variable is set to 'standard'.
+
+    :param resource: hgt file or list of yearly hgt files (sorted by name before concatenation)
+    :param levels: list of pressure levels, e.g. [500, 700, 850] or ['NCEP_z500', 'NCEP_z700']
+    :param dir_output: folder of the output files (default: current working directory)
+    :param memory_limit: size of the blocks read from the input files in MB
+
+    :return dict: level as given in levels -> path of netCDF file
+    """
+    from netCDF4 import Dataset, num2date, date2num
+    from eggshell.nc.nc_index import guess_main_variable
+    import numpy as np
+    import os
+    import tempfile
+
+    if not isinstance(resource, list):
+        resource = [resource]
+    resource = sorted(resource, key=lambda i: os.path.splitext(os.path.basename(i))[0])
+    dir_output = dir_output or os.getcwd()
+    values = [_level_value(level) for level in levels]
+
+    outputs = {}
+    datasets = {}
     try:
-        if type(resource) == list:
-            resource = sorted(resource, key=lambda i: path.splitext(path.basename(i))[0])
-            # resource.sort()
-
-        level_data = call(resource, level_range=[int(level), int(level)])
-        variable = get_variable(level_data)
-        LOGGER.info('found %s in file' % variable)
-        ds = Dataset(level_data, mode='a')
-        var = ds.variables.pop(variable)
-        dims = var.dimensions
-        new_var = ds.createVariable('z%s' % level, var.dtype, dimensions=(dims[0], dims[2], dims[3]))
-        # i = where(var[:]==level)
-        new_var[:, :, :] = squeeze(var[:, 0, :, :])
-
-        # TODO: Here may be an error! in case of exception, dataset will not close!
-        # Exception arise for example for 20CRV2 data...
-        try:
-            new_var.setncatts({k: var.getncattr(k) for k in var.ncattrs()})
-        except Exception as ex:
-            LOGGER.info('Could not set attributes for z {}{}'.format(level, ex))
-        ds.close()
-        LOGGER.info('level %s extracted' % level)
-        data = call(level_data, variable='z%s' % level)
+        for nc in resource:
+            with Dataset(nc) as src:
+                variable = guess_main_variable(src)
+                var = src.variables[variable]
+                var.set_auto_maskandscale(False)
+                time = src.variables['time']
+                level_dim = var.dimensions[1]
+                available = list(np.asarray(src.variables[level_dim][:]).astype(int))
+                missing = [v for v in values if v not in available]
+                if missing:
+                    raise Exception('levels {} not found in {}'.format(missing, nc))
+                index = [available.index(v) for v in values]
+                lmin, lmax = min(index), max(index)
+
+                if not datasets:
+                    units = time.units
+                    calendar = getattr(time, 'calendar', 'standard')
+                    for level, value in zip(levels, values):
+                        fd, outputs[level] = tempfile.mkstemp(prefix='z{}_'.format(value), suffix='.nc',
+                                                              dir=dir_output)
+                        os.close(fd)
+                        datasets[level] = _create_level_file(outputs[level], src, var, value, calendar)
+
+                # time values converted if the units change between the files
+                times = time[:]
+                if time.units != units:
+                    times = date2num(num2date(times, time.units, calendar), units, calendar)
+                n = len(datasets[levels[0]].dimensions['time'])
+                for ds in datasets.values():
+                    ds.variables['time'][n:n + len(times)] = times
+
+                step_mb = var.dtype.itemsize * (lmax - lmin + 1) * np.prod(var.shape[2:]) / 1024 ** 2
+                block = max(1, int(memory_limit / step_mb))
+                for t in range(0, len(times), block):
+                    data = var[t:t + block, lmin:lmax + 1]
+                    for level, value, i in zip(levels, values, index):
+                        datasets[level].variables['z{}'.format(value)][n + t:n + t + len(data)] = data[:, i - lmin]
+            LOGGER.info('levels %s extracted from %s', values, nc)
     except Exception as ex:
-        LOGGER.exception('failed to extract level {}'.format(ex))
+        LOGGER.exception('failed to extract levels {}'.format(ex))
+        for ds in datasets.values():
+            ds.close()
+        for filename in outputs.values():
+            os.remove(filename)
+        raise Exception('failed to extract levels {}: {}'.format(values, ex))
+    for ds in datasets.values():
+        ds.close()
+    return outputs
 
-    return data
+
+def _attributes(var):
+    """Return the attributes of a netCDF variable which can be copied after its creation."""
+    return {k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'}
+
+
+def _create_level_file(filename, src, var, value, calendar):
+    """Create the output file of get_levels for one level with the grid of src."""
+    from netCDF4 import Dataset
+
+    ds = Dataset(filename, 'w', format='NETCDF4_CLASSIC')
+    ds.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+    time, _, lat, lon = var.dimensions
+    ds.createDimension(time, None)
+    for dim in (lat, lon):
+        ds.createDimension(dim, len(src.dimensions[dim]))
+        out = ds.createVariable(dim, src.variables[dim].dtype, (dim,))
+        out.setncatts(_attributes(src.variables[dim]))
+        out[:] = src.variables[dim][:]
+
+    out = ds.createVariable(time, src.variables[time].dtype, (time,))
+    out.setncatts(_attributes(src.variables[time]))
+    out.calendar = calendar
+
+    out = ds.createVariable('z{}'.format(value), var.dtype, (time, lat, lon),
+                            fill_value=getattr(var, '_FillValue', None))
+    out.set_auto_maskandscale(False)
+    out.setncatts(_attributes(var))
+    out.level = value
+    return ds
+
+
+def get_level(resource, level):
+    """
+    Extracts one pressure level of geopotential height files (see get_levels).
+
+    :param resource: hgt file or list of yearly hgt files
+    :param level: pressure level, e.g. 500
+
+    :return str: path of netCDF file with the variable z<level>
+    """
+    return get_levels(resource, [level])[level]
 
 
 def write_fileinfo(resource, filepath=False):
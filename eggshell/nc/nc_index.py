@@ -0,0 +1,219 @@
+"""
+Metadata index for netCDF files.
+
+Most helpers in :mod:`eggshell.nc.nc_utils` only need a handful of header
+values (global attributes, dimensions, the main variable and the time axis).
+The :class:`MetadataIndex` reads these once per file and keeps them in memory
+and, optionally, in an SQLite database shared between processes. Entries are
+keyed by path, size and modification time, so a modified file is read again.
+
+Example usage::
+
+    from eggshell.nc.nc_index import metadata
+    record = metadata('tas_day_EUR-11.nc')
+    record['attributes']['frequency']
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from eggshell.dependencies import lazy_import
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+Dataset = lazy_import('netCDF4', 'Dataset')
+
+
+def guess_main_variable(ds):
+    """
+    Guess the main variable of a netCDF4.Dataset (compare nc_utils.get_variable).
+
+    :param ds: netCDF4.Dataset
+
+    :return str: name of the first 3D or 4D variable, None if there is none
+    """
+    main_vars = [key for key in ds.variables.keys() if len(ds.variables[key].dimensions) >= 3]
+    if len(main_vars) > 1:
+        LOGGER.warning('more than one 3D or 4D variable in file')
+    if len(main_vars) == 0:
+        LOGGER.warning('No 3D or 4D variable detected')
+        return None
+    return main_vars[0]
+
+
+def _to_builtin(value):
+    """Convert netCDF attribute values to JSON serialisable python objects."""
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    return value
+
+
+def read_metadata(resource):
+    """
+    Read the header information of a netCDF file with a single open.
+
+    :param resource: path to netCDF file
+
+    :return dict: attributes, dimensions, variables (with their dimensions),
+                  variable, variable_dimensions, variable_shape and time (units, calendar, first, last, size)
+    """
+    with Dataset(resource) as ds:
+        record = dict(
+            attributes={k: _to_builtin(ds.getncattr(k)) for k in ds.ncattrs()},
+            dimensions={name: len(dim) for name, dim in ds.dimensions.items()},
+            variables={name: list(var.dimensions) for name, var in ds.variables.items()},
+            variable=guess_main_variable(ds),
+            variable_dimensions=[],
+            variable_shape=[],
+            time=None)
+
+        if record['variable'] is not None:
+            var = ds.variables[record['variable']]
+            record['variable_dimensions'] = list(var.dimensions)
+            record['variable_shape'] = list(var.shape)
+
+        if 'time' in ds.variables:
+            time = ds.variables['time']
+            record['time'] = dict(
+                units=getattr(time, 'units', None),
+                calendar=getattr(time, 'calendar', None),
+                size=len(time),
+                first=float(time[0]) if len(time) else None,
+                last=float(time[-1]) if len(time) else None)
+    return record
+
+
+class MetadataIndex(object):
+    """In-memory and SQLite backed cache of :func:`read_metadata` records."""
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: SQLite database file. If None, records are only kept in memory.
+        """
+        self.db_path = db_path
+        self._records = {}
+        self._lock = threading.Lock()
+        if db_path:
+            if not os.path.exists(os.path.dirname(os.path.abspath(db_path))):
+                os.makedirs(os.path.dirname(os.path.abspath(db_path)))
+            self._execute('CREATE TABLE IF NOT EXISTS metadata '
+                          '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, record TEXT)')
+
+    def _execute(self, sql, parameters=()):
+        """Run a single statement on the SQLite database and return the first row."""
+        con = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with con:
+                return con.execute(sql, parameters).fetchone()
+        finally:
+            con.close()
+
+    def get(self, resource):
+        """
+        Return the metadata record of a netCDF file, reading the file only if it
+        is not indexed yet or has changed since.
+
+        :param resource: path to netCDF file
+
+        :return dict: metadata record
+        """
+        path = os.path.abspath(resource)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            entry = self._records.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        record = None
+        if self.db_path:
+            try:
+                row = self._execute('SELECT size, mtime, record FROM metadata WHERE path = ?', (path,))
+                if row is not None and (row[0], row[1]) == stamp:
+                    record = json.loads(row[2])
+            except sqlite3.Error:
+                LOGGER.exception('failed to read metadata index %s', self.db_path)
+
+        if record is None:
+            LOGGER.debug('indexing metadata of %s', path)
+            record = read_metadata(path)
+            if self.db_path:
+                try:
+                    self._execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                                  (path, stamp[0], stamp[1], json.dumps(record)))
+                except sqlite3.Error:
+                    LOGGER.exception('failed to write metadata index %s', self.db_path)
+
+        with self._lock:
+            self._records[path] = (stamp, record)
+        return record
+
+    def invalidate(self, resource):
+        """Remove a file from the index."""
+        path = os.path.abspath(resource)
+        with self._lock:
+            self._records.pop(path, None)
+        if self.db_path:
+            self._execute('DELETE FROM metadata WHERE path = ?', (path,))
+
+    def clear(self):
+        """Remove all entries from the index."""
+        with self._lock:
+            self._records.clear()
+        if self.db_path:
+            self._execute('DELETE FROM metadata')
+
+
+_index = None
+
+
+def default_db_path():
+    """
+    Return the path of the shared SQLite index. The cache configuration option
+    `nc_index_path` is used if set, otherwise `nc_index.sqlite` in the server cache.
+    None is returned if no server configuration is available.
+    """
+    try:
+        import eggshell
+        from eggshell.config import Paths
+        from pywps import configuration
+    except ImportError:
+        return None
+    db_path = configuration.get_config_value("cache", "nc_index_path")
+    return db_path or os.path.join(Paths(eggshell).cache, 'nc_index.sqlite')
+
+
+def get_index():
+    """Return the index shared by the helpers in eggshell.nc."""
+    global _index
+    if _index is None:
+        db_path = default_db_path()
+        try:
+            _index = MetadataIndex(db_path)
+        except (OSError, sqlite3.Error):
+            LOGGER.exception('failed to open metadata index %s, using memory only', db_path)
+            _index = MetadataIndex()
+    return _index
+
+
+def set_index(index):
+    """Replace the shared index, e.g. MetadataIndex(db_path) or MetadataIndex() for memory only."""
+    global _index
+    _index = index
+
+
+def metadata(resource):
+    """
+    Return the metadata record of a netCDF file from the shared index.
+
+    :param resource: path to netCDF file
+
+    :return dict: metadata record (see :func:`read_metadata`)
+    """
+    return get_index().get(resource)
@@ -0,0 +1,259 @@
+"""
+OPeNDAP helpers.
+
+Opening an URL with netCDF4 to find out if a server speaks OPeNDAP costs a
+full (and, for plain HTTP servers, failing) DAP handshake. The functions here
+detect OPeNDAP support with a cheap probe of the `.dds` response and remember
+the result per host and path prefix, so that all files below a THREDDS
+`dodsC` or `fileServer` folder are classified by the first probe.
+
+:func:`subset_opendap` fetches only the hyperslabs of a time range and
+bounding box instead of the whole file.
+
+Example usage::
+
+    from datetime import datetime as dt
+    from eggshell.nc.nc_opendap import supports_opendap, subset_opendap
+    url = 'https://example.org/thredds/dodsC/birdhouse/tas.nc'
+    if supports_opendap(url):
+        subset_opendap(url, time_range=[dt(2001, 1, 1), dt(2010, 12, 31)], bbox=[-10, 35, 30, 70])
+"""
+
+import os
+import posixpath
+import threading
+import time
+
+import numpy as np
+
+from urllib.parse import urlparse
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# seconds after which the capability of a server is probed again
+CAPABILITY_TTL = 3600
+
+_capabilities = {}  # (scheme, netloc, folder) -> (supports opendap, time of probe)
+_capabilities_lock = threading.Lock()
+
+
+def _key(url):
+    parsed = urlparse(url)
+    return parsed.scheme, parsed.netloc, posixpath.dirname(parsed.path)
+
+
+def known_capability(url):
+    """
+    Return the remembered OPeNDAP capability of the folder of an URL or of a parent folder.
+    The capability of the root folder of a host only applies to the files in that folder.
+
+    :param url: url of a NetCDF resource
+
+    :return bool: True or False if known, None if the server has to be probed
+    """
+    scheme, netloc, folder = _key(url)
+    now = time.time()
+    with _capabilities_lock:
+        while True:
+            entry = _capabilities.get((scheme, netloc, folder))
+            if entry is not None and now - entry[1] < CAPABILITY_TTL:
+                return entry[0]
+            folder = posixpath.dirname(folder)
+            if folder in ('', '/'):
+                return None
+
+
+def remember_capability(url, dap):
+    """Remember if the server of an URL speaks OPeNDAP below the folder of the URL (None is not remembered)."""
+    if dap is None:
+        return
+    with _capabilities_lock:
+        _capabilities[_key(url)] = (dap, time.time())
+
+
+def clear_capabilities():
+    """Forget all probed servers."""
+    with _capabilities_lock:
+        _capabilities.clear()
+
+
+def probe_opendap(url, cookies=None, session=None, timeout=30):
+    """
+    Probe an URL for OPeNDAP with a request of its dataset descriptor structure (`<url>.dds`),
+    a few bytes starting with `Dataset {` on DAP servers.
+
+    Only a 200 response is an answer: with this body the URL is served by OPeNDAP, with any
+    other body it is not. Errors (e.g. 404 of a missing file, 5xx, timeouts) say nothing
+    about the server, the capability is unknown.
+
+    :param url: url of a NetCDF resource
+    :param cookies: cookies sent with the request, e.g. an authentication ticket
+    :param session: requests.Session (default: shared session, see eggshell.utils.get_session)
+    :param timeout: seconds to wait for the server
+
+    :return bool: True if the URL is served by OPeNDAP, False if not, None if unknown
+    """
+    from eggshell.utils import get_session
+    http = session or get_session()
+    try:
+        with http.get(url + '.dds', cookies=cookies, stream=True, timeout=timeout) as r:
+            if r.status_code != 200:
+                LOGGER.debug('OPeNDAP probe of %s: status %s', url, r.status_code)
+                return None
+            head = r.raw.read(64, decode_content=True)
+        return head.lstrip().startswith(b'Dataset')
+    except Exception as e:
+        LOGGER.debug('OPeNDAP probe of %s failed: %s', url, e)
+        return None
+
+
+def supports_opendap(url, cookies=None, session=None):
+    """
+    Check if an URL is served by OPeNDAP, probing the server only if its folder is unknown.
+    A failed probe is not remembered, the next call probes again.
+
+    :param url: url of a NetCDF resource
+    :param cookies: cookies sent with the probe, e.g. an authentication ticket
+    :param session: requests.Session (default: shared session, see eggshell.utils.get_session)
+
+    :return bool: True if the URL is served by OPeNDAP
+    """
+    dap = known_capability(url)
+    if dap is None:
+        dap = probe_opendap(url, cookies=cookies, session=session)
+        LOGGER.debug('%s OPeNDAP support: %s', url, dap)
+        remember_capability(url, dap)
+    return bool(dap)
+
+
+def _index(ds, variable, time_range=None, bbox=None):
+    """Return the slices of the dimensions of a variable selected by time range and bbox."""
+    from eggshell.nc.nc_utils import time_slice, coordinate_slice
+
+    dims = ds.variables[variable].dimensions
+    index = {}
+    if time_range is not None and 'time' in dims:
+        index['time'] = time_slice(ds.variables['time'], time_range)
+    if bbox is not None and len(dims) >= 2:
+        if dims[-1] in ds.variables:
+            index[dims[-1]] = coordinate_slice(ds.variables[dims[-1]], bbox[0], bbox[2])
+        if dims[-2] in ds.variables:
+            index[dims[-2]] = coordinate_slice(ds.variables[dims[-2]], bbox[1], bbox[3])
+    return index
+
+
+def output_filename(url, *args):
+    """
+    Return a file name for the data of an URL fetched with the given arguments. Subsets get
+    the basename of the URL with a hash of the URL and the arguments, e.g. `tas_3f2a9c1b04d7.nc`,
+    whole files (all arguments None) keep the basename of the URL.
+
+    :param url: url (or path) of a NetCDF resource
+    :param args: arguments of the request, e.g. variable, time range and bbox of a subset
+
+    :return str: file name
+    """
+    import hashlib
+    if all(arg is None for arg in args):
+        return posixpath.basename(urlparse(url).path)
+    stem = os.path.splitext(posixpath.basename(urlparse(url).path))[0] or 'data'
+    digest = hashlib.sha1(repr((url,) + args).encode('utf-8')).hexdigest()[:12]
+    return '{}_{}.nc'.format(stem, digest)
+
+
+def subset_opendap(url, variable=None, time_range=None, bbox=None, output_path=None, complevel=4,
+                   memory_limit=256):
+    """
+    Fetch a subset of a remote dataset over OPeNDAP and write it to a local, compressed netCDF file.
+
+    The index ranges are computed from the coordinate variables, so only the
+    hyperslabs of the time range and bbox are transferred. The main variable is
+    requested in blocks of timesteps of at most `memory_limit` MB. Coordinates,
+    bounds and other variables with less than three dimensions are copied
+    (subset along the selected dimensions), other data variables are skipped.
+    The subset is written to a temporary file which is renamed to the output file
+    (see output_filename) when complete.
+
+    :param url: OPeNDAP url (or path) of a NetCDF resource
+    :param variable: variable to be fetched (if not set, variable will be detected)
+    :param time_range: list[start, end] of datetime, None for an open bound
+    :param bbox: [min_x, min_y, max_x, max_y] in the coordinates of the two spatial dimensions
+                 of the variable (e.g. rlon/rlat for rotated pole grids)
+    :param output_path: folder of the output file (default: current working directory)
+    :param complevel: zlib compression level of the output file (0 for no compression)
+    :param memory_limit: size of the blocks requested from the server in MB
+
+    :return str: path of the netCDF file
+    """
+    import tempfile
+
+    output_path = output_path or os.getcwd()
+    output_file = os.path.join(output_path, output_filename(url, variable, time_range, bbox))
+    if os.path.abspath(output_file) == os.path.abspath(url):
+        raise Exception('the output file {} is the input file, use another output_path'.format(output_file))
+    fd, tmp = tempfile.mkstemp(dir=output_path, suffix='.nc.part')
+    os.close(fd)
+    try:
+        _write_subset(url, tmp, variable, time_range, bbox, complevel, memory_limit)
+        os.replace(tmp, output_file)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return output_file
+
+
+def _write_subset(url, output_file, variable, time_range, bbox, complevel, memory_limit):
+    """Write the subset of a dataset to a netCDF file (see subset_opendap)."""
+    from netCDF4 import Dataset
+    from eggshell.nc.nc_index import guess_main_variable
+
+    with Dataset(url) as src:
+        if variable is None:
+            variable = guess_main_variable(src)
+            if variable is None:
+                raise Exception('no variable found in {}'.format(url))
+        index = _index(src, variable, time_range, bbox)
+        LOGGER.info('fetching subset %s of %s', index, url)
+
+        with Dataset(output_file, 'w') as dst:
+            dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                size = len(range(*index[name].indices(len(dim)))) if name in index else len(dim)
+                dst.createDimension(name, None if dim.isunlimited() else size)
+
+            for name, var in src.variables.items():
+                if name != variable and var.ndim >= 3:
+                    continue
+                var.set_auto_maskandscale(False)
+                fill_value = getattr(var, '_FillValue', None)
+                out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value,
+                                         zlib=complevel > 0 and var.dtype != str, complevel=complevel or 1)
+                out.set_auto_maskandscale(False)
+                out.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+                selection = [index.get(dim, slice(None)) for dim in var.dimensions]
+
+                if var.ndim == 0:
+                    try:
+                        out.assignValue(var.getValue())
+                    except Exception:
+                        LOGGER.debug('failed to read scalar variable %s, copied attributes only', name)
+                elif name == variable and 'time' in var.dimensions:
+                    _copy_blocks(var, out, selection, var.dimensions.index('time'), memory_limit)
+                else:
+                    out[:] = var[tuple(selection)]
+
+
+def _copy_blocks(var, out, selection, axis, memory_limit):
+    """Copy a variable in blocks of timesteps of at most memory_limit MB."""
+    shape = [len(range(*s.indices(n))) for s, n in zip(selection, var.shape)]
+    step_mb = var.dtype.itemsize * int(np.prod(shape)) / max(shape[axis], 1) / 1024 ** 2
+    block = max(1, int(memory_limit / step_mb)) if step_mb > 0 else max(shape[axis], 1)
+
+    start, stop, _ = selection[axis].indices(var.shape[axis])
+    for i in range(start, stop, block):
+        src = list(selection)
+        src[axis] = slice(i, min(i + block, stop))
+        dst = [slice(None)] * var.ndim
+        dst[axis] = slice(i - start, min(i + block, stop) - start)
+        out[tuple(dst)] = var[tuple(src)]
@@ -1,14 +1,17 @@
-from netCDF4 import Dataset, MFDataset, num2date
-from ocgis import RequestDataset
 from datetime import datetime as dt
+from eggshell.dependencies import lazy_import
+from eggshell.nc.nc_index import metadata, guess_main_variable
 # TODO: change to nc_utils guess_main_variables
 # from eggshell.nc.ocg_utils import get_variable
 import logging
+import numpy as np
 import os
 from os import path, rename
-import requests
 
 LOGGER = logging.getLogger("PYWPS")
+
+Dataset, MFDataset, num2date, date2num = lazy_import('netCDF4', 'Dataset', 'MFDataset', 'num2date', 'date2num')
+RequestDataset = lazy_import('ocgis', 'RequestDataset')
 # from esgf_utils import ATTRIBUTE_TO_FACETS_MAP
 
 
@@ -45,7 +48,7 @@ class CookieNetCDFTransfer:
             os.remove(self.auth_cookie_fn)
 
 
-def aggregations(resource):
+def aggregations(resource, workers=None):
     """
     aggregates netcdf files by experiment. Aggregation examples:
     CORDEX: EUR-11_ICHEC-EC-EARTH_historical_r3i1p1_DMI-HIRHAM5_v1_day
@@ -54,12 +57,17 @@ def aggregations(resource):
     200101-200512, 200601-201012, ...
     Time axis is sorted by time.
     :param resource: list of netcdf files
+    :param workers: number of processes to read the file metadata in parallel (default: serial)
     :return: dictionary with key=experiment
     """
-    from .nc_utils import drs_filename, sort_by_time
+    records = inspect_files(resource, workers=workers)
     aggregations = {}
     for nc in resource:
-        key = drs_filename(nc, skip_timestamp=True, skip_format=True)
+        if records[nc] is None:
+            raise Exception('failed to read metadata of %s' % nc)
+        key = _drs_name(records[nc])
+        if key is None:
+            key = path.basename(nc)
 
         # collect files of each aggregation (time axis)
         if key in aggregations:
@@ -69,21 +77,158 @@ def aggregations(resource):
 
     # collect aggregation metadata
     for key in aggregations.keys():
-        # sort files by time
-        aggregations[key]['files'] = sort_by_time(aggregations[key]['files'])
-        # start timestamp of first file
-        start, _ = get_timerange(aggregations[key]['files'][0])
-        # end timestamp of last file
-        _, end = get_timerange(aggregations[key]['files'][-1])
+        # sort files by time, files without time axis first
+        files = aggregations[key]['files']
+        files.sort(key=lambda nc: (records[nc]['start_time'] is not None, records[nc]['start_time'] or ''))
+        # start timestamp of first file, end timestamp of last file with a time axis
+        starts = [records[nc]['start'] for nc in files if records[nc]['start'] is not None]
+        ends = [records[nc]['end'] for nc in files if records[nc]['end'] is not None]
+        start = starts[0] if starts else None
+        end = ends[-1] if ends else None
         aggregations[key]['from_timestamp'] = start
         aggregations[key]['to_timestamp'] = end
-        aggregations[key]['start_year'] = int(start[0:4])
-        aggregations[key]['end_year'] = int(end[0:4])
-        aggregations[key]['variable'] = get_variable(aggregations[key]['files'][0])
-        aggregations[key]['filename'] = "%s_%s-%s.nc" % (key, start, end)
+        aggregations[key]['start_year'] = int(start[0:4]) if start else None
+        aggregations[key]['end_year'] = int(end[0:4]) if end else None
+        aggregations[key]['variable'] = records[files[0]]['variable']
+        if start and end:
+            aggregations[key]['filename'] = "%s_%s-%s.nc" % (key, start, end)
+        else:
+            aggregations[key]['filename'] = "%s.nc" % key
     return aggregations
 
 
+def _num2date(value, units=None, calendar=None):
+    if units and calendar:
+        return num2date(value, units, calendar)
+    elif units:
+        return num2date(value, units)
+    return num2date(value)
+
+
+def _facets(attributes, variable):
+    """
+    returns the data reference syntax facets of a file.
+
+    :param attributes: global attributes of the netCDF file
+    :param variable: main variable
+
+    :return dict: facets, None if the project is unknown
+    """
+    project = attributes.get('project_id')
+    if project == 'CORDEX' or project == 'EOBS':
+        return dict(variable=variable,
+                    domain=attributes['CORDEX_domain'],
+                    driving_model=attributes['driving_model_id'],
+                    experiment=attributes['experiment_id'],
+                    ensemble=attributes['driving_model_ensemble_member'],
+                    model=attributes['model_id'],
+                    version=attributes['rcm_version_id'],
+                    frequency=attributes['frequency'])
+    elif project == 'CMIP5':
+        # TODO: attributes missing in netcdf file for name generation?
+        return dict(variable=variable,
+                    model=attributes['model_id'],
+                    experiment=attributes['experiment'],
+                    ensemble=attributes['parent_experiment_rip'])
+    return None
+
+
+def _drs_name(record, variable=None):
+    """
+    returns the DRS name (without timestamp and extension) of an inspect record.
+
+    :param record: output of inspect
+    :param variable: overwrites the variable of the record
+
+    :return str: DRS name, None for unknown projects
+    """
+    facets = record['facets']
+    if facets is None:
+        return None
+    if variable is not None:
+        facets = dict(facets, variable=variable)
+    if record['project'] == 'CMIP5':
+        # CMIP5 example: tas_MPI-ESM-LR_historical_r1i1p1
+        return "{variable}_{model}_{experiment}_{ensemble}".format(**facets)
+    # CORDEX example: EUR-11_ICHEC-EC-EARTH_historical_r3i1p1_DMI-HIRHAM5_v1_day
+    return "{variable}_{domain}_{driving_model}_{experiment}_{ensemble}_{model}_{version}_{frequency}".format(**facets)
+
+
+def inspect(resource):
+    """
+    returns a compact description of a netCDF file. The file is opened only once
+    (see eggshell.nc.nc_index), all further calls are served from the metadata index.
+
+    :param resource: path to netCDF file
+
+    :return dict: path, project, facets (DRS facets, None for unknown projects),
+                  variable, frequency, start, end (YYYYMMDD), start_time (ISO format),
+                  units, calendar, dimensions and grid_shape of the variable
+    """
+    record = metadata(resource)
+    attributes = record['attributes']
+    variable = record['variable']
+
+    try:
+        facets = _facets(attributes, variable)
+    except KeyError as ex:
+        LOGGER.warning('incomplete DRS attributes in %s: %s', resource, ex)
+        facets = None
+
+    time = record['time'] or {}
+    start = end = start_time = None
+    if time.get('first') is not None:
+        s = _num2date(time['first'], time['units'], time['calendar'])
+        e = _num2date(time['last'], time['units'], time['calendar'])
+        start = '%s%s%s' % (s.year, str(s.month).zfill(2), str(s.day).zfill(2))
+        end = '%s%s%s' % (e.year, str(e.month).zfill(2), str(e.day).zfill(2))
+        start_time = '%04d-%02d-%02dT%02d:%02d:%02d' % (s.year, s.month, s.day, s.hour, s.minute, s.second)
+
+    dims = record['variable_dimensions']
+    grid_shape = [n for d, n in zip(dims, record['variable_shape']) if d != 'time']
+
+    return dict(path=path.abspath(resource),
+                project=attributes.get('project_id'),
+                facets=facets,
+                variable=variable,
+                frequency=attributes.get('frequency'),
+                start=start,
+                end=end,
+                start_time=start_time,
+                units=time.get('units'),
+                calendar=time.get('calendar'),
+                dimensions=dims,
+                grid_shape=grid_shape)
+
+
+def _try_inspect(resource):
+    try:
+        return inspect(resource)
+    except Exception:
+        LOGGER.exception('failed to inspect %s', resource)
+        return None
+
+
+def inspect_files(resource, workers=None):
+    """
+    inspects a list of netCDF files, optionally in a pool of processes.
+    Results are returned in a deterministic order, independent of the number of workers.
+
+    :param resource: list of netCDF files
+    :param workers: number of processes (default: None, files are inspected one after another)
+
+    :return dict: {file: inspect record}, the record is None if the file could not be read
+    """
+    if workers and workers > 1 and len(resource) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, len(resource) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            records = list(pool.map(_try_inspect, resource, chunksize=chunksize))
+    else:
+        records = [_try_inspect(nc) for nc in resource]
+    return dict(zip(resource, records))
+
+
 def get_auth_cookie(pywps_request):
     try:
         return dict(auth_tkt=pywps_request.http_request.cookies['auth_tkt'])
@@ -93,40 +238,55 @@ def get_auth_cookie(pywps_request):
 
 
 def opendap_or_download(resource, auth_tkt_cookie={}, output_path=None,
-                        max_nbytes=10000000000):
+                        max_nbytes=10000000000, variable=None, time_range=None, bbox=None):
     """Check for OPEnDAP support, if not download the resource.
+
+    The OPeNDAP support of HTTP servers is probed with a `.dds` request and
+    remembered per server folder (see eggshell.nc.nc_opendap). Other resources
+    are downloaded to the download cache (see eggshell.cache) or output_path.
+    If a time range or bbox is given, only that subset of an OPeNDAP resource
+    is fetched to a local file (see eggshell.nc.nc_opendap.subset_opendap).
+
     :param resource: url of a NetCDF resource
-    :param output_path: where to save the non-OPEnDAP resource
-    :param max_nbytes: maximum file size for download, default: 1 gb
-    :return str: the original url if OPEnDAP is supported or path of saved file
+    :param output_path: where to save the non-OPEnDAP resource or subset (default: download cache,
+                        current working directory for subsets). Downloads keep the basename of the
+                        url, subsets get a hash of the url and subset in their name
+                        (see eggshell.nc.nc_opendap.output_filename).
+    :param max_nbytes: maximum file size for download, default: 10 gb. Checked
+                       before anything is written if the server announces the size.
+    :param variable: variable of a subset (if not set, variable will be detected)
+    :param time_range: list[start, end] of datetime of a subset
+    :param bbox: [min_x, min_y, max_x, max_y] of a subset in the coordinates of the variable
+    :return str: the original url if OPEnDAP is supported, path of saved file or subset
     """
+    from eggshell.nc.nc_opendap import supports_opendap, subset_opendap
 
-    try:
-        nc = Dataset(resource, 'r')
-        nc.close()
-    except Exception:
-        response = requests.get(resource, cookies=auth_tkt_cookie, stream=True)
-        if response.status_code == 401:
-            raise Exception("Not Authorized")
-
-        if 'Content-Length' in response.headers.keys():
-            if int(response.headers['Content-Length']) > max_nbytes:
-                raise IOError("File too large to download.")
-        chunk_size = 16 * 1024
-        if not output_path:
-            output_path = os.getcwd()
-        output_file = os.path.join(output_path, os.path.basename(resource))
-        with open(output_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size):
-                if chunk:
-                    f.write(chunk)
+    if not resource.startswith(('http://', 'https://')):
         try:
-            nc = Dataset(output_file, 'r')
+            nc = Dataset(resource, 'r')
             nc.close()
+            return resource
         except Exception:
-            raise IOError("This does not appear to be a valid NetCDF file.")
-        return output_file
-    return resource
+            LOGGER.debug('failed to open %s, downloading', resource)
+    elif supports_opendap(resource, cookies=auth_tkt_cookie):
+        if time_range is None and bbox is None:
+            return resource
+        return subset_opendap(resource, variable=variable, time_range=time_range, bbox=bbox,
+                              output_path=output_path)
+
+    if output_path:
+        from eggshell.utils import fetch_file
+        output_file = os.path.join(output_path, os.path.basename(resource))
+        fetch_file(resource, output_file, cookies=auth_tkt_cookie, max_nbytes=max_nbytes)
+    else:
+        from eggshell.cache import get_cache
+        output_file = get_cache().fetch(resource, cookies=auth_tkt_cookie, max_nbytes=max_nbytes)
+    try:
+        nc = Dataset(output_file, 'r')
+        nc.close()
+    except Exception:
+        raise IOError("This does not appear to be a valid NetCDF file.")
+    return output_file
 
 
 def get_coordinates(resource, variable=None, unrotate=False):
@@ -181,13 +341,8 @@ def get_index_lat(resource, variable=None):
         variable = get_variable(resource)
     if type(resource) != list:
         resource = [resource]
-    if len(resource) == 1:
-        ds = Dataset(resource[0])
-    else:
-        ds = MFDataset(resource)
 
-    var = ds.variables[variable]
-    dims = list(var.dimensions)
+    dims = metadata(resource[0])['variables'][variable]
 
     if 'rlat' in dims:
         index = dims.index('rlat')
@@ -204,9 +359,9 @@ def get_variable(resources):
     """Guess main variables in a NetCDF file.
     (compare nc.ocg_utils.get_variable)
 
-    :param resources: netCDF4.Dataset
+    :param resources: path, list of paths of one dataset or netCDF4.Dataset
 
-    :return list: names of main variables
+    :return str: name of the main variable
 
     Notes
     -----
@@ -215,26 +370,20 @@ def get_variable(resources):
     automatically ignored.
     """
 
+    # assume that main variables are 3D or 4D
     if type(resources) == str:
-        ncdataset = Dataset(resources)
+        variable = inspect(resources)['variable']
     elif type(resources) == list:
-        ncdataset = MFDataset(resources)
+        # files of one dataset share the main variable
+        variable = inspect(resources[0])['variable']
     else:
-        ncdataset = resources
+        variable = guess_main_variable(resources)
 
-    # dims = [key for key in ncdataset.dimensions.keys()]
-    vars = [key for key in ncdataset.variables.keys()]
-
-    # assume that main variables are 3D or 4D
-    main_vars = []
-    for var in vars:
-        if len(ncdataset.variables[var].dimensions) >= 3:
-            main_vars.append(var)
-    if len(main_vars) > 1:
-        LOGGER.exception('more than one 3D or 4D variable in file')
-    if len(main_vars) == 0:
-        LOGGER.exception('No 3D or 4D variable detected')
-    return main_vars[0]
+    if variable is None:
+        msg = 'No 3D or 4D variable detected'
+        LOGGER.error(msg)
+        raise Exception(msg)
+    return variable
 
     # var_candidates = []
     # bnds_variables = []
@@ -265,13 +414,14 @@ def get_variable(resources):
     # return main_variables
 
 
-def sort_by_filename(resource, historical_concatination=False):
+def sort_by_filename(resource, historical_concatination=False, workers=None):
     """
     Sort a list of files with CORDEX-conformant file names.
 
     :param resource: netCDF file
     :param historical_concatination: if True (default=False), appropriate historial
                                     runs will be sorted to the rcp datasets
+    :param workers: number of processes to read the time ranges in parallel (default: serial)
     :return  dictionary: {'drs_filename': [list of netCDF files]}
     """
     from os import path
@@ -343,11 +493,13 @@ def sort_by_filename(resource, historical_concatination=False):
                         LOGGER.exception('failed for %s ' % key)
             except Exception:
                 LOGGER.exception('failed to populate the dictionary with appropriate files')
+            # read the time ranges of all files at once
+            records = inspect_files([path.abspath(n) for n in resource], workers=workers)
             for key in nc_datasets.keys():
                 try:
                     nc_datasets[key].sort()
-                    start, _ = get_timerange(nc_datasets[key][0])  # get first timestep of first file
-                    _ , end = get_timerange(nc_datasets[key][-1])  # get last  timestep of last file
+                    start = records[nc_datasets[key][0]]['start']  # get first timestep of first file
+                    end = records[nc_datasets[key][-1]]['end']  # get last  timestep of last file
                     newkey = key + '_' + start + '-' + end
                     tmp_dic[newkey] = nc_datasets[key]
                 except Exception:
@@ -436,17 +588,15 @@ def get_frequency(resource):
 
     :return str: frequency
     """
-    ds = Dataset(resource)
-
     try:
-        frequency = ds.frequency
+        frequency = inspect(resource)['frequency']
+        if frequency is None:
+            raise KeyError('frequency')
         LOGGER.info('frequency written in the meta data:  %s', frequency)
     except Exception as ex:
         msg = "Could not specify frequency for %s : %s" % (resource, ex)
         LOGGER.exception(msg)
         raise Exception(msg)
-    else:
-        ds.close()
     return frequency
 
 
@@ -466,130 +616,167 @@ def get_timerange(resource):
     LOGGER.debug('length of recources: %s files' % len(resource))
 
     try:
-        resource.sort()
-        if len(resource) > 1:
-            #ds = MFDataset(resource)
-            LOGGER.exception('functon expect single file, Mulitple files found' % len(resource))
-        else:
-            ds = Dataset(resource[0])
-            LOGGER.debug('Dataset loaded for %s file in resource:' % len(resource))
-        time = ds.variables['time']
-
-        if (hasattr(time, 'units') and hasattr(time, 'calendar')) is True:
-            s = num2date(time[0], time.units, time.calendar)
-            e = num2date(time[-1], time.units, time.calendar)
-        elif hasattr(time, 'units'):
-            s = num2date(time[0], time.units)
-            e = num2date(time[-1], time.units)
-        else:
-            s = num2date(time[0])
-            e = num2date(time[-1])
-
         # TODO: include frequency
-        start = '%s%s%s' % (s.year, str(s.month).zfill(2), str(s.day).zfill(2))
-        end = '%s%s%s' % (e.year, str(e.month).zfill(2), str(e.day).zfill(2))
-        ds.close()
+        records = [inspect(nc) for nc in resource]
+        start = min(r['start'] for r in records)
+        end = max(r['end'] for r in records)
     except Exception:
         msg = 'failed to get time range'
         LOGGER.exception(msg)
-        ds.close()
         raise Exception(msg)
     return start, end
 
 
-def get_time(resource):
+# time units which can be decoded without calendar arithmetic, in microseconds
+_TIME_UNITS_ = {'days': 86400000000, 'day': 86400000000, 'd': 86400000000,
+                'hours': 3600000000, 'hour': 3600000000, 'hrs': 3600000000, 'hr': 3600000000, 'h': 3600000000,
+                'minutes': 60000000, 'minute': 60000000, 'mins': 60000000, 'min': 60000000,
+                'seconds': 1000000, 'second': 1000000, 'secs': 1000000, 'sec': 1000000, 's': 1000000}
+
+
+def decode_time(values, units=None, calendar=None):
+    """
+    converts numeric time values into timestamps.
+    For standard calendars the values are converted directly to a numpy.datetime64 array,
+    other calendars (360_day, noleap, ...) are decoded by cftime.
+
+    :param values: numeric time values
+    :param units: units of the time variable, e.g. 'days since 1949-12-01'
+    :param calendar: calendar of the time variable (default: standard)
+
+    :return numpy.array: datetime64[us] for standard calendars, otherwise cftime datetime objects
+    """
+    values = np.asarray(values, dtype='float64')
+    calendar = (calendar or 'standard').lower()
+    if units and ' since ' in units and calendar in ['standard', 'gregorian', 'proleptic_gregorian']:
+        step = _TIME_UNITS_.get(units.split(' since ')[0].strip().lower())
+        if step is not None:
+            ref = _num2date(0, units, calendar)
+            # the julian/gregorian switch of the standard calendar is not supported by numpy
+            if calendar == 'proleptic_gregorian' or \
+                    ((ref.year, ref.month, ref.day) >= (1582, 10, 15) and (values.size == 0 or values.min() >= 0)):
+                origin = np.datetime64('%04d-%02d-%02dT%02d:%02d:%02d' % (
+                    ref.year, ref.month, ref.day, ref.hour, ref.minute, ref.second), 'us')
+                origin += np.timedelta64(getattr(ref, 'microsecond', 0), 'us')
+                return origin + np.round(values * step).astype('int64').astype('timedelta64[us]')
+    return np.asarray(_num2date(values, units, calendar), dtype=object)
+
+
+def get_time(resource, as_array=False):
     """
     returns all timestamps of given netcdf file as datetime list.
 
     :param resource: NetCDF file(s)
+    :param as_array: if True, timestamps are returned as numpy array (see decode_time)
+                     instead of a list of datetime objects
 
     :return : list of timesteps
     """
-    # :param format: if a format is provided (e.g format='%Y%d%m'), values will be converted to string
-
     if type(resource) != list:
         resource = [resource]
 
     try:
-        if len(resource) > 1:
-            ds = MFDataset(resource)
-        else:
-            ds = Dataset(resource[0])
-        time = ds.variables['time']
+        timestamps = []
+        for nc in resource:
+            with Dataset(nc) as ds:
+                time = ds.variables['time']
+                timestamps.append(decode_time(time[:], getattr(time, 'units', None),
+                                              getattr(time, 'calendar', None)))
+        timestamps = np.concatenate(timestamps)
     except Exception as ex:
         msg = 'failed to get time {}'.format(ex)
         LOGGER.exception(msg)
         raise Exception(msg)
 
-    try:
-        if (hasattr(time, 'units') and hasattr(time, 'calendar')) is True:
-            timestamps = num2date(time[:], time.units, time.calendar)
-        elif hasattr(time, 'units'):
-            timestamps = num2date(time[:], time.units)
-        else:
-            timestamps = num2date(time[:])
-        ds.close()
-        try:
-            ts = [dt.strptime(str(i), '%Y-%m-%d %H:%M:%S') for i in timestamps]
-
-            # if date_format is not None:
-            #     ts = [t.strftime(format=date_format) for t in timestamps]
-            # else:
-            #    ts = [dt.strptime(str(i), '%Y-%m-%d %H:%M:%S') for i in timestamps]
-
-            # TODO give out dateformat by frequency
-            # ERROR: ValueError: unconverted data remains: 12:00:00
-            # from flyingpigeon.metadata import get_frequency
-
-            # frq = get_frequency(resource)
-            # if frq is 'day':
-            #     ts = [dt.strptime(str(i), '%Y-%m-%d') for i in timestamps]
-            # elif frq is 'mon':
-            #     ts = [dt.strptime(str(i), '%Y-%m') for i in timestamps]
-            # elif frq is 'sem':
-            #     ts = [dt.strptime(str(i), '%Y-%m') for i in timestamps]
-            # elif frq is 'yr':
-            #     ts = [dt.strptime(str(i), '%Y') for i in timestamps]
-            # else:
-            #     ts = [dt.strptime(str(i), '%Y-%m-%d %H:%M:%S') for i in timestamps]
-        except Exception as e:
-            msg = 'failed to convert times to string: {}'.format(e)
-            LOGGER.exception(msg)
-    except Exception as e:
-        msg = 'failed to convert time: {}'.format(e)
-        LOGGER.exception(msg)
-    return ts
+    if as_array is True:
+        return timestamps
+    # datetime64 values are converted to datetime.datetime, cftime objects are kept
+    return timestamps.tolist()
 
 
-def get_values(resource, variable=None, time_range=None):
+def time_slice(time, time_range):
     """
-    returns the values for a list of files of files belonging to one dataset
+    returns the index range of a time period on a sorted time variable.
+    The bounds are converted to the numeric time axis and located by binary search,
+    so only the time coordinate needs to be read.
 
-    :param resource: netCDF file
+    :param time: netCDF time variable
+    :param time_range: [start, end] datetime objects, None for an open bound
+
+    :return slice: indices of the timesteps start <= t <= end
+    """
+    values = np.asarray(time[:], dtype='float64')
+    units = getattr(time, 'units', None)
+    calendar = getattr(time, 'calendar', 'standard')
+
+    start, end = time_range
+    i0 = 0 if start is None else int(np.searchsorted(values, date2num(start, units, calendar), side='left'))
+    i1 = len(values) if end is None else int(np.searchsorted(values, date2num(end, units, calendar), side='right'))
+    return slice(i0, max(i0, i1))
+
+
+def coordinate_slice(coordinate, lower, upper):
+    """
+    returns the index range of the coordinate values within [lower, upper].
+
+    :param coordinate: 1D coordinate variable (ascending or descending)
+    :param lower: lower bound
+    :param upper: upper bound
+
+    :return slice: indices covering the bounds
+    """
+    values = np.asarray(coordinate[:])
+    idx = np.where((values >= lower) & (values <= upper))[0]
+    if len(idx) == 0:
+        return slice(0, 0)
+    return slice(int(idx.min()), int(idx.max()) + 1)
+
+
+def get_values(resource, variable=None, time_range=None, bbox=None):
+    """
+    returns the values for a list of files of files belonging to one dataset.
+    Only the hyperslab selected by time_range and bbox is read from disk.
+
+    :param resource: netCDF file or list of files of one dataset
     :param variable: variable to be picked from the files (if not set, variable will be detected)
     :param time_range: list[start,end] of datetime to define periode to get values
+    :param bbox: [min_x, min_y, max_x, max_y] in the coordinates of the two spatial dimensions
+                 of the variable (e.g. rlon/rlat for rotated pole grids). A ValueError is raised
+                 if these dimensions have no 1D coordinate variables (e.g. curvilinear grids).
 
     :returs numpy.array: values
     """
-    from numpy import squeeze, where, array
+    from numpy import squeeze
     if variable is None:
         variable = get_variable(resource)
+    if type(resource) != list:
+        resource = [resource]
 
-    if isinstance(resource, str):
-        ds = Dataset(resource)
-    elif len(resource) == 1:
-        ds = Dataset(resource)
+    vals = []
+    for nc in resource:
+        with Dataset(nc) as ds:
+            var = ds.variables[variable]
+            dims = var.dimensions
+            index = [slice(None)] * len(dims)
+
+            if time_range is not None and 'time' in dims:
+                index[dims.index('time')] = time_slice(ds.variables['time'], time_range)
+            if bbox is not None:
+                missing = [d for d in dims[-2:] if d not in ds.variables or ds.variables[d].ndim != 1]
+                if len(dims) < 2 or missing:
+                    raise ValueError('bbox can not be applied to {} in {}: no 1D coordinate variable of {}'.format(
+                        variable, nc, missing or dims))
+                index[-1] = coordinate_slice(ds.variables[dims[-1]], bbox[0], bbox[2])
+                index[-2] = coordinate_slice(ds.variables[dims[-2]], bbox[1], bbox[3])
+
+            vals.append(var[tuple(index)])
+            axis = dims.index('time') if 'time' in dims else 0
+
+    if len(vals) > 1:
+        vals = np.ma.concatenate(vals, axis=axis)
     else:
-        LOGGER.exception('resource is a list containing {} files. Should be only one'.format(len(resource)))
-    vals = squeeze(ds.variables[variable][:])
-
-    if time_range != None:
-        ts = array(get_time(resource))
-        id_start = where(ts >= time_range[0])[0][0]
-        id_end = where(ts <= time_range[1])[0][-1]
-        vals = vals[id_start:id_end+1,:,:]
-
-    return vals
+        vals = vals[0]
+    return squeeze(vals)
 
 
 # def rename_variable(resource, oldname=None, newname='newname'):
@@ -712,42 +899,19 @@ def drs_filename(resource, skip_timestamp=False, skip_format=False,
     :returns str: DRS filename
     """
     try:
-        ds = Dataset(resource)
-        if variable is None:
-            variable = get_variable(resource)
-        # CORDEX example: EUR-11_ICHEC-EC-EARTH_historical_r3i1p1_DMI-HIRHAM5_v1_day
-        cordex_pattern = "{variable}_{domain}_{driving_model}_{experiment}_{ensemble}_{model}_{version}_{frequency}"
-        # CMIP5 example: tas_MPI-ESM-LR_historical_r1i1p1
-        cmip5_pattern = "{variable}_{model}_{experiment}_{ensemble}"
-        filename = resource
-        if ds.project_id == 'CORDEX' or ds.project_id == 'EOBS':
-            filename = cordex_pattern.format(
-                variable=variable,
-                domain=ds.CORDEX_domain,
-                driving_model=ds.driving_model_id,
-                experiment=ds.experiment_id,
-                ensemble=ds.driving_model_ensemble_member,
-                model=ds.model_id,
-                version=ds.rcm_version_id,
-                frequency=ds.frequency)
-        elif ds.project_id == 'CMIP5':
-            # TODO: attributes missing in netcdf file for name generation?
-            filename = cmip5_pattern.format(
-                variable=variable,
-                model=ds.model_id,
-                experiment=ds.experiment,
-                ensemble=ds.parent_experiment_rip
-            )
-        else:
-            raise Exception('unknown project %s' % ds.project_id)
-        ds.close()
+        record = inspect(resource)
+        name = _drs_name(record, variable=variable)
+        if name is None:
+            raise Exception('unknown project %s' % record['project'])
+        filename = name
     except Exception:
         LOGGER.exception('Could not read metadata %s', resource)
+        return resource
     try:
-        # add from/to timestamp if not skipped
-        if skip_timestamp is False:
+        # add from/to timestamp if not skipped (and the file has a time axis)
+        if skip_timestamp is False and record['start'] is not None:
             LOGGER.debug("add timestamp")
-            from_timestamp, to_timestamp = get_timerange(resource)
+            from_timestamp, to_timestamp = record['start'], record['end']
             LOGGER.debug("from_timestamp %s", from_timestamp)
             filename = "%s_%s-%s" % (filename, int(from_timestamp), int(to_timestamp))
 
@@ -786,3 +950,82 @@ def sort_by_time(resource):
     else:
         sorted_list = resource
     return sorted_list
+
+
+# types of the classic netCDF data model and the casts of other integer types
+_CLASSIC_DTYPES_ = ('i1', 'i2', 'i4', 'f4', 'f8', 'S1')
+_CLASSIC_CASTS_ = {'u1': 'i2', 'u2': 'i4', 'u4': 'f8', 'i8': 'f8', 'u8': 'f8'}
+
+
+def _classic_compatible(ds):
+    """Check if a netCDF4.Dataset only uses features of the classic data model."""
+    if ds.groups or sum(dim.isunlimited() for dim in ds.dimensions.values()) > 1:
+        return False
+    return all(var.dtype != str and var.dtype.str[1:] in _CLASSIC_DTYPES_ for var in ds.variables.values())
+
+
+def _rewrite(resource, data_model, attributes, memory_limit=256):
+    """
+    Rewrite a netCDF file with another data model (e.g. NETCDF4_CLASSIC), casting
+    types which do not exist in that model. The data is copied in blocks along the
+    first dimension and the file is replaced when complete.
+    """
+    tmp = resource + '.tmp'
+    with Dataset(resource) as src, Dataset(tmp, 'w', format=data_model) as dst:
+        dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in src.variables.items():
+            if var.dtype == str:
+                LOGGER.warning('variable length string %s can not be converted to %s', name, data_model)
+                continue
+            var.set_auto_maskandscale(False)
+            dtype = _CLASSIC_CASTS_.get(var.dtype.str[1:], var.dtype) if 'CLASSIC' in data_model else var.dtype
+            fill_value = getattr(var, '_FillValue', None)
+            out = dst.createVariable(name, dtype, var.dimensions,
+                                     fill_value=None if fill_value is None else np.asarray(fill_value, dtype))
+            out.set_auto_maskandscale(False)
+            out.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != '_FillValue'})
+            out.setncatts(attributes.get(name, {}))
+            if var.ndim == 0:
+                out.assignValue(var.getValue())
+                continue
+            step_mb = np.dtype(dtype).itemsize * np.prod(var.shape[1:]) / 1024 ** 2
+            block = max(1, int(memory_limit / step_mb)) if step_mb else max(var.shape[0], 1)
+            for i in range(0, var.shape[0], block):
+                end = min(i + block, var.shape[0])
+                out[i:end] = var[i:end]
+    os.replace(tmp, resource)
+
+
+def normalize_time(resource, calendar='standard', data_model=None):
+    """
+    Adds missing attributes of the time variable (calendar) to a netCDF file.
+
+    The attributes are written in place, only the header of the file is changed.
+    The file is rewritten only if `data_model` is given and the file uses features
+    which do not exist in that data model (e.g. groups or unsigned types for NETCDF4_CLASSIC).
+
+    :param resource: netCDF file
+    :param calendar: calendar of time variables without calendar attribute
+    :param data_model: data model the file has to conform to, e.g. 'NETCDF4_CLASSIC' (default: any)
+
+    :return bool: True if the file was changed
+    """
+    with Dataset(resource) as ds:
+        attributes = {}
+        if 'time' in ds.variables and not hasattr(ds.variables['time'], 'calendar'):
+            attributes['time'] = {'calendar': calendar}
+        rewrite = data_model is not None and data_model != ds.data_model
+        if rewrite and 'CLASSIC' in data_model:
+            rewrite = not _classic_compatible(ds)
+
+    if rewrite:
+        LOGGER.info('rewriting %s as %s', path.basename(resource), data_model)
+        _rewrite(resource, data_model, attributes)
+    elif attributes:
+        LOGGER.info('adding %s to %s', attributes, path.basename(resource))
+        with Dataset(resource, 'a') as ds:
+            for name, attrs in attributes.items():
+                ds.variables[name].setncatts(attrs)
+    return rewrite or bool(attributes)
@@ -1,10 +1,12 @@
 from os.path import join, abspath, dirname, getsize, curdir, isfile
 import eggshell.config
 import logging
-from ocgis import RequestDataset
+from eggshell.dependencies import lazy_import
 
 LOGGER = logging.getLogger("PYWPS")
 
+RequestDataset = lazy_import('ocgis', 'RequestDataset')
+
 # This should replace calc_grouping, as it provides direct access to keys and makes inspection easier.
 temp_groups = {'AMJJAS': [[4, 5, 6, 7, 8, 9], 'unique'],
                'Apr': [[4], 'unique'],
@@ -31,6 +33,88 @@ temp_groups = {'AMJJAS': [[4, 5, 6, 7, 8, 9], 'unique'],
 # # TODO: include regridding with ocgis
 
 
+def _read_int(filename):
+    try:
+        with open(filename) as fp:
+            return int(fp.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_memory():
+    """
+    returns the memory available to this process in MB.
+    The available memory of the system (/proc/meminfo) is limited by the
+    memory limit of the cgroup (v1 or v2) the process is running in.
+
+    :return float: available memory in MB, None if it can not be detected
+    """
+    available = []
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])  # kB
+        if 'MemAvailable' in meminfo:
+            available.append(meminfo['MemAvailable'] / 1024.)
+        else:
+            available.append((meminfo['MemFree'] + meminfo.get('Cached', 0)) / 1024.)
+    except (IOError, OSError, ValueError, KeyError):
+        LOGGER.debug('could not read /proc/meminfo')
+
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read_int(limit_file)  # 'max' (no limit) is not an integer
+        usage = _read_int(usage_file)
+        # cgroup v1 reports a huge number if no limit is set
+        if limit is not None and usage is not None and limit < 2 ** 60:
+            available.append((limit - usage) / 1024. / 1024.)
+            break
+
+    if not available:
+        return None
+    return max(0., min(available))
+
+
+def tile_dimension(data_mb, mem_limit, grid_shape):
+    """
+    returns the edge length of square spatial tiles for ocgis.util.large_array.compute
+    so that one tile (with all timesteps) fits into the memory limit.
+
+    :param data_mb: size of the requested data in MB
+    :param mem_limit: memory limit in MB
+    :param grid_shape: shape of the spatial grid (y, x)
+
+    :return int: tile dimension
+    """
+    from math import sqrt
+    ncells = float(grid_shape[-1] * grid_shape[-2])
+    tile = int(sqrt(mem_limit / data_mb * ncells))
+    return max(1, min(tile, max(grid_shape[-2:])))
+
+
+def request_tile_dimension(size, mem_limit, variable=None):
+    """
+    returns the tile dimension (see tile_dimension) of a request. The data size and the
+    shape of the grid (and the number of timesteps) are both taken from the request size,
+    i.e. after the geom and time subset.
+
+    :param size: request size as returned by OcgOperations.get_base_request_size()
+    :param mem_limit: memory limit in MB
+    :param variable: variable of the request (default: the largest variable)
+
+    :return int: tile dimension
+    """
+    variables = size['variables']
+    if variable is None or variable not in variables:
+        variable = max(variables, key=lambda v: variables[v]['value'].get('kb', 0))
+    shape = variables[variable]['value']['shape']
+    LOGGER.debug('request shape of %s: %s', variable, shape)
+    return tile_dimension(size['total'] / 1024., mem_limit, shape)
+
+
 def call(resource=[], variable=None, dimension_map=None, agg_selection=True,
          calc=None, calc_grouping=None, conform_units_to=None, crs=None,
          memory_limit=None, prefix=None,
@@ -51,8 +135,8 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True,
     :param cdover: OUTDATED use py-cdo ('python', by default) or cdo from the system ('system')
     :param conform_units_to:
     :param crs: coordinate reference system
-    :param memory_limit: limit the amount of data to be loaded into the memory at once \
-        if None (default) free memory is detected by birdhouse
+    :param memory_limit: limit the amount of data in MB to be loaded into the memory at once. \
+        If None (default) half of the available memory is used. Larger requests are computed in spatial tiles.
     :param level_range: subset of given levels
     :param prefix: string for the file base name
     :param regrid_destination: file path with netCDF file with grid for output file
@@ -167,100 +251,46 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True,
         LOGGER.exception('failed to setup OcgOperations: {}'.format(ex))
         return None
 
-    # TODO include comaprison dataload to available memory
-    dataload = 1
-    available_memory = 2
+    try:
+        if memory_limit is None:
+            # set limit to half of the free memory
+            free_memory = available_memory()
+            mem_limit = free_memory / 2. if free_memory else None
+        else:
+            mem_limit = memory_limit
+        LOGGER.info('memory_limit = %s Mb' % (mem_limit))
+
+        size = ops.get_base_request_size()
+        data_mb = size['total'] / 1024.
+        LOGGER.info('data_mb  = %s Mb' % (data_mb))
+    except Exception as ex:
+        LOGGER.exception('failed to compare dataload with free memory, calling as execute instead: {}'.format(ex))
+        mem_limit = data_mb = None
 
     try:
-        if dataload < available_memory:  # compare dataload to free_memory
+        if mem_limit is None or data_mb <= mem_limit:  # input is smaller than the memory limit
             LOGGER.info('ocgis module call as ops.execute()')
             geom_file = ops.execute()
         else:
-            # LOGGER.info('ocgis module call as compute(ops)')
-            # TODO: estimate right tile_dimensionS
-            tile_dimension = 10  # default
-            LOGGER.info('Not enough memory for data load, ocgis module call compute in chunks')
-            geom_file = compute(ops, tile_dimension=tile_dimension, verbose=True)
+            from eggshell.nc.nc_utils import get_variable
+            try:
+                tile_dim = request_tile_dimension(size, mem_limit, variable)
+            except Exception:
+                LOGGER.exception('failed to estimate tile_dimension, using default')
+                tile_dim = 10
+            LOGGER.info('Not enough memory for data load, ocgis module call compute in chunks of %s' % tile_dim)
+            if calc is None:
+                # compute needs a calculation
+                var = variable or get_variable(resource)
+                ops.calc = '%s=%s*1' % (var, var)
+                LOGGER.info('calc set to = %s ' % ops.calc)
+            geom_file = compute(ops, tile_dimension=tile_dim, verbose=True)
 
     except Exception as ex:
         LOGGER.exception('failed to execute ocgis operation : {}'.format(ex))
         return None
     return geom_file
 
-    # try:
-    #     from numpy import sqrt
-    #     from flyingpigeon.utils import FreeMemory
-    #
-    #     if memory_limit is None:
-    #         f = FreeMemory()
-    #         mem_kb = f.user_free
-    #         mem_mb = mem_kb / 1024.
-    #         mem_limit = mem_mb / 2.  # set limit to half of the free memory
-    #     else:
-    #         mem_limit = memory_limit
-    #
-    #     if mem_limit >= 1024. * 4:
-    #         mem_limit = 1024. * 4
-    #         # 475.0 MB for openDAP
-    #
-    #     LOGGER.info('memory_limit = %s Mb' % (mem_limit))
-    #
-    #     data_kb = ops.get_base_request_size()['total']
-    #     data_mb = data_kb / 1024.
-    #
-    #     # data_kb = size['total']/reduce(lambda x,y: x*y,size['variables'][variable]['value']['shape'])
-    #     LOGGER.info('data_mb  = %s Mb' % (data_mb))
-    #
-    #     if data_mb <= mem_limit:  # input is smaler than the half of free memory size
-    #         try:
-    #             LOGGER.info('ocgis module call as ops.execute()')
-    #             geom_file = ops.execute()
-    #         except Exception as e:
-    #             LOGGER.debug('failed to execute ocgis operation')
-    #             raise
-    #             return None
-    #
-    #     else:
-    #         ##########################
-    #         # calcultion of chunk size
-    #         ##########################
-    #         try:
-    #             size = ops.get_base_request_size()
-    #             nb_time_coordinates_rd = size['variables'][variable]['temporal']['shape'][0]
-    #             element_in_kb = size['total']/reduce(lambda x, y: x*y, size['variables'][variable]['value']['shape'])
-    #             element_in_mb = element_in_kb / 1024.
-    #             tile_dim = sqrt(mem_limit/(element_in_mb*nb_time_coordinates_rd))  # maximum chunk size
-    #
-    #             LOGGER.info('ocgis module call compute with chunks')
-    #             if calc is None:
-    #                 calc = '%s=%s*1' % (variable, variable)
-    #                 LOGGER.info('calc set to = %s ' % calc)
-    #             ops = OcgOperations(dataset=rd,
-    #                                 output_format_options=output_format_options,
-    #                                 dir_output=dir_output,
-    #                                 spatial_wrapping=spatial_wrapping,
-    #                                 spatial_reorder=spatial_reorder,
-    #                                 # regrid_destination=rd_regrid,
-    #                                 # options=options,
-    #                                 calc=calc,
-    #                                 calc_grouping=calc_grouping,
-    #                                 geom=geom,
-    #                                 output_format=output_format,
-    #                                 prefix=prefix,
-    #                                 search_radius_mult=search_radius_mult,
-    #                                 select_nearest=select_nearest,
-    #                                 select_ugid=select_ugid,
-    #                                 add_auxiliary_files=False)
-    #             geom_file = compute(ops, tile_dimension=int(tile_dim), verbose=True)
-    #             print 'ocgis calculated'
-    #         except Exception as e:
-    #             LOGGER.debug('failed to compute ocgis with chunks')
-    #             raise
-    #             return None
-    #     LOGGER.info('Succeeded with ocgis module call function')
-    # except:
-    #     LOGGER.exception('failed to compare dataload with free memory, calling as execute instead')
-
     # ############################################
     # # remapping according to regrid informations
     # ############################################
@@ -0,0 +1,208 @@
+"""
+Batch rendering of maps.
+
+Products pages need hundreds of time mean maps (every index x season x scenario).
+:func:`plot_maps` renders a list of plot specs, each one a dict of the arguments
+of :func:`eggshell.plot.plt_ncdata.plot_map_timemean`::
+
+    specs = [{'resource': ['tg_mean_rcp45_2071-2100.nc'], 'title': 'RCP4.5', 'delta': -273.15},
+             {'resource': ['tg_mean_rcp85_2071-2100.nc'], 'title': 'RCP8.5', 'delta': -273.15}]
+    graphics = plot_maps(specs, workers=4, dir_output='.')
+
+The specs are rendered in worker processes with the Agg backend. Every worker keeps
+one figure per grid: the map (template, color mesh, colorbar and gridlines) is built
+for the first spec of a grid, the following ones only update the data of the mesh
+with `set_array`, the color limits and the title before the figure is saved.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from eggshell.dependencies import lazy_import
+from eggshell.plot.plt_utils import fig2plot, get_map_template
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+Dataset = lazy_import('netCDF4', 'Dataset')
+
+# number of time steps read at once to compute the time mean
+_TIME_BLOCK_ = 100
+
+_renderer = None  # MapRenderer of a worker process
+
+
+def _default_cmap(variable):
+    """Return the colormap of a variable as in plot_map_timemean, None for the matplotlib default."""
+    if variable in ['pr', 'prAdjust', 'prcptot', 'rx1day', 'wetdays', 'cdd', 'cwd', 'sdii',
+                    'max_5_day_precipitation_amount']:
+        return 'Blues'
+    if variable in ['tas', 'tasAdjust', 'tg', 'tg_mean']:
+        return 'seismic'
+    return None
+
+
+def time_mean(resource, variable=None, time_range=None):
+    """
+    Compute the mean over the time steps of one or several files, reading blocks of time steps.
+
+    :param resource: netCDF file or list of files of one dataset
+    :param variable: variable to be averaged (if not set, variable will be detected)
+    :param time_range: list[start, end] of datetime to define the periode
+
+    :return tuple: variable, longitudes, latitudes (1D, the last two dimensions of the variable), 2D mean
+    """
+    from eggshell.nc.nc_utils import get_variable, time_slice
+
+    if isinstance(resource, str):
+        resource = [resource]
+    if variable is None:
+        variable = get_variable(resource[0])
+
+    total, count, lon, lat = None, None, None, None
+    for f in resource:
+        with Dataset(f) as ds:
+            var = ds.variables[variable]
+            if lon is None:
+                lon = np.asarray(ds.variables[var.dimensions[-1]][:])
+                lat = np.asarray(ds.variables[var.dimensions[-2]][:])
+                total = np.zeros(var.shape[-2:])
+                count = np.zeros(var.shape[-2:], dtype='int64')
+            if time_range is not None and 'time' in var.dimensions:
+                index = time_slice(ds.variables['time'], time_range)
+            else:
+                index = slice(0, var.shape[0] if var.ndim > 2 else 1)
+            for i in range(index.start, index.stop, _TIME_BLOCK_):
+                block = var[i:min(i + _TIME_BLOCK_, index.stop)] if var.ndim > 2 else var[:][np.newaxis]
+                block = np.ma.filled(np.ma.asarray(block, dtype='float64'), np.nan)
+                block = block.reshape((-1,) + block.shape[-2:])
+                valid = np.isfinite(block)
+                total += np.where(valid, block, 0).sum(axis=0)
+                count += valid.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+    return variable, lon, lat, mean
+
+
+class MapRenderer(object):
+    """
+    Render time mean maps, reusing one figure per grid.
+
+    :param figsize: figure size
+    :param file_extension: file format of the graphics
+    :param dir_output: output directory of the graphics
+    :param features: cartopy features of the maps (see plt_utils.MapTemplate)
+    :param profile: output profile of the graphics (see plt_utils.fig2plot)
+    """
+
+    def __init__(self, figsize=(15, 15), file_extension='png', dir_output='.', features=('borders',), profile=None):
+        self.figsize = figsize
+        self.features = tuple(features)
+        self.profile = profile
+        self.file_extension = file_extension
+        self.dir_output = dir_output
+        self._canvases = {}  # grid -> (figure, mesh, title)
+
+    def _canvas(self, lon, lat, values):
+        """Return the figure, color mesh and title of a grid, building them for the first map."""
+        import cartopy.crs as ccrs
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        key = (len(lon), len(lat), float(lon[0]), float(lon[-1]), float(lat[0]), float(lat[-1]))
+        if key in self._canvases:
+            return self._canvases[key]
+
+        fig = Figure(figsize=self.figsize, facecolor='w', edgecolor='k')
+        FigureCanvasAgg(fig)
+        template = get_map_template(extent=[lon.min(), lon.max(), lat.min(), lat.max()], features=self.features)
+        ax = template.axes(fig, styles={'borders': dict(linewidth=2, linestyle='--')})
+        mesh = ax.pcolormesh(lon, lat, values, transform=ccrs.PlateCarree())
+
+        gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                          linewidth=2, color='gray', alpha=0.5, linestyle='--')
+        gl.top_labels = False
+        gl.right_labels = False
+        gl.xlabel_style = {'size': 15, 'color': 'black', 'weight': 'bold'}
+        gl.ylabel_style = {'size': 15, 'color': 'black', 'weight': 'bold'}
+
+        cax = fig.add_axes([ax.get_position().x1 + 0.1, ax.get_position().y0, 0.02, ax.get_position().height])
+        cbar = fig.colorbar(mesh, cax=cax)
+        cbar.ax.tick_params(labelsize=20)
+        title = ax.set_title('', fontsize=25)
+
+        self._canvases[key] = (fig, mesh, title)
+        return self._canvases[key]
+
+    def render(self, spec):
+        """
+        Render one map.
+
+        :param spec: dict with the resource and the optional variable, time_range, title,
+                     delta, cmap, vmin and vmax of the map (see plot_map_timemean)
+
+        :return str: path to the graphic
+        """
+        variable, lon, lat, mean = time_mean(spec['resource'], variable=spec.get('variable'),
+                                             time_range=spec.get('time_range'))
+        values = np.ma.masked_invalid(mean + spec.get('delta', 0))
+
+        fig, mesh, title = self._canvas(lon, lat, values)
+        mesh.set_array(values)
+        mesh.set_cmap(spec.get('cmap') or _default_cmap(variable))
+        vmin, vmax = spec.get('vmin'), spec.get('vmax')
+        mesh.set_clim(values.min() if vmin is None else vmin, values.max() if vmax is None else vmax)
+        title.set_text(spec.get('title') or '')
+
+        graphic = fig2plot(fig=fig, file_extension=self.file_extension, dir_output=self.dir_output,
+                           profile=self.profile)
+        LOGGER.debug('map of %s rendered to %s', variable, graphic)
+        return graphic
+
+
+def _init_worker(options):
+    """Force the Agg backend and create the renderer of a worker process."""
+    global _renderer
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    _renderer = MapRenderer(**options)
+
+
+def _render(specs):
+    return [_renderer.render(spec) for spec in specs]
+
+
+def plot_maps(specs, workers=None, figsize=(15, 15), file_extension='png', dir_output='.', features=('borders',),
+              profile=None, chunksize=None):
+    """
+    Render a batch of time mean maps (see plot_map_timemean) in a pool of processes.
+
+    :param specs: list of dicts with the resource and the optional variable, time_range,
+                  title, delta, cmap, vmin and vmax of each map
+    :param workers: number of processes (default: number of CPUs), 1 renders in this process
+    :param figsize: figure size of the maps
+    :param file_extension: file format of the graphics
+    :param dir_output: output directory of the graphics
+    :param features: cartopy features of the maps (see plt_utils.MapTemplate)
+    :param profile: output profile of the graphics, e.g. 'web' (see plt_utils.fig2plot)
+    :param chunksize: number of specs sent to a worker at once (default: a fourth of the share of a worker)
+
+    :returns list: paths to the graphics, in the order of the specs
+    """
+    specs = list(specs)
+    workers = min(workers or os.cpu_count() or 1, max(len(specs), 1))
+    options = dict(figsize=figsize, file_extension=file_extension, dir_output=os.path.abspath(dir_output),
+                   features=features, profile=profile)
+
+    if workers == 1:
+        renderer = MapRenderer(**options)
+        return [renderer.render(spec) for spec in specs]
+
+    chunksize = chunksize or max(1, len(specs) // (workers * 4))
+    chunks = [specs[i:i + chunksize] for i in range(0, len(specs), chunksize)]
+    LOGGER.info('rendering %s maps in %s processes', len(specs), workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as pool:
+        return [graphic for graphics in pool.map(_render, chunks) for graphic in graphics]
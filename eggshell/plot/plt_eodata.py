@@ -3,18 +3,19 @@
 # from snappy import ProgressMonitor
 # from snappy import jpy
 
-from matplotlib import pyplot as plt
-
 from os.path import splitext, basename
 from os.path import join
 from tempfile import mkstemp
 import numpy as np
 
 from eggshell.plot import plt_utils
+from eggshell.dependencies import lazy_import
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+plt = lazy_import('matplotlib.pyplot')
+
 
 def plot_products(products, extend=[10, 20, 5, 15], dir_output='.'):
     """
@@ -7,37 +7,154 @@ from tempfile import mkstemp
 # use('Agg')   # use this if no xserver is available
 import numpy as np
 
-from matplotlib import pyplot as plt
-from matplotlib import colors
-from matplotlib.patches import Polygon
-import matplotlib.patches as mpatches
-import cartopy.feature as cfeature
-
-import cartopy.crs as ccrs
-from cartopy.util import add_cyclic_point
-
 from eggshell.nc.calculation import fieldmean
 from eggshell.nc.nc_utils import get_variable, get_frequency, get_coordinates
-from eggshell.nc.nc_utils import get_time, sort_by_filename, get_values
-from eggshell.plot.plt_utils import fig2plot
+from eggshell.nc.nc_utils import get_time, sort_by_filename, get_values, decode_time
+from eggshell.plot.plt_utils import fig2plot, get_map_template
+from eggshell.dependencies import lazy_import
 
 from numpy import meshgrid
-from netCDF4 import Dataset
 import numpy as np
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
-class MidpointNormalize(colors.Normalize):
-    def __init__(self, vmin=None, vmax=None, vcenter=None, clip=False):
-        self.vcenter = vcenter
-        colors.Normalize.__init__(self, vmin, vmax, clip)
+# matplotlib, cartopy and netCDF4 are imported on first use
+plt = lazy_import('matplotlib.pyplot')
+colors = lazy_import('matplotlib.colors')
+mpatches = lazy_import('matplotlib.patches')
+Polygon = lazy_import('matplotlib.patches', 'Polygon')
+cfeature = lazy_import('cartopy.feature')
+ccrs = lazy_import('cartopy.crs')
+add_cyclic_point = lazy_import('cartopy.util', 'add_cyclic_point')
+Dataset = lazy_import('netCDF4', 'Dataset')
+
+_midpoint_normalize = None
+
+
+def _midpoint_normalize_class():
+    """Define MidpointNormalize on first use, the base class requires matplotlib to be imported."""
+    global _midpoint_normalize
+    if _midpoint_normalize is None:
+        class MidpointNormalize(colors.Normalize):
+            def __init__(self, vmin=None, vmax=None, vcenter=None, clip=False):
+                self.vcenter = vcenter
+                colors.Normalize.__init__(self, vmin, vmax, clip)
+
+            def __call__(self, value, clip=None):
+                # I'm ignoring masked values and all kinds of edge cases to make a
+                # simple example...
+                x, y = [self.vmin, self.vcenter, self.vmax], [0, 0.5, 1]
+                return np.ma.masked_array(np.interp(value, x, y))
+
+        MidpointNormalize.__module__ = __name__
+        _midpoint_normalize = MidpointNormalize
+    return _midpoint_normalize
+
+
+def __getattr__(name):
+    if name == 'MidpointNormalize':
+        return _midpoint_normalize_class()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def _extent(lons, lats):
+    """Return the extent [lon_min, lon_max, lat_min, lat_max] of the coordinates of a map."""
+    return [np.nanmin(lons), np.nanmax(lons), np.nanmin(lats), np.nanmax(lats)]
+
+
+def _as_datetime64(times):
+    """Convert decoded timestamps to datetime64, dates missing in the standard calendar (e.g. 30 Feb) are NaT."""
+    import pandas as pd
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        return times.astype('datetime64[ns]')
+    return pd.to_datetime([t.strftime('%Y-%m-%d %H:%M:%S') for t in times], errors='coerce').values
+
+
+def _fieldmean_cache_dir():
+    """Return the directory of the field mean cache in the server cache directory."""
+    import os
+    import eggshell
+    from eggshell.config import Paths
+    return os.path.join(Paths(eggshell).cache, 'fieldmean')
+
+
+def _fieldmean_key(nc, variable, weighted):
+    """Return the cache key of a field mean: file identity (path, inode, size, mtime), variable and weighting."""
+    import hashlib
+    import json
+    import os
+    st = os.stat(nc)
+    identity = [os.path.abspath(nc), st.st_ino, st.st_size, st.st_mtime_ns, variable,
+                'sqrt_coslat' if weighted else 'none']
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
 
-    def __call__(self, value, clip=None):
-        # I'm ignoring masked values and all kinds of edge cases to make a
-        # simple example...
-        x, y = [self.vmin, self.vcenter, self.vmax], [0, 0.5, 1]
-        return np.ma.masked_array(np.interp(value, x, y))
+
+def _fieldmean_series(nc, variable, weighted=False, memory_limit=256, cache=True):
+    """
+    Return the field mean of a variable as a float64 pandas Series with a datetime64 index.
+
+    The file is opened once and read in blocks of timesteps of at most memory_limit MB.
+    The series are cached as .npy files in the server cache directory, keyed by file
+    identity, variable and weighting, so re-plotting an ensemble reads no input data.
+
+    :param nc: netCDF file
+    :param variable: variable to be averaged
+    :param weighted: if True, latitudes are weighted with sqrt(cos(lat)) as in calculation.fieldmean
+    :param memory_limit: maximum size of the data block read at once in MB
+    :param cache: if False, the cache is neither read nor written
+    """
+    import os
+    import pandas as pd
+    import warnings
+
+    filename = None
+    if cache:
+        filename = os.path.join(_fieldmean_cache_dir(), _fieldmean_key(nc, variable, weighted) + '.npy')
+        try:
+            record = np.load(filename)
+            return pd.Series(record['value'], index=pd.DatetimeIndex(record['time']), name=nc)
+        except (IOError, ValueError):
+            pass
+
+    with Dataset(nc) as ds:
+        time = ds.variables['time']
+        index = _as_datetime64(decode_time(time[:], getattr(time, 'units', None), getattr(time, 'calendar', None)))
+        var = ds.variables[variable]
+        nt, ny, nx = len(time), var.shape[-2], var.shape[-1]
+        weights = None
+        if weighted:
+            lats = np.asarray(ds.variables[var.dimensions[-2]][:], dtype='float64')
+            weights = np.sqrt(np.cos(np.radians(lats)))[:, np.newaxis]  # along the latitude axis
+        step = max(1, int(memory_limit * 1024 ** 2 / (8. * ny * nx * max(1, var.size // max(nt, 1) // (ny * nx)))))
+        values = np.empty(nt, dtype='float64')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN slices give NaN
+            for i in range(0, nt, step):
+                block = np.ma.filled(np.ma.asarray(var[i:i + step], dtype='float64'), np.nan)
+                block = block.reshape(block.shape[0], -1, ny, nx)
+                # mean over the latitudes, then over the longitudes
+                if weights is None:
+                    profile = np.nanmean(block, axis=-2)
+                else:
+                    valid = np.isfinite(block)
+                    profile = (np.where(valid, block, 0) * weights).sum(axis=-2) / (valid * weights).sum(axis=-2)
+                values[i:i + step] = np.nanmean(profile, axis=-1).mean(axis=1)
+
+    keep = ~np.isnat(index)
+    record = np.empty(int(keep.sum()), dtype=[('time', 'M8[ns]'), ('value', 'f8')])
+    record['time'], record['value'] = index[keep], values[keep]
+    if filename is not None:
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(tmp, 'wb') as fp:
+                np.save(fp, record)
+            os.replace(tmp, filename)
+        except (IOError, OSError) as ex:
+            LOGGER.debug('field mean of %s not cached: %s', nc, ex)
+    return pd.Series(record['value'], index=pd.DatetimeIndex(record['time']), name=nc)
 
 
 def add_colorbar(im, aspect=20, pad_fraction=0.5,):
@@ -74,16 +191,17 @@ def plot_extend(resource, file_extension='png'):
                    [np.max(lons), np.max(lats)],
                    [np.min(lons), np.max(lats)]])
 
-    fig = plt.figure(figsize=(20, 10), dpi=600, facecolor='w', edgecolor='k')
+    # the resolution of the graphic is set by fig2plot
+    fig = plt.figure(figsize=(20, 10), facecolor='w', edgecolor='k')
     projection = ccrs.Robinson()
 
     #  ccrs.Orthographic(central_longitude=np.mean(xy[:, 0]),
     #  central_latitude=np.mean(xy[:, 1]),
     #  globe=None)  # Robinson()
 
-    ax = plt.axes(projection=projection)
-    ax.stock_img()
-    ax.coastlines()
+    # stock image and coastlines are projected once and shared by all plots
+    template = get_map_template(projection=projection, features=('coastline',), background=True)
+    ax = template.axes(fig)
     ax.add_patch(mpatches.Polygon(xy, closed=True, transform=ccrs.PlateCarree(), color='coral', alpha=0.6))
     # ccrs.Geodetic()
     ax.gridlines()
@@ -109,6 +227,7 @@ def plot_ts_spaghetti(resource, variable=None, ylim=None, title=None,
     :param variable: variable to be visualised. If None (default), variable will be detected
     :param title: string to be used as title
     :param ylim: Y-axis limitations: tuple(min,max)
+    :param delta: set a delta for the values e.g. -273.15 to convert Kelvin to Celsius
     :param figsize: figure size defult=(10,10)
 
     :retruns str: path to png file
@@ -116,7 +235,8 @@ def plot_ts_spaghetti(resource, variable=None, ylim=None, title=None,
     # from eggshell.nc.calculation import fieldmean
 
     try:
-        fig = plt.figure(figsize=figsize, dpi=600, facecolor='w', edgecolor='k')
+        # the resolution of the graphic is set by fig2plot
+        fig = plt.figure(figsize=figsize, facecolor='w', edgecolor='k')
         LOGGER.debug('Start visualisation spaghetti plot')
 
         # === prepare invironment
@@ -147,16 +267,10 @@ def plot_ts_spaghetti(resource, variable=None, ylim=None, title=None,
                 else:
                     col = 'green'
 
-                dt = get_time(nc) # [datetime.strptime(elem, '%Y-%m-%d') for elem in strDate[0]]
-                # ts = fieldmean(nc)
-
-                ds = Dataset(nc)
-                var = get_variable(nc)
-                tg_val = np.squeeze(ds.variables[var][:])
-                d2 = np.nanmean(tg_val, axis=1)
-                ts = np.nanmean(d2, axis=1)
+                # field mean series, read from the field mean cache if the file is known
+                ts = _fieldmean_series(nc, variable) + delta
 
-                plt.plot(dt, ts, col )
+                plt.plot(ts.index, ts.values, col)
                 plt.grid()
                 plt.title(title)
                 #
@@ -201,6 +315,7 @@ def plot_ts_uncertainty(resource, variable=None, ylim=None, title=None,
 
     import pandas as pd
     import numpy as np
+    import warnings
     from datetime import datetime as dt
     from os.path import basename
     #
@@ -223,37 +338,16 @@ def plot_ts_uncertainty(resource, variable=None, ylim=None, title=None,
 
         dic = sort_by_filename(resource, historical_concatination=True)
 
-        # Create index out of existing timestemps
-        for i, key in enumerate(dic.keys()):
-            for nc in dic[key]:
-                ds = Dataset(nc)
-                ts = get_time(nc)
-                if i == 0:
-                    dates = pd.DatetimeIndex(ts)
-                else:
-                    dates = dates.union(ts)
-
-        # create empty DataFrame according existing timestemps
-        df = pd.DataFrame(columns=list(dic.keys()), index=dates)
-
+        # field mean series per file, concatenated per dataset and aligned on the union of the timestamps
+        series = {}
         for key in dic.keys():
             try:
-                for nc in dic[key]:
-                    ds = Dataset(nc)
-                    var = get_variable(nc)
-                    ts = get_time(nc)
-                    tg_val = np.squeeze(ds.variables[var][:])
-                    d2 = np.nanmean(tg_val, axis=1)
-                    data = np.nanmean(d2, axis=1) + delta
-                    df[key].loc[ts] = data
-                    # data = fieldmean(dic[key])  # get_values(f)
-                    # ts = get_time(dic[key])
-                    # ds = pd.Series(data=data, index=ts, name=key)
-                    # # ds_yr = ds.resample('12M', ).mean()   # yearly mean loffset='6M'
-                    # df[key] = ds
+                ts = pd.concat([_fieldmean_series(nc, variable) for nc in dic[key]])
+                series[key] = ts[~ts.index.duplicated(keep='last')] + delta
                 LOGGER.info('read in pandas series timeseries for: {}'.format(key))
             except Exception:
                 LOGGER.exception('failed to calculate timeseries for %s ' % (key))
+        df = pd.concat(series, axis=1).sort_index().astype('float64')
 
         frq = get_frequency(resource[0])
 
@@ -284,12 +378,11 @@ def plot_ts_uncertainty(resource, variable=None, ylim=None, title=None,
                      ha='right', va='bottom', alpha=0.5)
 
         try:
-            rmean = np.squeeze(df_smooth.quantile([0.5], axis=1,).values)
-            # skipna=False  quantile([0.5], axis=1, numeric_only=False )
-            q05 = np.squeeze(df_smooth.quantile([0.10], axis=1,).values)  # numeric_only=False)
-            q33 = np.squeeze(df_smooth.quantile([0.33], axis=1,).values)  # numeric_only=False)
-            q66 = np.squeeze(df_smooth.quantile([0.66], axis=1,).values)  # numeric_only=False)
-            q95 = np.squeeze(df_smooth.quantile([0.90], axis=1,).values)  # numeric_only=False)
+            # quantiles over the members on the contiguous float64 array (NaN are skipped)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN timesteps give NaN
+                q05, q33, rmean, q66, q95 = np.nanquantile(np.ascontiguousarray(df_smooth.values),
+                                                           [0.10, 0.33, 0.5, 0.66, 0.90], axis=1)
             LOGGER.info('quantile calculated for all input data')
         except Exception as e:
             LOGGER.exception('failed to calculate quantiles: {}'.format(e))
@@ -379,7 +472,8 @@ def plot_map_timemean(resource, variable=None, time_range=None,
         LOGGER.info('preparing matplotlib figure')
 
         fig = plt.figure(figsize=figsize, facecolor='w', edgecolor='k')
-        ax = plt.axes(projection=ccrs.PlateCarree())
+        template = get_map_template(extent=_extent(lons, lats), features=('borders',))
+        ax = template.axes(fig, styles={'borders': dict(linewidth=2, linestyle='--')})
 
         cs = plt.pcolormesh(lons, lats, var_mean,
                             transform=ccrs.PlateCarree(), cmap=cmap,
@@ -388,7 +482,6 @@ def plot_map_timemean(resource, variable=None, time_range=None,
         # extent=(-0,17,10.5,24)
         # ax.set_extent(extent)
 
-        ax.add_feature(cfeature.BORDERS, linewidth=2, linestyle='--')
         # ax.add_feature(cfeature.RIVERS)
         # ax.stock_img()
         # ax.gridlines(draw_labels=False)
@@ -501,7 +594,9 @@ def plot_map_ccsignal(signal, robustness=None,
 
     try:
         fig = plt.figure(figsize=(20, 10), facecolor='w', edgecolor='k')
-        ax = plt.axes(projection=ccrs.PlateCarree())
+        template = get_map_template(extent=_extent(lons, lats), features=('borders', 'coastline'))
+        ax = template.axes(fig, styles={'borders': dict(linewidth=2, linestyle='--'),
+                                        'coastline': dict(linewidth=2)})
         # ax = plt.axes(projection=ccrs.Robinson(central_longitude=int(mean(lons))))
 
         # minval = round(np.nanmin(var_signal))
@@ -521,7 +616,7 @@ def plot_map_ccsignal(signal, robustness=None,
         maxval = round(np.nanmax(val_signal)+.5)
         minval = round(np.nanmin(val_signal))
 
-        norm = MidpointNormalize( vmin=minval, vcenter=0, vmax=maxval)  # )  vcenter=0,,
+        norm = _midpoint_normalize_class()( vmin=minval, vcenter=0, vmax=maxval)  # )  vcenter=0,,
 
         cs = plt.pcolormesh(lons, lats, val_signal, transform=ccrs.PlateCarree(), cmap=cmap, norm=norm, vmin=vmin, vmax=vmax)
                 #  60,
@@ -538,8 +633,6 @@ def plot_map_ccsignal(signal, robustness=None,
 
         # ch = plt.contourf(lons, lats, mask, 1, transform=ccrs.PlateCarree(), colors='none', hatches=[None,'.' ])
 
-        ax.add_feature(cfeature.BORDERS, linewidth=2, linestyle='--')
-        ax.add_feature(cfeature.COASTLINE, linewidth=2,) #  coastlines()
         gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
                           linewidth=2, color='gray', alpha=0.5, linestyle='--')
         gl.xlabels_top = False
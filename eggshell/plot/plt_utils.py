@@ -5,20 +5,39 @@ import logging
 # use('Agg')   # use this if no xserver is available
 import numpy as np
 import os
+import threading
 
 from os.path import abspath, curdir, join
 
-from matplotlib import pyplot as plt
-from matplotlib.patches import Polygon
-import matplotlib.patches as mpatches
-from matplotlib.collections import PatchCollection
-from matplotlib.colors import Normalize
+from eggshell.dependencies import lazy_import
 
-import cartopy.crs as ccrs
+LOGGER = logging.getLogger("PYWPS")
 
+# matplotlib and cartopy are imported on first use
+plt = lazy_import('matplotlib.pyplot')
+mpatches = lazy_import('matplotlib.patches')
+Polygon = lazy_import('matplotlib.patches', 'Polygon')
+PatchCollection = lazy_import('matplotlib.collections', 'PatchCollection')
+Normalize = lazy_import('matplotlib.colors', 'Normalize')
+ccrs = lazy_import('cartopy.crs')
 
 
-LOGGER = logging.getLogger("PYWPS")
+# output profiles of fig2plot:
+# dpi, bbox_inches ('tight' renders the figure twice to find the bounding box),
+# compress_level of PNG files (0-9) and quality of JPEG/WebP files (1-95)
+PROFILES = {
+    'print': dict(dpi=300, bbox_inches='tight', compress_level=6, quality=95),
+    'web': dict(dpi=100, bbox_inches=None, compress_level=1, quality=85),
+    'preview': dict(dpi=50, bbox_inches=None, compress_level=1, quality=70),
+}
+
+# profile of fig2plot if none is given, None for the dpi and bbox_inches arguments
+DEFAULT_PROFILE = None
+
+_save_pool = None  # thread of fig2plot_async
+_save_pool_lock = threading.Lock()
+# matplotlib is not thread-safe (e.g. the fonts are shared by all renderers), figures are saved one at a time
+_savefig_lock = threading.RLock()
 
 
 def fig2plot(fig,
@@ -26,24 +45,275 @@ def fig2plot(fig,
              dir_output='.',
              bbox_inches='tight',
              dpi=300, facecolor='w',
-             edgecolor='k', figsize=(20, 10)):
+             edgecolor='k', figsize=(20, 10),
+             profile=None, filename=None, as_buffer=False):
     '''saving a matplotlib figure to a graphic
 
     :param fig: matplotlib figure object
     :param dir_output: directory of output plot
-    :param file_extension: file file_extension (default='png')
+    :param file_extension: file file_extension (default='png'), 'jpg' and 'webp' are encoded by Pillow
+    :param profile: name of an output profile (see PROFILES) or dict of dpi, bbox_inches,
+                    compress_level and quality; overrides dpi and bbox_inches (default: DEFAULT_PROFILE)
+    :param filename: path of the graphic (default: a new temporary file in dir_output)
+    :param as_buffer: if True, the graphic is returned as io.BytesIO instead of written to a file
 
-    :return str: path to graphic
+    :return str: path to graphic (io.BytesIO if as_buffer is True)
     '''
+    import io
+
+    options = dict(dpi=dpi, bbox_inches=bbox_inches)
+    profile = profile or DEFAULT_PROFILE
+    if profile is not None:
+        options.update(PROFILES[profile] if isinstance(profile, str) else profile)
+
+    file_format = file_extension.lower().lstrip('.')
+    pil_kwargs = {}
+    if file_format == 'png' and options.get('compress_level') is not None:
+        pil_kwargs['compress_level'] = options['compress_level']
+    elif file_format in ('jpg', 'jpeg', 'webp') and options.get('quality') is not None:
+        pil_kwargs['quality'] = options['quality']
+
+    if as_buffer:
+        graphic = io.BytesIO()
+    elif filename is not None:
+        graphic = filename
+    else:
+        fd, graphic = mkstemp(dir=dir_output, suffix='.%s' % file_extension)
+        os.close(fd)
 
-    _, graphic = mkstemp(dir=dir_output, suffix='.%s' % file_extension)
-
-    fig.savefig(graphic, bbox_inches=bbox_inches, dpi=dpi, facecolor=facecolor,
-                edgecolor=edgecolor, figsize=figsize)
+    # figsize is a property of the figure, savefig does not accept it
+    with _savefig_lock:
+        fig.savefig(graphic, format=file_format, bbox_inches=options['bbox_inches'], dpi=options['dpi'],
+                    facecolor=facecolor, edgecolor=edgecolor, pil_kwargs=pil_kwargs or None)
 
+    if as_buffer:
+        graphic.seek(0)
     return graphic
 
 
+def fig2plot_async(fig, close=True, **kwargs):
+    """
+    Save a matplotlib figure to a graphic in a background thread (see fig2plot).
+
+    The figure is rendered and encoded while the caller reads the data and builds the next
+    figure; it must not be changed until the graphic is saved. Matplotlib is not thread-safe,
+    so the figures are saved one after another in a single thread and fig2plot holds a module
+    lock while saving. Code drawing figures in other threads meanwhile (e.g. tight_layout or
+    canvas.draw) has to wait for the pending futures.
+
+    :param fig: matplotlib figure object
+    :param close: if True (default), the figure is closed in pyplot before it is saved
+    :param kwargs: arguments of fig2plot
+
+    :return concurrent.futures.Future: future of the path to the graphic (io.BytesIO if as_buffer is True)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    global _save_pool
+
+    if close:
+        plt.close(fig)
+    if not kwargs.get('as_buffer') and kwargs.get('filename') is None:
+        # the file name is known when the call returns
+        fd, kwargs['filename'] = mkstemp(dir=kwargs.pop('dir_output', '.'),
+                                         suffix='.%s' % kwargs.get('file_extension', 'png'))
+        os.close(fd)
+    with _save_pool_lock:
+        if _save_pool is None:
+            _save_pool = ThreadPoolExecutor(max_workers=1)
+    return _save_pool.submit(fig2plot, fig, **kwargs)
+
+
+# cartopy features by name, see MapTemplate
+_MAP_FEATURES_ = {'borders': 'BORDERS', 'coastline': 'COASTLINE', 'land': 'LAND', 'ocean': 'OCEAN',
+                  'lakes': 'LAKES', 'rivers': 'RIVERS', 'states': 'STATES'}
+
+# number of map templates kept by get_map_template
+MAP_TEMPLATES_MAX = 32
+
+_map_templates = {}
+_map_templates_lock = threading.Lock()
+
+
+class MapTemplate(object):
+    """
+    Projection, extent and features of a map.
+
+    Projecting and clipping the Natural Earth geometries of the features is the most
+    expensive part of drawing a map. A template does it once and keeps the features as
+    matplotlib paths in projection coordinates, as well as the reprojected stock image
+    if a background is requested. Maps created with :meth:`axes` then only have to
+    draw their data layer. Use :func:`get_map_template` to share templates between plots.
+    """
+
+    def __init__(self, projection=None, extent=None, features=('borders',), background=False):
+        """
+        :param projection: cartopy projection of the map (default: PlateCarree)
+        :param extent: [lon_min, lon_max, lat_min, lat_max] of the map, None for the whole globe
+        :param features: names of cartopy features ('borders', 'coastline', 'land', ...) or cartopy Feature objects
+        :param background: if True, the cartopy stock image is shown below the data
+        """
+        self.projection = projection or ccrs.PlateCarree()
+        self.extent = None if extent is None else tuple(float(v) for v in extent)
+        self.features = tuple(features)
+        self.background = background
+        self._paths = {}
+        self._image = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _feature(feature):
+        if isinstance(feature, str):
+            import cartopy.feature as cfeature
+            return getattr(cfeature, _MAP_FEATURES_[feature])
+        return feature
+
+    def _clip_box(self):
+        """Return the bounding box of the extent in projection coordinates (with a margin of 5%)."""
+        from shapely.geometry import box
+
+        x0, x1, y0, y1 = self.extent
+        edge = np.linspace(0, 1, 50)
+        lons = np.concatenate([x0 + (x1 - x0) * edge, np.full(50, x1), x1 - (x1 - x0) * edge, np.full(50, x0)])
+        lats = np.concatenate([np.full(50, y0), y0 + (y1 - y0) * edge, np.full(50, y1), y1 - (y1 - y0) * edge])
+        points = self.projection.transform_points(ccrs.PlateCarree(), lons, lats)
+        points = points[np.isfinite(points[:, :2]).all(axis=1)]
+        if len(points) == 0:
+            return None
+        (xmin, ymin), (xmax, ymax) = points[:, :2].min(axis=0), points[:, :2].max(axis=0)
+        dx, dy = 0.05 * (xmax - xmin), 0.05 * (ymax - ymin)
+        return box(xmin - dx, ymin - dy, xmax + dx, ymax + dy)
+
+    def _project(self, feature):
+        """Project and clip the geometries of a feature, return them as one matplotlib path."""
+        from matplotlib.path import Path
+        try:
+            from cartopy.mpl.path import shapely_to_path
+        except ImportError:  # cartopy < 0.23
+            from cartopy.mpl.patch import geos_to_path as shapely_to_path
+
+        feature = self._feature(feature)
+        if self.extent is None:
+            geometries, clip = feature.geometries(), None
+        else:
+            geometries, clip = feature.intersecting_geometries(self.extent), self._clip_box()
+
+        paths = []
+        for geometry in geometries:
+            projected = self.projection.project_geometry(geometry, feature.crs)
+            if clip is not None:
+                projected = projected.intersection(clip)
+            if not projected.is_empty:
+                path = shapely_to_path(projected)
+                paths.extend(path if isinstance(path, list) else [path])
+        return Path.make_compound_path(*paths) if paths else None
+
+    def feature_path(self, feature):
+        """
+        Return the path of a feature in projection coordinates, computed on first use.
+
+        :param feature: name of a cartopy feature or cartopy Feature object
+
+        :return matplotlib.path.Path: path, None if no geometry of the feature is in the extent
+        """
+        with self._lock:
+            if feature not in self._paths:
+                self._paths[feature] = self._project(feature)
+            return self._paths[feature]
+
+    def add_feature(self, ax, feature, **kwargs):
+        """
+        Add the pre-projected path of a feature to a GeoAxes of the template projection.
+
+        :param ax: cartopy GeoAxes
+        :param feature: name of a cartopy feature or cartopy Feature object
+        :param kwargs: matplotlib patch properties, e.g. linewidth=2, linestyle='--'
+
+        :return matplotlib.patches.PathPatch: the artist, None if the feature is not in the extent
+        """
+        from matplotlib.patches import PathPatch
+
+        path = self.feature_path(feature)
+        if path is None:
+            return None
+        style = dict(facecolor='none', edgecolor='black', zorder=1.5)
+        style.update((k, 'none' if v == 'never' else v) for k, v in self._feature(feature).kwargs.items())
+        if 'color' in kwargs:
+            style['edgecolor'] = kwargs.pop('color')
+        style.update(kwargs)
+        patch = PathPatch(path, transform=ax.transData, **style)
+        ax.add_artist(patch)
+        return patch
+
+    def add_background(self, ax):
+        """Add the stock image, reprojected once per template, to a GeoAxes."""
+        with self._lock:
+            image = self._image
+        if image is None:
+            im = ax.stock_img()
+            with self._lock:
+                self._image = (im.get_array(), im.get_extent(), im.origin)
+            return im
+        array, extent, origin = image
+        return ax.imshow(array, origin=origin, extent=extent, transform=self.projection)
+
+    def axes(self, fig=None, rect=None, styles=None):
+        """
+        Add a GeoAxes with the extent, background and features of the template to a figure.
+
+        :param fig: matplotlib figure (default: current figure)
+        :param rect: [left, bottom, width, height] of the axes, None for the default subplot position
+        :param styles: dict of patch properties per feature, e.g. {'borders': {'linestyle': '--'}}
+
+        :return GeoAxes: axes (the current axes of the figure)
+        """
+        fig = fig or plt.gcf()
+        if rect is None:
+            ax = fig.add_subplot(1, 1, 1, projection=self.projection)
+        else:
+            ax = fig.add_axes(rect, projection=self.projection)
+        if self.extent is None:
+            ax.set_global()
+        else:
+            ax.set_extent(self.extent, crs=ccrs.PlateCarree())
+        if self.background:
+            self.add_background(ax)
+        for feature in self.features:
+            self.add_feature(ax, feature, **(styles or {}).get(feature, {}))
+        return ax
+
+
+def get_map_template(projection=None, extent=None, features=('borders',), background=False):
+    """
+    Return the shared map template of a projection, extent and feature set (see MapTemplate).
+
+    :param projection: cartopy projection of the map (default: PlateCarree)
+    :param extent: [lon_min, lon_max, lat_min, lat_max] of the map, None for the whole globe
+    :param features: names of cartopy features ('borders', 'coastline', ...) or cartopy Feature objects
+    :param background: if True, the cartopy stock image is shown below the data
+
+    :return MapTemplate: template
+    """
+    projection = projection or ccrs.PlateCarree()
+    if extent is not None:
+        extent = tuple(round(float(v), 6) for v in extent)
+    key = (projection, extent, tuple(features), bool(background))
+    with _map_templates_lock:
+        template = _map_templates.pop(key, None)
+        if template is None:
+            template = MapTemplate(projection, extent, features, background)
+            LOGGER.debug('new map template %s', key)
+        _map_templates[key] = template  # most recently used last
+        while len(_map_templates) > MAP_TEMPLATES_MAX:
+            del _map_templates[next(iter(_map_templates))]
+    return template
+
+
+def clear_map_templates():
+    """Forget all map templates."""
+    with _map_templates_lock:
+        _map_templates.clear()
+
+
 def concat_images(images, orientation='v', dir_output='.'):
     """
     concatenation of images.
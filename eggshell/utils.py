@@ -2,19 +2,30 @@
 
 """Utitility functions."""
 
+import bz2
+import contextlib
+import io
+import mmap
 import os
+import struct
 import tempfile
 import tarfile
-import requests
+import threading
+import time
 import shutil
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 
-from netCDF4 import Dataset, MFDataset
 from re import search
 from urllib.parse import urlparse
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 import eggshell as eg
 from eggshell.config import Paths
+from eggshell.dependencies import lazy_import
 from eggshell.nc.nc_utils import get_variable
 
 paths = Paths(eg)
@@ -23,8 +34,299 @@ import logging
 
 LOGGER = logging.getLogger("EGGSHELL")
 
+requests = lazy_import('requests')
+Dataset, MFDataset = lazy_import('netCDF4', 'Dataset', 'MFDataset')
+
+
+# compression of archive members: tar modes and zip modes mapped to the codec of the stream/members
+_TAR_CODECS_ = {'w': None, 'w:': None, 'w|': None, 'w:gz': 'gzip', 'w|gz': 'gzip', 'w:bz2': 'bz2', 'w|bz2': 'bz2'}
+_ZIP_CODECS_ = {'w': None, 'w:': None, 'w:deflated': 'deflate'}
+
+# file extensions of members which are already compressed
+_COMPRESSED_EXTENSIONS_ = ('.gz', '.bz2', '.xz', '.zip', '.png', '.jpg', '.jpeg', '.gif')
+
+_ZIP64_LIMIT_ = (1 << 31) - 1
+
+
+def _is_compressed(path):
+    """
+    Check if a file is already compressed (e.g. a netCDF4 file with zlib compressed variables),
+    so that compressing it again would cost time without saving space.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _COMPRESSED_EXTENSIONS_:
+        return True
+    if ext != '.nc':
+        return False
+    with open(path, 'rb') as fp:
+        if fp.read(8) != b'\x89HDF\r\n\x1a\n':
+            return False  # netCDF3 files can not be compressed internally
+    try:
+        with Dataset(path) as ds:
+            return any(any(var.filters().get(key) for key in ('zlib', 'szip', 'zstd', 'bzip2', 'blosc'))
+                       for var in ds.variables.values() if var.ndim >= 2)
+    except Exception:
+        LOGGER.debug('failed to check compression of %s', path)
+        return False
+
+
+def _compress_block(data, codec, level, last=True):
+    """
+    Compress a block of data. Blocks compressed independently can be concatenated:
+    gzip and bz2 blocks are complete streams (multi-stream files), raw deflate blocks
+    (zip members) are byte aligned by a sync flush and only the last one is finished.
+    """
+    if codec == 'gzip':
+        c = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    if codec == 'deflate':
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    if codec == 'bz2':
+        # bzip2 has no stored blocks, level 0 (compressed members) is its cheapest stream (100k blocks)
+        return bz2.compress(data, max(level, 1))
+    return data
+
+
+class _OrderedPool(object):
+    """
+    Compress blocks in a thread pool and return the results in submission order.
+    At most `2 * workers` blocks are pending, so memory is bounded by the block size.
+    """
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.limit = 2 * workers
+        self.pending = deque()
+        self.offset = 0  # bytes returned so far
+
+    def put(self, data, callback=None):
+        """Queue bytes (or a function returning bytes, called in order) and return finished output."""
+        self.pending.append((data, callback))
+        return self._pop(self.limit)
+
+    def submit(self, data, codec, level, last=True, callback=None):
+        """Queue a block for compression and return finished output."""
+        self.pending.append((self.pool.submit(_compress_block, data, codec, level, last), callback))
+        return self._pop(self.limit)
+
+    def drain(self):
+        """Wait for all pending blocks and return their output."""
+        return self._pop(0)
+
+    def _pop(self, limit):
+        out = []
+        while len(self.pending) > limit or (self.pending and self._ready(self.pending[0][0])):
+            item, callback = self.pending.popleft()
+            if callable(item):
+                item = item()
+            elif not isinstance(item, bytes):
+                item = item.result()
+            if callback is not None:
+                callback(item)
+            self.offset += len(item)
+            out.append(item)
+        return out
+
+    @staticmethod
+    def _ready(item):
+        return not hasattr(item, 'done') or item.done()
+
+
+def _read_blocks(path, chunk_size):
+    """Read a file in blocks, flagging the last one."""
+    with open(path, 'rb') as fp:
+        block = fp.read(chunk_size)
+        while True:
+            following = fp.read(chunk_size) if len(block) == chunk_size else b''
+            yield block, not following
+            if not following:
+                break
+            block = following
+
+
+def _tar_stream(resources, codec, level, pool, chunk_size):
+    """Yield a tar archive compressed (gzip or bz2) in independently compressed blocks."""
+    buf = []
+    buf_size = [0]
+    size = [0]  # uncompressed bytes of the tar stream
+
+    def write(data, lvl):
+        buf.append(data)
+        buf_size[0] += len(data)
+        size[0] += len(data)
+        if buf_size[0] >= chunk_size:
+            return flush(lvl)
+        return []
+
+    def flush(lvl):
+        data = b''.join(buf)
+        del buf[:]
+        buf_size[0] = 0
+        if not data:
+            return []
+        if codec is None:
+            return pool.put(data)
+        return pool.submit(data, codec, lvl)
+
+    for path in resources:
+        st = os.stat(path)
+        info = tarfile.TarInfo(os.path.basename(path))
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = st.st_mode & 0o7777
+        # members which are compressed already are stored in gzip streams (level 0),
+        # or written in the cheapest bzip2 streams
+        lvl = 0 if codec in ('gzip', 'bz2') and _is_compressed(path) else level
+        yield from write(info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'), level)
+        yield from flush(level)
+        for block, _ in _read_blocks(path, chunk_size):
+            yield from write(block, lvl)
+        yield from flush(lvl)
+        if st.st_size % tarfile.BLOCKSIZE:
+            yield from write(tarfile.NUL * (tarfile.BLOCKSIZE - st.st_size % tarfile.BLOCKSIZE), level)
+    # end of archive: two empty blocks, padded to a full record
+    yield from write(tarfile.NUL * 2 * tarfile.BLOCKSIZE, level)
+    if size[0] % tarfile.RECORDSIZE:
+        yield from write(tarfile.NUL * (tarfile.RECORDSIZE - size[0] % tarfile.RECORDSIZE), level)
+    yield from flush(level)
+    yield from pool.drain()
+
+
+def _is_regular_file(path):
+    """Check if a path is a regular file and not a symbolic link (which are stored as links by tarfile)."""
+    return os.path.isfile(path) and not os.path.islink(path)
+
+
+def _zip_write(zf, path):
+    """Write a file or a directory with its content to a ZipFile, below the basename of the path."""
+    zf.write(path, os.path.basename(path))
+    if os.path.isdir(path):
+        top = os.path.dirname(os.path.abspath(path))
+        for root, dirs, files in os.walk(path):
+            for name in sorted(dirs) + sorted(files):
+                filename = os.path.join(root, name)
+                zf.write(filename, os.path.relpath(os.path.abspath(filename), top))
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _zip_stream(resources, codec, level, pool, chunk_size):
+    """
+    Yield a zip archive. Members are written with data descriptors, so the archive
+    can be streamed, and deflated in blocks in parallel.
+    """
+    entries = []
+    for path in resources:
+        st = os.stat(path)
+        name = os.path.basename(path).encode('utf-8')
+        method = 8 if codec == 'deflate' and not _is_compressed(path) else 0
+        zip64 = st.st_size * 1.05 > _ZIP64_LIMIT_
+        dostime, dosdate = _dos_time(st.st_mtime)
+        entry = dict(name=name, method=method, zip64=zip64, time=dostime, date=dosdate, crc=0,
+                     csize=0, size=st.st_size, offset=0, mode=st.st_mode & 0xFFFF)
+        entries.append(entry)
+
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        header = struct.pack('<4sHHHHHLLLHH', b'PK\x03\x04', 45 if zip64 else 20, 0x808, method,
+                             dostime, dosdate, 0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0,
+                             len(name), len(extra))
+
+        def local_header(entry=entry, data=header + name + extra):
+            entry['offset'] = pool.offset  # called in order, when all previous bytes are written
+            return data
+        yield from pool.put(local_header)
+
+        def add_csize(data, entry=entry):
+            entry['csize'] += len(data)
+
+        for block, last in _read_blocks(path, chunk_size):
+            entry['crc'] = zlib.crc32(block, entry['crc'])
+            if method == 8:
+                yield from pool.submit(block, 'deflate', level, last=last, callback=add_csize)
+            else:
+                yield from pool.put(block, callback=add_csize)
+
+        def descriptor(entry=entry):
+            fmt = '<4sLQQ' if entry['zip64'] else '<4sLLL'
+            return struct.pack(fmt, b'PK\x07\x08', entry['crc'], entry['csize'], entry['size'])
+        yield from pool.put(descriptor)
+    yield from pool.drain()
+
+    # central directory
+    cd_offset = pool.offset
+    cd = []
+    for entry in entries:
+        fields = []
+        csize, size, offset = entry['csize'], entry['size'], entry['offset']
+        if size > _ZIP64_LIMIT_ or entry['zip64']:
+            fields += [size, csize]
+            size = csize = 0xFFFFFFFF
+        if offset > _ZIP64_LIMIT_:
+            fields.append(offset)
+            offset = 0xFFFFFFFF
+        extra = struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields), *fields) if fields else b''
+        version = 45 if fields else 20
+        header = struct.pack('<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02', (3 << 8) | version, version, 0x808,
+                             entry['method'], entry['time'], entry['date'], entry['crc'], csize, size,
+                             len(entry['name']), len(extra), 0, 0, 0, entry['mode'] << 16, offset)
+        cd.append(header + entry['name'] + extra)
+    cd = b''.join(cd)
+    yield cd
+
+    count, cd_size, end = len(entries), len(cd), b''
+    if count > 0xFFFF or cd_size > _ZIP64_LIMIT_ or cd_offset > _ZIP64_LIMIT_:
+        end = struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        end += struct.pack('<4sLQL', b'PK\x06\x07', 0, cd_offset + cd_size, 1)
+        count, cd_size, cd_offset = min(count, 0xFFFF), min(cd_size, 0xFFFFFFFF), 0xFFFFFFFF
+    yield end + struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0)
+
+
+def archive_stream(resources, format='tar', mode=None, workers=None, level=6, chunk_size=4 * 1024 * 1024):
+    """
+    Creates an archive as a stream of chunks, e.g. to send it while it is written.
+
+    The data is compressed in blocks of `chunk_size` in a pool of threads (zlib and bz2
+    release the GIL). Already compressed members like zlib compressed netCDF4 files are
+    stored without compressing them again (in gzip compressed tar and deflated zip archives).
+
+    :param resources: list of regular files to be stored in archive (see archive for directories and links)
+    :param format: archive format. Options: tar (default), zip
+    :param mode: for format='tar': 'w' (no compression, default), 'w:gz' or 'w:bz2' (compressed stream)
+                 for format='zip': 'w' (members stored, default) or 'w:deflated' (members deflated)
+    :param workers: number of compression threads (default: number of CPUs)
+    :param level: compression level (1-9)
+    :param chunk_size: size of the compressed blocks in bytes
+
+    :return generator: chunks of bytes
+    """
+    mode = mode or 'w'
+    codecs = {'tar': _TAR_CODECS_, 'zip': _ZIP_CODECS_}.get(format)
+    if codecs is None:
+        raise Exception('archive format {} not supported (only zip and tar)'.format(format))
+    if mode not in codecs:
+        raise Exception('archive mode {} not supported for streaming {} archives'.format(mode, format))
+
+    if not isinstance(resources, list):
+        resources = list([resources])
+    resources = [x for x in resources if x is not None]
+    for path in resources:
+        if not _is_regular_file(path):
+            raise Exception('{} is not a regular file, only regular files can be streamed'.format(path))
+
+    workers = workers or os.cpu_count() or 1
+    stream = _tar_stream if format == 'tar' else _zip_stream
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from stream(resources, codecs[mode], level, _OrderedPool(executor, workers), chunk_size)
+
 
-def archive(resources, format='tar', dir_output=None, mode=None):
+def archive(resources, format='tar', dir_output=None, mode=None, workers=None):
     """
     Compresses a list of files into an archive.
 
@@ -40,7 +342,8 @@ def archive(resources, format='tar', dir_output=None, mode=None):
                   'w|bz2'      open a bzip2 compressed stream for writing
 
                   for foramt='zip':
-                  read "r", write "w" or append "a"
+                  write "w", write with deflate compression "w:deflated" or append "a"
+    :param workers: number of compression threads (default: number of CPUs), see archive_stream
 
     :return str: archive path/filname.ext
     """
@@ -57,30 +360,215 @@ def archive(resources, format='tar', dir_output=None, mode=None):
         resources = list([resources])
     resources = [x for x in resources if x is not None]
 
-    _, arch = tempfile.mkstemp(dir=dir_output, suffix='.{}'.format(format))
+    fd, arch = tempfile.mkstemp(dir=dir_output, suffix='.{}'.format(format))
+    os.close(fd)
 
+    # directories and symbolic links are written by tarfile/ZipFile, regular files are streamed
+    streamable = all(_is_regular_file(f) for f in resources)
     try:
-        if format == 'tar':
+        if streamable and mode in {'tar': _TAR_CODECS_, 'zip': _ZIP_CODECS_}[format]:
+            with open(arch, 'wb') as fp:
+                for chunk in archive_stream(resources, format=format, mode=mode, workers=workers):
+                    fp.write(chunk)
+        elif format == 'tar':
             with tarfile.open(arch, mode) as tar:
                 for f in resources:
                     tar.add(f, arcname=os.path.basename(f))
         elif format == 'zip':
-            with ZipFile(arch, mode=mode) as zf:
+            compression = ZIP_DEFLATED if mode == 'w:deflated' else ZIP_STORED
+            with ZipFile(arch, mode=mode.split(':')[0], compression=compression) as zf:
                 for f in resources:
-                    zf.write(f, os.path.basename(f))
+                    _zip_write(zf, f)
     except Exception as e:
         raise Exception('failed to create {} archive: {}'.format(format, e))
     return arch
 
 
-def download_file(url, out=None, verify=False):
+# settings of the HTTP session shared by the download functions (see configure_session)
+_SESSION_OPTIONS_ = dict(retries=3, backoff_factor=0.5, pool_connections=10, pool_maxsize=10)
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def configure_session(retries=3, backoff_factor=0.5, pool_connections=10, pool_maxsize=10):
+    """
+    Configures the HTTP session shared by download, download_file, download_files
+    and opendap_or_download. Connections are kept alive and reused between requests.
+
+    :param retries: number of retries for failed connections and 5xx responses
+    :param backoff_factor: retries wait {backoff factor} * (2 ** ({retry number} - 1)) seconds
+    :param pool_connections: number of hosts with cached connections
+    :param pool_maxsize: maximum number of concurrent connections per host
+    """
+    global _session
+    with _session_lock:
+        _SESSION_OPTIONS_.update(retries=retries, backoff_factor=backoff_factor,
+                                 pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """
+    Returns the shared HTTP session (a requests.Session with retry/backoff and
+    a connection pool per host). A new session is created in forked processes.
+
+    :return requests.Session: session
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=_SESSION_OPTIONS_['retries'],
+                          backoff_factor=_SESSION_OPTIONS_['backoff_factor'],
+                          status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(max_retries=retry,
+                                  pool_connections=_SESSION_OPTIONS_['pool_connections'],
+                                  pool_maxsize=_SESSION_OPTIONS_['pool_maxsize'],
+                                  pool_block=True)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def _validator(response):
+    """Return the validator of a response usable in an If-Range header (strong ETag or Last-Modified), None if none."""
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def fetch_file(url, out, headers=None, verify=False, session=None, chunk_size=1024 * 1024,
+               cookies=None, max_nbytes=None):
+    """
+    Downloads a URL to a local file and returns the response of the server.
+
+    The data is written to a temporary file `<out>.part` which is renamed when the download is
+    complete and has the size announced by the server, so no truncated files appear under the
+    target name. The validator of the response (ETag or Last-Modified) is stored in
+    `<out>.part.validator`. If a partial file of an interrupted download exists, the download is
+    resumed with an HTTP Range request conditional on this validator (If-Range): if the remote
+    file changed in the meantime, the server sends the whole file and the download restarts.
+    A partial file without validator is not resumed. If the server answers a conditional
+    request (see `headers`) with 304 Not Modified, `out` is left untouched.
+
+    :param url: url adress of the target file location
+    :param out: local file name
+    :param headers: additional request headers, e.g. If-None-Match or If-Modified-Since
+    :param verify: verify the SSL certificate of the server
+    :param session: requests.Session (default: shared session, see get_session)
+    :param chunk_size: size of the chunks written to disk in bytes
+    :param cookies: cookies sent with the request, e.g. an authentication ticket
+    :param max_nbytes: maximum file size. Larger files raise an IOError, checked against the
+                       announced size before anything is written and while streaming.
+
+    :return requests.Response: response of the server (content consumed)
+    """
+    part = out + '.part'
+    validator = part + '.validator'
+    http = session or get_session()
+
+    request_headers = dict(headers or {})
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset and os.path.exists(validator):
+        with open(validator) as fp:
+            request_headers['If-Range'] = fp.read()
+        request_headers['Range'] = 'bytes={}-'.format(offset)
+        LOGGER.debug('resuming download of %s at byte %s', url, offset)
+    elif offset:
+        LOGGER.debug('no validator for the partial file of %s, restarting the download', url)
+        _remove(part)
+        offset = 0
+
+    expected = None
+    with http.get(url, stream=True, verify=verify, headers=request_headers, cookies=cookies) as r:
+        if r.status_code == 304:
+            LOGGER.debug('%s not modified', url)
+            return r
+        if r.status_code == 416:
+            # requested range not satisfiable: complete only if the partial file has the size of the remote one
+            total = r.headers.get('Content-Range', '').split('/')[-1]
+            if not (total.isdigit() and int(total) == offset):
+                LOGGER.debug('partial file of %s does not match the remote file, restarting the download', url)
+                _remove(part, validator)
+                return fetch_file(url, out, headers=headers, verify=verify, session=session,
+                                  chunk_size=chunk_size, cookies=cookies, max_nbytes=max_nbytes)
+            LOGGER.debug('partial file of %s is complete', url)
+        else:
+            if r.status_code == 401:
+                raise Exception("Not Authorized")
+            r.raise_for_status()
+            expected = _expected_size(r)
+            if max_nbytes is not None and expected is not None and expected > max_nbytes:
+                raise IOError("File too large to download.")
+            if r.status_code == 206:
+                mode = 'ab'
+            else:
+                # the whole file (first attempt, or the remote file changed since the partial download)
+                mode = 'wb'
+                _remove(validator)
+                if _validator(r):
+                    with open(validator, 'w') as fp:
+                        fp.write(_validator(r))
+            with open(part, mode) as fp:
+                for chunk in r.iter_content(chunk_size):
+                    if chunk:
+                        fp.write(chunk)
+                        if max_nbytes is not None and fp.tell() > max_nbytes:
+                            break
+            if max_nbytes is not None and os.path.getsize(part) > max_nbytes:
+                _remove(part, validator)
+                raise IOError("File too large to download.")
+    if expected is not None and os.path.getsize(part) != expected:
+        # keep the partial file and its validator, the next attempt resumes it
+        raise Exception('incomplete download of {}: got {} of {} bytes'.format(
+            url, os.path.getsize(part), expected))
+    os.replace(part, out)
+    _remove(validator)
+    return r
+
+
+def _expected_size(response):
+    """Return the complete size of a downloaded file announced by the server, None if unknown."""
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None  # Content-Length counts the encoded bytes
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').split('/')[-1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def download_file(url, out=None, verify=False, session=None, chunk_size=1024 * 1024):
+    """
+    Downloads a URL to a local file (see fetch_file).
+
+    :param url: url adress of the target file location
+    :param out: local file name (default: basename of the url in the current directory)
+    :param verify: verify the SSL certificate of the server
+    :param session: requests.Session (default: shared session, see get_session)
+    :param chunk_size: size of the chunks written to disk in bytes
+
+    :return str: filename
+    """
     if out:
         local_filename = out
     else:
         local_filename = url.split('/')[-1]
-    r = requests.get(url, stream=True, verify=verify)
-    with open(local_filename, 'wb') as fp:
-        shutil.copyfileobj(r.raw, fp)
+    fetch_file(url, local_filename, verify=verify, session=session, chunk_size=chunk_size)
     return local_filename
 
 
@@ -89,55 +577,89 @@ def local_path(url):
     return url_parts.path
 
 
-def download(url, cache=False):
+def cache_path(url):
+    """
+    Returns the path of an URL in the cache directory.
+
+    :param url: url adress of the target file location
+
+    :return str: path in cache
+    """
+    parsed_url = urlparse(url)
+    return os.path.join(paths.cache, parsed_url.netloc, parsed_url.path.strip('/'))
+
+
+def download(url, cache=False, session=None):
     """
     Downloads URL using the Python requests module to the current directory.
 
-    :param cache: if True then files will be downloaded to a cache directory.
+    :param cache: if True then files will be downloaded to the cache directory
+                  managed by eggshell.cache.DownloadCache.
     :param url: url adress of the target file location
+    :param session: requests.Session (default: shared session, see get_session)
 
     :return str: filename
     """
     filename = ''
     try:
         if cache:
-            parsed_url = urlparse(url)
-            filename = os.path.join(paths.cache, parsed_url.netloc, parsed_url.path.strip('/'))
-            if os.path.exists(filename):
-                LOGGER.info('file already in cache: %s', os.path.basename(filename))
-                # if check_creationtime(filename, url):
-                #     msg = 'file in cache older than archive file, downloading: {}'.format(os.path.basename(filename))
-                #     LOGGER.info(msg)
-                #     os.remove(filename)
-                #     filename = download_file(url, out=filename)
-                # TODO: enable creation time check
-            else:
-                if not os.path.exists(os.path.dirname(filename)):
-                    os.makedirs(os.path.dirname(filename))
-                LOGGER.info('downloading: {}'.format(url))
-                filename = download_file(url, out=filename)
-                # make softlink to current dir
-                # os.symlink(filename, os.path.basename(filename))
-                # filename = os.path.basename(filename)
+            from eggshell.cache import get_cache
+            filename = get_cache().fetch(url, session=session)
         else:
-            filename = download_file(url)
+            filename = download_file(url, session=session)
     except Exception as e:
         msg = 'failed to download data: {}'.format(e)
         LOGGER.exception(msg)
     return filename
 
 
-def extract_archive(resources, dir_output=None):
+def download_files(urls, cache=False, workers=4):
+    """
+    Downloads a list of URLs concurrently in a pool of threads sharing the HTTP session.
+    The number of connections per host is limited by the session (see configure_session).
+
+    :param urls: list of url adresses
+    :param cache: if True then files will be downloaded to a cache directory.
+    :param workers: maximum number of concurrent downloads
+
+    :return list: filenames in the order of the urls ('' for failed downloads)
+    """
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda url: download(url, cache=cache, session=session), urls))
+
+
+_VSI_PREFIXES_ = {'zip': '/vsizip/', 'tar': '/vsitar/'}
+
+
+def _member_filter(members):
+    """Return a predicate for member names from a glob pattern, a list of patterns or a function."""
+    if members is None:
+        return lambda name: True
+    if callable(members):
+        return members
+    patterns = [members] if isinstance(members, str) else list(members)
+    return lambda name: any(fnmatch(name, p) or fnmatch(os.path.basename(name), p) for p in patterns)
+
+
+def extract_archive(resources, dir_output=None, members=None, workers=None, lazy=False):
     """
     extracts archives (tar/zip)
 
     :param resources: list of archive files (if netCDF files are in list,
                      they are passed and returnd as well in the return).
     :param dir_output: define a directory to store the results (default: tempory folder).
+    :param members: select members by name: glob pattern (e.g. '*.nc'), list of patterns
+                    or function returning True for names to extract (default: all members)
+    :param workers: number of threads decompressing zip members in parallel (default: number of CPUs)
+    :param lazy: if True, nothing is extracted. Virtual paths `/vsizip/<archive>/<member>`
+                 (or `/vsitar/`) are returned instead, which GDAL reads directly and
+                 open_dataset opens in memory (uncompressed members without copying).
 
     :return list: [list of extracted files]
     """
     dir_output = dir_output or tempfile.gettempdir()
+    select = _member_filter(members)
 
     if not isinstance(resources, list):
         resources = list([resources])
@@ -149,15 +671,23 @@ def extract_archive(resources, dir_output=None):
             ext = os.path.basename(arch).split('.')[-1]
 
             if ext == 'nc':
-                files.append(os.path.join(dir_output, arch))
-            elif ext == 'tar':
-                with tarfile.open(arch, mode='r') as tar:
-                    tar.extractall()
-                    files.extend([os.path.join(dir_output, f) for f in tar.getnames()])
+                files.append(arch)
             elif ext == 'zip':
                 with ZipFile(arch, mode='r') as zf:
-                    zf.extractall()
-                    files.extend([os.path.join(dir_output, f) for f in zf.filelist])
+                    selected = [m for m in zf.infolist() if not m.is_dir() and select(m.filename)]
+                    if lazy:
+                        files.extend([_virtual_path('zip', arch, m.filename) for m in selected])
+                    else:
+                        files.extend(_extract_zip(zf, selected, dir_output, workers))
+            elif ext == 'tar' or tarfile.is_tarfile(arch):
+                with tarfile.open(arch, mode='r') as tar:
+                    selected = [m for m in tar.getmembers() if m.isfile() and select(m.name)]
+                    if lazy:
+                        files.extend([_virtual_path('tar', arch, m.name) for m in selected])
+                    else:
+                        kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+                        tar.extractall(dir_output, members=selected, **kwargs)
+                        files.extend([os.path.join(dir_output, m.name) for m in selected])
             else:
                 LOGGER.warning('file extention {} unknown'.format(ext))
         except Exception as e:
@@ -165,6 +695,113 @@ def extract_archive(resources, dir_output=None):
     return files
 
 
+def _extract_zip(zf, selected, dir_output, workers=None):
+    """Extract zip members in a pool of threads (zlib releases the GIL while inflating)."""
+    # create the folders first, ZipFile.extract is not safe to do it concurrently
+    for m in selected:
+        os.makedirs(os.path.dirname(os.path.join(dir_output, m.filename)), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        return list(pool.map(lambda m: zf.extract(m, dir_output), selected))
+
+
+def _virtual_path(format, arch, name):
+    """Return the GDAL style virtual path of an archive member, e.g. /vsizip/tmp/out.zip/tas.nc"""
+    return _VSI_PREFIXES_[format] + os.path.join(os.path.abspath(arch), name).lstrip('/')
+
+
+def _split_virtual_path(path):
+    """Split a /vsizip/ or /vsitar/ path into format, archive file and member name."""
+    for format, prefix in _VSI_PREFIXES_.items():
+        if path.startswith(prefix):
+            parts = path[len(prefix):].split('/')
+            for i in range(1, len(parts)):
+                arch = '/' + '/'.join(parts[:i]).lstrip('/')
+                if os.path.isfile(arch):
+                    return format, arch, '/'.join(parts[i:])
+            raise Exception('archive of {} not found'.format(path))
+    return None, path, None
+
+
+def _member_range(path):
+    """
+    Locate a member of an archive given by a virtual path.
+
+    :return tuple: content (None if the member is stored uncompressed), archive, offset and
+                   size of the member in the archive
+    """
+    format, arch, name = _split_virtual_path(path)
+    if format is None:
+        raise Exception('{} is not a path in an archive'.format(path))
+
+    if format == 'zip':
+        with ZipFile(arch) as zf:
+            info = zf.getinfo(name)
+            if info.compress_type != ZIP_STORED or info.flag_bits & 0x1:
+                return zf.read(info), arch, None, info.file_size
+            with open(arch, 'rb') as fp:
+                fp.seek(info.header_offset)
+                header = struct.unpack('<4sHHHHHLLLHH', fp.read(30))
+            return None, arch, info.header_offset + 30 + header[9] + header[10], info.file_size
+    with tarfile.open(arch) as tar:
+        info = tar.getmember(name)
+        if not isinstance(tar.fileobj, io.BufferedReader):
+            return tar.extractfile(info).read(), arch, None, info.size  # compressed tar
+        return None, arch, info.offset_data, info.size
+
+
+@contextlib.contextmanager
+def map_member(path):
+    """
+    Context manager mapping a member of an archive given by a virtual path (see extract_archive
+    with lazy=True) into memory. Uncompressed members are memory mapped instead of copied,
+    the mapping is closed when the context is left.
+
+    :param path: /vsizip/<archive>/<member> or /vsitar/<archive>/<member>
+
+    :return memoryview: content, valid inside the context only
+    """
+    content, arch, offset, size = _member_range(path)
+    if content is not None or size == 0:
+        with memoryview(content or b'') as view:
+            yield view
+        return
+    with open(arch, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with memoryview(mm)[offset:offset + size] as view:
+            yield view
+    finally:
+        mm.close()
+
+
+def read_member(path):
+    """
+    Read a member of an archive given by a virtual path (see extract_archive with lazy=True).
+    Uncompressed members are copied from a memory map of the archive, see map_member to
+    read them without copy.
+
+    :param path: /vsizip/<archive>/<member> or /vsitar/<archive>/<member>
+
+    :return bytes: content
+    """
+    with map_member(path) as view:
+        return view.tobytes()
+
+
+def open_dataset(resource):
+    """
+    Opens a netCDF file, also from a path in an archive (see extract_archive with lazy=True).
+
+    :param resource: path to netCDF file or /vsizip/ or /vsitar/ path
+
+    :return netCDF4.Dataset: dataset opened for reading
+    """
+    if _split_virtual_path(resource)[0] is None:
+        return Dataset(resource)
+    # the dataset keeps the buffer, the member is copied (see read_member)
+    return Dataset(os.path.basename(resource), memory=read_member(resource))
+
+
 # def get_coordinates(resource, variable=None, unrotate=False):
 #     """
 #     reads out the coordinates of a variable
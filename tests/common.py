@@ -1,7 +1,12 @@
 # from pywps import get_ElementMakerForVersion
 # from pywps.app.basic import get_xpath_ns
 # from pywps.tests import WpsClient, WpsTestResponse
+import contextlib
+import functools
+import io
 import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 # VERSION = "0.4.0"
 # WPS, OWS = get_ElementMakerForVersion(VERSION)
@@ -93,3 +98,91 @@ TESTDATA = {
 #             output[identifier_el.text] = data_el[0].text
 #
 #     return output
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler with support for HTTP Range requests (local stand-in for THREDDS)."""
+
+    def log_message(self, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super(RangeRequestHandler, self).end_headers()
+
+    def send_head(self):
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if rng is None or not os.path.isfile(path):
+            return super(RangeRequestHandler, self).send_head()
+        if self.headers.get('If-Range', self.date_time_string(os.path.getmtime(path))) != \
+                self.date_time_string(os.path.getmtime(path)):
+            # the file changed, send all of it
+            return super(RangeRequestHandler, self).send_head()
+        size = os.path.getsize(path)
+        start, end = rng.split('=')[1].split('-')[:2]
+        start, end = int(start), min(int(end or size - 1), size - 1)
+        if start >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.end_headers()
+            return None
+        with open(path, 'rb') as fp:
+            fp.seek(start)
+            body = io.BytesIO(fp.read(end - start + 1))
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        return body
+
+
+@contextlib.contextmanager
+def serve_directory(directory):
+    """Serve a directory over HTTP in a background thread and yield the base URL."""
+    handler = functools.partial(RangeRequestHandler, directory=str(directory))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def serve_opendap(resource, requests=None):
+    """
+    Serve a netCDF file over OPeNDAP with pydap (local stand-in for THREDDS) and yield its URL.
+    The requested paths (e.g. hyperslab queries) are appended to the list `requests`.
+    """
+    import numpy as np
+    from netCDF4 import Dataset
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    from pydap.model import DatasetType, BaseType
+    from pydap.handlers.lib import BaseHandler
+
+    name = os.path.basename(str(resource))
+    with Dataset(str(resource)) as nc:
+        dataset = DatasetType(name, **{k: nc.getncattr(k) for k in nc.ncattrs()})
+        for key, var in nc.variables.items():
+            dataset[key] = BaseType(key, np.asarray(var[:]), dims=var.dimensions,
+                                    **{k: var.getncattr(k) for k in var.ncattrs()})
+
+    class LoggingHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            if requests is not None:
+                requests.append(self.path)
+
+    server = make_server('127.0.0.1', 0, BaseHandler(dataset), handler_class=LoggingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/{}'.format(server.server_port, name)
+    finally:
+        server.shutdown()
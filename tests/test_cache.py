@@ -0,0 +1,153 @@
+import os
+import time
+
+from .common import serve_directory
+
+from eggshell.cache import DownloadCache, file_lock, parse_bytes
+
+
+def test_parse_bytes():
+    assert parse_bytes('2K') == 2048
+    assert parse_bytes('1.5G') == 1.5 * 1024 ** 3
+    assert parse_bytes(100) == 100
+    assert parse_bytes('') is None
+
+
+def test_fetch_and_revalidate(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('f.nc').write_binary(b'a' * 100)
+    os.utime(str(data.join('f.nc')), (1e9, 1e9))
+    cache = DownloadCache(str(tmpdir.join('cache')), max_age=0)
+
+    with serve_directory(data) as url:
+        filename = cache.fetch(url + '/f.nc')
+        assert filename == cache.path(url + '/f.nc')
+        assert open(filename, 'rb').read() == b'a' * 100
+        entry = cache.entry(url + '/f.nc')
+        assert entry['size'] == 100 and entry['last_modified']
+
+        # not modified on the server: the cached file is kept
+        cache.fetch(url + '/f.nc')
+        assert cache.entry(url + '/f.nc')['validated'] > entry['validated']
+
+        # modified on the server: downloaded again
+        data.join('f.nc').write_binary(b'b' * 50)
+        assert open(cache.fetch(url + '/f.nc'), 'rb').read() == b'b' * 50
+        assert cache.entry(url + '/f.nc')['size'] == 50
+
+
+def test_lru_eviction(tmpdir):
+    data = tmpdir.mkdir('data')
+    for i in range(3):
+        data.join('f{}.nc'.format(i)).write_binary(b'x' * 100)
+    cache = DownloadCache(str(tmpdir.join('cache')), max_bytes=250)
+
+    with serve_directory(data) as url:
+        f0 = cache.fetch(url + '/f0.nc')
+        f1 = cache.fetch(url + '/f1.nc')
+        time.sleep(0.01)
+        cache.fetch(url + '/f0.nc')  # f1 is now least recently used
+        f2 = cache.fetch(url + '/f2.nc')
+
+    assert os.path.exists(f0) and os.path.exists(f2)
+    assert not os.path.exists(f1)
+    assert not os.path.exists(f1 + '.lock')
+    assert cache.entry(url + '/f1.nc') is None
+    assert cache.size() == 200
+
+
+def test_lru_eviction_locked(tmpdir):
+    data = tmpdir.mkdir('data')
+    for i in range(2):
+        data.join('f{}.nc'.format(i)).write_binary(b'x' * 100)
+    cache = DownloadCache(str(tmpdir.join('cache')), max_bytes=150)
+
+    with serve_directory(data) as url:
+        f0 = cache.fetch(url + '/f0.nc')
+        # f0 is in use by another process, it is skipped
+        with file_lock(f0):
+            cache.fetch(url + '/f1.nc')
+        assert os.path.exists(f0) and os.path.exists(f0 + '.lock')
+        assert cache.evict() == [url + '/f0.nc']
+    assert not os.path.exists(f0) and not os.path.exists(f0 + '.lock')
+
+
+def test_file_lock_removed(tmpdir):
+    import threading
+    path = str(tmpdir.join('f.nc'))
+    held, release = threading.Event(), threading.Event()
+
+    def wait_for_lock():
+        with file_lock(path):
+            held.set()
+            release.wait(5)
+
+    with file_lock(path):
+        thread = threading.Thread(target=wait_for_lock)
+        thread.start()
+        time.sleep(0.2)
+        # the holder removes the lock file with the cached file
+        os.remove(path + '.lock')
+    # the waiting thread locks the new lock file, no one else gets the lock
+    assert held.wait(5)
+    with file_lock(path, blocking=False) as locked:
+        assert not locked
+    release.set()
+    thread.join()
+
+
+def test_single_flight(tmpdir, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from eggshell import utils
+
+    calls = []
+    fetch_file = utils.fetch_file
+
+    def slow_fetch(*args, **kwargs):
+        calls.append(args[0])
+        time.sleep(0.2)
+        return fetch_file(*args, **kwargs)
+
+    monkeypatch.setattr(utils, 'fetch_file', slow_fetch)
+    data = tmpdir.mkdir('data')
+    data.join('f.nc').write_binary(b'x' * 1000)
+    root = str(tmpdir.join('cache'))
+
+    with serve_directory(data) as url:
+        # separate cache objects stand in for separate worker processes
+        with ThreadPoolExecutor(4) as pool:
+            files = list(pool.map(lambda i: DownloadCache(root).fetch(url + '/f.nc'), range(4)))
+    assert len(calls) == 1
+    assert len(set(files)) == 1
+    assert not os.path.exists(files[0] + '.part')
+
+
+def test_integrity(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('f.nc').write_binary(b'x' * 100)
+    cache = DownloadCache(str(tmpdir.join('cache')), verify='checksum')
+
+    with serve_directory(data) as url:
+        filename = cache.fetch(url + '/f.nc')
+        # truncated file
+        with open(filename, 'wb') as fp:
+            fp.write(b'x' * 10)
+        assert open(cache.fetch(url + '/f.nc'), 'rb').read() == b'x' * 100
+        # corrupt file of the right size
+        with open(filename, 'wb') as fp:
+            fp.write(b'y' * 100)
+        assert open(cache.fetch(url + '/f.nc'), 'rb').read() == b'x' * 100
+
+
+def test_modify(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('f.nc').write_binary(b'x' * 100)
+    cache = DownloadCache(str(tmpdir.join('cache')), verify='checksum')
+
+    with serve_directory(data) as url:
+        filename = cache.fetch(url + '/f.nc')
+        with cache.modify(url + '/f.nc'):
+            with open(filename, 'ab') as fp:
+                fp.write(b'y')
+        # the changed file is served, not downloaded again
+        assert open(cache.fetch(url + '/f.nc'), 'rb').read() == b'x' * 100 + b'y'
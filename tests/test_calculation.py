@@ -0,0 +1,44 @@
+import numpy as np
+
+from .common import TESTDATA
+
+from eggshell.utils import local_path
+from eggshell.nc import calculation
+
+
+def test_fieldmean():
+    ncs = [local_path(TESTDATA['cordex_tasmax_2006_nc']),
+           local_path(TESTDATA['cordex_tasmax_2007_nc'])]
+    ts = calculation.fieldmean(ncs)
+    assert ts.shape == (23,)
+
+    # the legacy implementation: all values at once, weighted with the rlat coordinate
+    from netCDF4 import Dataset
+    from eggshell.nc.nc_utils import get_values
+    with Dataset(ncs[0]) as ds:
+        assert ds.variables['tasmax'].dimensions == ('time', 'rlat', 'rlon')
+        lat_w = np.sqrt(np.cos(np.radians(ds.variables['rlat'][:])))
+    expected = np.average(np.average(get_values(ncs), axis=1, weights=lat_w), axis=1)
+    assert np.array_equal(ts, expected)
+
+    # reading one timestep at a time gives the same result
+    assert np.array_equal(calculation.fieldmean(ncs, memory_limit=0.01), ts)
+
+
+def test_ensemble_stats(tmpdir):
+    from netCDF4 import Dataset
+
+    fields = np.random.RandomState(0).rand(5, 4, 3)
+    fields[1, 0, 0] = np.nan
+    resources = []
+    for i, field in enumerate(fields):
+        resources.append(str(tmpdir.join('member_{}.nc'.format(i))))
+        with Dataset(resources[-1], 'w') as ds:
+            ds.createDimension('time', 1)
+            ds.createDimension('lat', 4)
+            ds.createDimension('lon', 3)
+            ds.createVariable('tas', 'f8', ('time', 'lat', 'lon'))[:] = field[None]
+
+    median, std = calculation.ensemble_stats(resources, memory_limit=1e-5)
+    assert np.allclose(median, np.nanmedian(fields, axis=0))
+    assert np.allclose(std, np.nanstd(fields, axis=0))
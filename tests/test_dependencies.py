@@ -1,4 +1,40 @@
+import os
+import subprocess
+import sys
+
+from eggshell import dependencies
 
 
 def test_dependencies_imports():
     from eggshell.dependencies import netCDF4 as nc
+    assert nc.Dataset is not None
+
+
+def test_lazy_import():
+    json = dependencies.lazy_import('json')
+    assert json is sys.modules['json']
+
+    name = 'xml.dom.pulldom'
+    sys.modules.pop(name, None)
+    pulldom, parse = dependencies.lazy_import(name, 'PullDOM', 'parseString')
+    assert name not in sys.modules
+    assert callable(parse('<a/>').getEvent)
+    assert name in sys.modules
+    assert isinstance(pulldom(), pulldom)
+
+    assert not dependencies.is_available('eggshell_missing_package')
+
+
+def test_import_heavy_modules():
+    # a fresh interpreter, the heavy dependencies must not be imported with eggshell
+    code = ("import sys, time\n"
+            "t = time.perf_counter()\n"
+            "import eggshell, eggshell.utils\n"
+            "print(time.perf_counter() - t)\n"
+            "print([m for m in ('netCDF4', 'ocgis', 'pywps', 'requests', 'matplotlib', 'cartopy', 'pandas')"
+            " if m in sys.modules])\n")
+    top_level = os.path.dirname(os.path.dirname(dependencies.__file__))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=top_level).decode().splitlines()
+    assert out[1] == '[]'
+    if os.environ.get('EGGSHELL_BENCHMARK'):
+        assert float(out[0]) < 1.0
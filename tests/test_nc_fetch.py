@@ -0,0 +1,181 @@
+import os
+import time
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from .common import serve_directory
+
+from eggshell import utils
+from eggshell.cache import DownloadCache, set_cache
+from eggshell.nc import nc_fetch
+
+
+def _hgt(filename, year, levels=(1000, 850, 700, 500, 300)):
+    with Dataset(filename, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('level', len(levels))
+        ds.createDimension('lat', 4)
+        ds.createDimension('lon', 5)
+        ds.createVariable('time', 'f8', ('time',))[:] = np.arange(3) * 24 + (year - 2000) * 8760
+        ds.variables['time'].units = 'hours since 2000-01-01 00:00:0.0'
+        ds.createVariable('level', 'f4', ('level',))[:] = levels
+        ds.createVariable('lat', 'f4', ('lat',))[:] = np.arange(4)
+        ds.createVariable('lon', 'f4', ('lon',))[:] = np.arange(5)
+        hgt = ds.createVariable('hgt', 'f4', ('time', 'level', 'lat', 'lon'))
+        hgt[:] = np.random.rand(3, len(levels), 4, 5)
+        hgt.units = 'm'
+        return hgt[:]
+
+
+def test_get_levels(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    files = [str(tmpdir.join('hgt.{}.nc'.format(year))) for year in (2001, 2000)]
+    data = {2001: _hgt(files[0], 2001), 2000: _hgt(files[1], 2000)}
+
+    out = nc_fetch.get_levels(files, ['NCEP_z850', 'NCEP_z500'], dir_output=str(tmpdir), memory_limit=1e-4)
+    with Dataset(out['NCEP_z500']) as ds:
+        assert ds.variables['z500'].shape == (6, 4, 5)
+        assert ds.variables['time'].calendar == 'standard'
+        np.testing.assert_array_equal(ds.variables['z500'][:3], data[2000][:, 3])
+        np.testing.assert_array_equal(ds.variables['z500'][3:], data[2001][:, 3])
+    with Dataset(nc_fetch.get_level(files, 850)) as ds:
+        np.testing.assert_array_equal(ds.variables['z850'][3:], data[2001][:, 1])
+
+    # a second extraction to the same folder does not overwrite the first one
+    again = nc_fetch.get_levels(files, ['NCEP_z500'], dir_output=str(tmpdir))
+    assert again['NCEP_z500'] != out['NCEP_z500']
+    assert os.path.basename(again['NCEP_z500']).startswith('z500_')
+    with pytest.raises(Exception):
+        nc_fetch.get_levels(files, [500, 600], dir_output=str(tmpdir))
+    assert len(tmpdir.listdir(lambda f: f.basename.startswith('z500_'))) == 2
+
+
+def _slp(filename, days, format='NETCDF3_CLASSIC'):
+    with Dataset(filename, 'w', format=format) as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('lat', 3)
+        ds.createVariable('time', 'f8', ('time',))
+        ds.variables['time'].units = 'hours since 1800-01-01 00:00:0.0'
+        ds.createVariable('lat', 'f4', ('lat',))[:] = np.arange(3)
+        ds.createVariable('slp', 'f4', ('time', 'lat'))
+        _grow(ds, days)
+
+
+def _grow(ds, days):
+    n = len(ds.variables['time'])
+    ds.variables['time'][n:days] = np.arange(n, days) * 24 + 1902192
+    ds.variables['slp'][n:days] = np.random.rand(days - n, 3)
+
+
+@pytest.fixture
+def cache(tmpdir):
+    set_cache(DownloadCache(str(tmpdir.join('cache'))))
+    yield
+    set_cache(None)
+
+
+def _no_download(*args, **kwargs):
+    raise AssertionError('downloaded the whole file')
+
+
+def test_update_reanalysis_range(tmpdir, cache, monkeypatch):
+    data = tmpdir.mkdir('data')
+    remote = str(data.join('slp.2017.nc'))
+    _slp(remote, 10)
+    with serve_directory(data) as url:
+        filename = nc_fetch.update_reanalysis(url + '/slp.2017.nc')
+        assert nc_fetch.read_manifest(filename)['time']['size'] == 10
+
+        with Dataset(remote, 'a') as ds:
+            _grow(ds, 15)
+        os.utime(remote, (time.time() + 10, time.time() + 10))
+        monkeypatch.setattr(DownloadCache, 'fetch', _no_download)
+        size = os.path.getsize(filename)
+        assert nc_fetch.update_reanalysis(url + '/slp.2017.nc') == filename
+        assert os.path.getsize(filename) > size
+        assert open(filename, 'rb').read() == open(remote, 'rb').read()
+        assert nc_fetch.read_manifest(filename)['time']['size'] == 15
+
+
+def test_update_reanalysis_rewritten(tmpdir, cache, monkeypatch):
+    data = tmpdir.mkdir('data')
+    remote = str(data.join('slp.2017.nc'))
+    _slp(remote, 10)
+    with serve_directory(data) as url:
+        filename = nc_fetch.update_reanalysis(url + '/slp.2017.nc')
+        # the cached file is rewritten (e.g. normalized), the remote one is unchanged
+        with Dataset(filename, 'a') as ds:
+            ds.variables['time'].calendar = 'standard'
+        size = os.path.getsize(filename)
+        assert size != nc_fetch.read_manifest(filename)['offset']
+        monkeypatch.setattr(DownloadCache, 'fetch', _no_download)
+        assert nc_fetch.update_reanalysis(url + '/slp.2017.nc') == filename
+        assert os.path.getsize(filename) == size
+
+        # no byte append to the rewritten file
+        with Dataset(remote, 'a') as ds:
+            _grow(ds, 15)
+        manifest = nc_fetch.read_manifest(filename)
+        assert not nc_fetch._append_bytes(url + '/slp.2017.nc', filename, manifest['offset'],
+                                          os.path.getsize(remote), utils.get_session())
+        assert os.path.getsize(filename) == size
+
+
+def test_reanalyses_normalized(tmpdir, cache, monkeypatch, caplog):
+    pytest.importorskip('pydap')
+    import logging
+    from datetime import datetime as dt
+    from .common import serve_opendap
+    year = dt.now().year
+    data = tmpdir.mkdir('data')
+    remote = str(data.join('slp.{}.nc'.format(year)))
+    _slp(remote, 10)  # no calendar, normalize_time adds it
+
+    calls = []
+    for name in ('_append_bytes', '_append_dap'):
+        def spy(*args, _name=name, _func=getattr(nc_fetch, name)):
+            calls.append((_name, _func(*args)))
+            return calls[-1][1]
+        monkeypatch.setattr(nc_fetch, name, spy)
+
+    with serve_directory(data) as url:
+        monkeypatch.setattr(nc_fetch, 'reanalyses_url', lambda year, **kwargs: '{}/slp.{}.nc'.format(url, year))
+        filename, = nc_fetch.reanalyses(start=year, end=year, workers=1)
+        with Dataset(filename) as ds:
+            assert ds.variables['time'].calendar == 'standard'
+        assert nc_fetch.read_manifest(filename)['offset'] is None
+
+        with Dataset(remote, 'a') as ds:
+            _grow(ds, 12)
+        os.utime(remote, (time.time() + 10, time.time() + 10))
+        monkeypatch.setattr(DownloadCache, 'fetch', _no_download)
+        with serve_opendap(remote) as dap_url, caplog.at_level(logging.INFO, logger='PYWPS'):
+            nc_fetch.update_reanalysis('{}/slp.{}.nc'.format(url, year), dap_url=dap_url)
+    # the normalized file is updated over OPeNDAP, the Range append is skipped with a message
+    assert calls == [('_append_bytes', False), ('_append_dap', True)]
+    assert 'not a byte copy' in caplog.text
+    with Dataset(filename) as ds:
+        assert len(ds.variables['time']) == 12
+
+
+def test_update_reanalysis_dap(tmpdir, cache, monkeypatch):
+    pytest.importorskip('pydap')
+    from .common import serve_opendap
+    data = tmpdir.mkdir('data')
+    remote = str(data.join('slp.2017.nc'))
+    _slp(remote, 10, format='NETCDF4')
+    with serve_directory(data) as url:
+        filename = nc_fetch.update_reanalysis(url + '/slp.2017.nc')
+
+        with Dataset(remote, 'a') as ds:
+            _grow(ds, 12)
+        os.utime(remote, (time.time() + 10, time.time() + 10))
+        monkeypatch.setattr(DownloadCache, 'fetch', _no_download)
+        with serve_opendap(remote) as dap_url:
+            nc_fetch.update_reanalysis(url + '/slp.2017.nc', dap_url=dap_url)
+    with Dataset(filename) as ds, Dataset(remote) as src:
+        assert len(ds.variables['time']) == 12
+        np.testing.assert_array_equal(ds.variables['slp'][:], src.variables['slp'][:])
+    assert nc_fetch.read_manifest(filename)['time']['size'] == 12
@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+
+from .common import TESTDATA
+
+from eggshell.utils import local_path
+from eggshell.nc import nc_index
+
+
+def test_read_metadata():
+    record = nc_index.read_metadata(local_path(TESTDATA['cordex_tasmax_2006_nc']))
+    assert record['variable'] == 'tasmax'
+    assert record['variable_dimensions'] == ['time', 'rlat', 'rlon']
+    assert record['attributes']['frequency'] == 'mon'
+    assert record['dimensions']['time'] == 11
+    assert record['time']['calendar'] == 'proleptic_gregorian'
+
+
+def test_metadata_index():
+    tmp = tempfile.mkdtemp()
+    nc = os.path.join(tmp, 'tasmax.nc')
+    shutil.copy(local_path(TESTDATA['cmip5_tasmax_2006_nc']), nc)
+    db = os.path.join(tmp, 'index.sqlite')
+
+    record = nc_index.MetadataIndex(db).get(nc)
+    assert record['variable'] == 'tasmax'
+
+    # a new index (e.g. in another process) is served from the database
+    index = nc_index.MetadataIndex(db)
+    assert index.get(nc) == record
+    assert index.get(nc) is index.get(nc)
+
+    # modified files are read again
+    os.utime(nc, (0, 0))
+    assert index.get(nc) == record
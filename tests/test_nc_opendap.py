@@ -0,0 +1,140 @@
+import os
+import shutil
+
+import pytest
+
+from .common import TESTDATA, serve_directory
+
+from eggshell.utils import local_path
+from eggshell.cache import DownloadCache, set_cache
+from eggshell.nc import nc_opendap
+from eggshell.nc.nc_utils import opendap_or_download
+
+
+@pytest.fixture
+def server(tmpdir):
+    dods = tmpdir.mkdir('dodsC')
+    dods.join('tas.nc.dds').write('Dataset {\n    Float32 tas[time = 12];\n} tas.nc;\n')
+    files = tmpdir.mkdir('fileServer')
+    files.join('tasmax.nc.dds').write('<html><body>not an OPeNDAP server</body></html>')
+    shutil.copy(local_path(TESTDATA['cmip5_tasmax_2006_nc']), str(files.join('tasmax.nc')))
+    nc_opendap.clear_capabilities()
+    with serve_directory(tmpdir) as url:
+        yield url
+
+
+def test_supports_opendap(server, monkeypatch):
+    assert nc_opendap.supports_opendap(server + '/dodsC/tas.nc')
+    assert not nc_opendap.supports_opendap(server + '/fileServer/tasmax.nc')
+
+    # other files in the same folders are not probed again
+    def probe(*args, **kwargs):
+        raise AssertionError('probed twice')
+    monkeypatch.setattr(nc_opendap, 'probe_opendap', probe)
+    assert nc_opendap.known_capability(server + '/dodsC/sub/pr.nc') is True
+    assert nc_opendap.supports_opendap(server + '/dodsC/pr.nc')
+    assert not nc_opendap.supports_opendap(server + '/fileServer/pr.nc')
+
+
+def test_probe_opendap_unknown(server):
+    # errors are no answer, the capability is not remembered
+    assert nc_opendap.probe_opendap(server + '/missing/tas.nc') is None
+    assert not nc_opendap.supports_opendap(server + '/missing/tas.nc')
+    assert nc_opendap.known_capability(server + '/missing/pr.nc') is None
+    assert nc_opendap.probe_opendap('http://127.0.0.1:1/dodsC/tas.nc', timeout=1) is None
+
+
+def test_known_capability_root():
+    nc_opendap.clear_capabilities()
+    nc_opendap.remember_capability('https://example.org/tas.nc', False)
+    assert nc_opendap.known_capability('https://example.org/pr.nc') is False
+    # a probe in the root folder does not classify the whole host
+    assert nc_opendap.known_capability('https://example.org/thredds/dodsC/tas.nc') is None
+    nc_opendap.remember_capability('https://example.org/thredds/dodsC/tas.nc', True)
+    assert nc_opendap.known_capability('https://example.org/thredds/dodsC/cmip5/pr.nc') is True
+    nc_opendap.clear_capabilities()
+
+
+def test_opendap_or_download(server, tmpdir):
+    set_cache(DownloadCache(str(tmpdir.join('cache'))))
+    try:
+        assert opendap_or_download(server + '/dodsC/tas.nc') == server + '/dodsC/tas.nc'
+
+        with pytest.raises(IOError):
+            opendap_or_download(server + '/fileServer/tasmax.nc', max_nbytes=1000)
+        folder = str(tmpdir.join('cache', server.split('/')[-1], 'fileServer'))
+        assert [f for f in os.listdir(folder) if not f.endswith('.lock')] == []
+
+        filename = opendap_or_download(server + '/fileServer/tasmax.nc')
+        assert filename.startswith(str(tmpdir.join('cache')))
+        assert os.path.getsize(filename) == os.path.getsize(str(tmpdir.join('fileServer', 'tasmax.nc')))
+
+        # downloads to an output path keep the basename of the url
+        out = str(tmpdir.mkdir('out'))
+        assert opendap_or_download(server + '/fileServer/tasmax.nc', output_path=out) == os.path.join(out, 'tasmax.nc')
+    finally:
+        set_cache(None)
+
+
+def test_subset_opendap_local(tmpdir):
+    from datetime import datetime as dt
+    from netCDF4 import Dataset
+    nc = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+
+    subset = nc_opendap.subset_opendap(nc, time_range=[dt(2006, 5, 1), dt(2006, 8, 31)],
+                                       bbox=[-10, -5, 5, 10], output_path=str(tmpdir))
+    with Dataset(subset) as ds, Dataset(nc) as src:
+        rlat, rlon = src.variables['rlat'][:], src.variables['rlon'][:]
+        i = (rlat >= -5) & (rlat <= 10)
+        j = (rlon >= -10) & (rlon <= 5)
+        assert ds.variables['tasmax'].shape == (4, i.sum(), j.sum())
+        assert ds.variables['time_bnds'].shape == (4, 2)
+        assert 'grid_mapping_name' in ds.variables['rotated_latitude_longitude'].ncattrs()
+        assert (ds.variables['tasmax'][:] == src.variables['tasmax'][3:7][:, i][:, :, j]).all()
+
+
+def test_subset_opendap_names(tmpdir):
+    # subsets written next to their input neither overwrite it nor each other
+    nc = str(tmpdir.join('tasmax.nc'))
+    shutil.copy(local_path(TESTDATA['cordex_tasmax_2006_nc']), nc)
+    size = os.path.getsize(nc)
+    subsets = [nc_opendap.subset_opendap(nc, bbox=bbox, output_path=str(tmpdir))
+               for bbox in ([-10, -5, 5, 10], [0, 0, 5, 5], [-10, -5, 5, 10])]
+    assert nc not in subsets
+    assert subsets[0] != subsets[1] and subsets[0] == subsets[2]
+    assert os.path.getsize(nc) == size
+    assert sorted(tmpdir.listdir()) == sorted([tmpdir.join('tasmax.nc')] + [tmpdir.join(os.path.basename(f))
+                                                                            for f in set(subsets)])
+    with pytest.raises(Exception):
+        nc_opendap.subset_opendap(nc, output_path=str(tmpdir))
+    assert os.path.getsize(nc) == size
+    assert nc_opendap.output_filename('https://example.org/dodsC/tas.nc') == 'tas.nc'
+
+
+def test_subset_opendap(tmpdir):
+    pytest.importorskip('pydap')
+    import numpy as np
+    from netCDF4 import Dataset
+    from .common import serve_opendap
+
+    data = tmpdir.mkdir('data')
+    with Dataset(str(data.join('tas.nc')), 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('lat', 20)
+        ds.createDimension('lon', 30)
+        ds.createVariable('time', 'f8', ('time',), fill_value=False)[:] = np.arange(10)
+        ds.variables['time'].units = 'days since 2000-01-01'
+        ds.createVariable('lat', 'f4', ('lat',))[:] = np.linspace(30, 68, 20)
+        ds.createVariable('lon', 'f4', ('lon',))[:] = np.linspace(-20, 38, 30)
+        ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'))[:] = np.random.rand(10, 20, 30)
+
+    requests = []
+    with serve_opendap(data.join('tas.nc'), requests) as url:
+        subset = nc_opendap.subset_opendap(url, bbox=[0, 40, 10, 50], output_path=str(tmpdir))
+    # only the hyperslab of the variable is requested
+    assert [r for r in requests if '?tas' in r] == ['/tas.nc.dods?tas%5b0:9%5d%5b5:10%5d%5b10:15%5d']
+    with Dataset(subset) as ds, Dataset(str(data.join('tas.nc'))) as src:
+        i = (src.variables['lat'][:] >= 40) & (src.variables['lat'][:] <= 50)
+        j = (src.variables['lon'][:] >= 0) & (src.variables['lon'][:] <= 10)
+        assert ds.variables['tas'].shape == (10, i.sum(), j.sum())
+        assert (ds.variables['tas'][:] == src.variables['tas'][:][:, i][:, :, j]).all()
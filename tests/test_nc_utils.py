@@ -134,3 +134,107 @@ def test_aggregations():
 
     # check filename
     assert agg['filename'] == 'tasmax_MPI-ESM-MR_RCP4.5_r1i1p1_20060116-20071216.nc'
+
+
+def test_aggregations_without_time(monkeypatch):
+    nc_files = [local_path(TESTDATA['cmip5_tasmax_2007_nc']), local_path(TESTDATA['cmip5_tasmax_2006_nc'])]
+    records = nc_utils.inspect_files(nc_files)
+    # a file of the same dataset without time axis
+    records['fx.nc'] = dict(records[nc_files[0]], start=None, end=None, start_time=None)
+    monkeypatch.setattr(nc_utils, 'inspect_files', lambda resource, workers=None: records)
+
+    agg = nc_utils.aggregations(nc_files + ['fx.nc'])["tasmax_MPI-ESM-MR_RCP4.5_r1i1p1"]
+    assert agg['files'] == ['fx.nc', nc_files[1], nc_files[0]]
+    assert agg['from_timestamp'] == '20060116'
+    assert agg['to_timestamp'] == '20071216'
+
+
+def test_drs_filename_unreadable(tmpdir):
+    txt = tmpdir.join('readme.txt')
+    txt.write('no netCDF file')
+    assert nc_utils.drs_filename(str(txt)) == str(txt)
+
+
+def test_inspect():
+    record = nc_utils.inspect(local_path(TESTDATA['cordex_tasmax_2006_nc']))
+    assert record['project'] == 'CORDEX'
+    assert record['facets']['domain'] == 'EUR-44'
+    assert record['variable'] == 'tasmax'
+    assert record['frequency'] == 'mon'
+    assert record['start'] == '20060215'
+    assert record['end'] == '20061216'
+    assert record['grid_shape'] == [103, 106]
+
+
+def test_aggregations_workers():
+    nc_files = [local_path(TESTDATA['cmip5_tasmax_2007_nc']),
+                local_path(TESTDATA['cmip5_tasmax_2006_nc']),
+                local_path(TESTDATA['cordex_tasmax_2007_nc']),
+                local_path(TESTDATA['cordex_tasmax_2006_nc'])]
+    assert nc_utils.aggregations(nc_files, workers=2) == nc_utils.aggregations(nc_files)
+
+
+def test_get_time_array():
+    timestamps = nc_utils.get_time(local_path(TESTDATA['cordex_tasmax_2007_nc']), as_array=True)
+    assert timestamps.dtype.kind == 'M'
+    assert str(timestamps[0]) == '2007-01-16T12:00:00.000000'
+
+    timestamps = nc_utils.get_time(local_path(TESTDATA['cmip3_tas_sresa2_da_nc']), as_array=True)
+    assert timestamps[0].calendar == '360_day'
+
+
+def test_get_values_subset():
+    from datetime import datetime as dt
+    nc = local_path(TESTDATA['cordex_tasmax_2007_nc'])
+    values = nc_utils.get_values(nc, time_range=[dt(2007, 3, 1), dt(2007, 5, 31)])
+    assert values.shape == (3, 103, 106)
+    assert (values == nc_utils.get_values(nc)[2:5]).all()
+
+    values = nc_utils.get_values(nc, time_range=[dt(2007, 3, 1), None], bbox=[-10, -5, 10, 5])
+    assert values.shape[0] == 10
+    assert values.shape[1] < 103 and values.shape[2] < 106
+
+
+def test_get_values_curvilinear(tmpdir):
+    import numpy as np
+    from netCDF4 import Dataset
+    nc = str(tmpdir.join('tas.nc'))
+    with Dataset(nc, 'w') as ds:
+        ds.createDimension('time', 2)
+        ds.createDimension('y', 3)
+        ds.createDimension('x', 4)
+        ds.createVariable('lat', 'f4', ('y', 'x'))[:] = np.random.rand(3, 4)
+        ds.createVariable('tas', 'f4', ('time', 'y', 'x'))[:] = np.random.rand(2, 3, 4)
+    assert nc_utils.get_values(nc, variable='tas').shape == (2, 3, 4)
+    # the bbox can not be applied without 1D coordinates
+    with pytest.raises(ValueError):
+        nc_utils.get_values(nc, variable='tas', bbox=[0, 0, 1, 1])
+
+
+def test_normalize_time(tmpdir):
+    import numpy as np
+    from netCDF4 import Dataset
+    nc = str(tmpdir.join('slp.nc'))
+    with Dataset(nc, 'w', format='NETCDF4') as ds:
+        ds.createDimension('time', None)
+        ds.createVariable('time', 'f8', ('time',))[:] = np.arange(5)
+        ds.variables['time'].units = 'hours since 1800-01-01'
+        ds.createVariable('slp', 'f4', ('time',))[:] = np.arange(5)
+
+    # classic compatible: the attribute is added in place
+    inode = tmpdir.join('slp.nc').stat().ino
+    assert nc_utils.normalize_time(nc, data_model='NETCDF4_CLASSIC')
+    assert tmpdir.join('slp.nc').stat().ino == inode
+    with Dataset(nc) as ds:
+        assert ds.variables['time'].calendar == 'standard'
+        assert ds.data_model == 'NETCDF4'
+    assert not nc_utils.normalize_time(nc, data_model='NETCDF4_CLASSIC')
+
+    # unsigned types require a rewrite
+    with Dataset(nc, 'a') as ds:
+        ds.createVariable('flag', 'u2', ('time',))[:] = np.arange(5)
+    assert nc_utils.normalize_time(nc, data_model='NETCDF4_CLASSIC')
+    with Dataset(nc) as ds:
+        assert ds.data_model == 'NETCDF4_CLASSIC'
+        assert ds.variables['flag'].dtype == np.int32
+        assert (ds.variables['slp'][:] == np.arange(5)).all()
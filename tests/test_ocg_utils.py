@@ -101,3 +101,23 @@ def test_calc_grouping():
 #         lats, lons = unrotate_pole(resource)
 #         LOGGER.info('got coordinates with pole rotation')
 #     return lats, lons
+
+
+def test_available_memory():
+    assert ocg_utils.available_memory() > 0
+
+
+def test_tile_dimension():
+    # a quarter of the data fits into memory: tiles of half the edge length
+    assert ocg_utils.tile_dimension(400., 100., (100, 100)) == 50
+    assert ocg_utils.tile_dimension(1e9, 1., (100, 100)) == 1
+
+
+def test_request_tile_dimension():
+    # 10 x 10 cells of a 100 x 100 grid with 400 timesteps of 4 bytes: 156.25 kB
+    size = {'total': 156.25,
+            'variables': {'tas': {'value': {'shape': (400, 1, 10, 10), 'kb': 156.25, 'dtype': 'float32'},
+                                  'temporal': {'shape': (400,), 'kb': 3.125, 'dtype': 'float64'}}}}
+    # a quarter of the subset fits: tiles of half the subset edge, not of the file grid
+    assert ocg_utils.request_tile_dimension(size, 156.25 / 1024. / 4, 'tas') == 5
+    assert ocg_utils.request_tile_dimension(size, 156.25 / 1024. / 4) == 5
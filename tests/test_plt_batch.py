@@ -0,0 +1,71 @@
+import pytest
+
+pytest.importorskip('cartopy')
+
+import logging
+import os
+import time
+import numpy as np
+from netCDF4 import Dataset
+
+from eggshell.plot import plt_batch
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _tas(filename, offset):
+    with Dataset(filename, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('rlat', 40)
+        ds.createDimension('rlon', 50)
+        ds.createVariable('time', 'f8', ('time',)).setncatts({'units': 'days since 2000-01-01',
+                                                             'calendar': 'standard'})
+        ds.createVariable('rlat', 'f8', ('rlat',))[:] = np.linspace(35, 70, 40)
+        ds.createVariable('rlon', 'f8', ('rlon',))[:] = np.linspace(-10, 30, 50)
+        tas = ds.createVariable('tas', 'f4', ('time', 'rlat', 'rlon'), fill_value=1e20)
+        ds.variables['time'][:] = np.arange(12)
+        tas[:] = offset + np.random.rand(12, 40, 50)
+        tas[:, 0, 0] = np.ma.masked
+    return filename
+
+
+def test_time_mean(tmpdir):
+    nc = _tas(str(tmpdir.join('tas.nc')), 280)
+    variable, lon, lat, mean = plt_batch.time_mean([nc, nc])
+    assert variable == 'tas'
+    assert mean.shape == (40, 50) and len(lon) == 50 and len(lat) == 40
+    with Dataset(nc) as ds:
+        np.testing.assert_allclose(mean[1:, 1:], ds.variables['tas'][:, 1:, 1:].mean(axis=0), rtol=1e-6)
+    assert np.isnan(mean[0, 0])
+
+
+def _specs(tmpdir, n):
+    files = [_tas(str(tmpdir.join('tas_{}.nc'.format(i))), 270 + i) for i in range(2)]
+    return [{'resource': files[i % 2], 'title': 'map {}'.format(i), 'delta': -273.15, 'vmin': -5, 'vmax': 5}
+            for i in range(n)]
+
+
+def test_plot_maps(tmpdir):
+    specs = _specs(tmpdir, 4)
+    for workers in (1, 2):
+        out = tmpdir.mkdir('maps_{}'.format(workers))
+        graphics = plt_batch.plot_maps(specs, workers=workers, figsize=(4, 4), dir_output=str(out), features=(),
+                                       profile='preview')
+        assert len(set(graphics)) == len(specs)
+        for graphic in graphics:
+            assert open(graphic, 'rb').read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not os.environ.get('EGGSHELL_BENCHMARK'), reason='benchmark, set EGGSHELL_BENCHMARK=1 to run')
+def test_plot_maps_benchmark(tmpdir, record_property):
+    specs = _specs(tmpdir, 24)
+    for workers in (1, 2):
+        out = tmpdir.mkdir('maps_{}'.format(workers))
+        start = time.time()
+        graphics = plt_batch.plot_maps(specs, workers=workers, figsize=(4, 4), dir_output=str(out), features=(),
+                                       profile='web')
+        elapsed = time.time() - start
+        record_property('maps_per_second_{}_workers'.format(workers), round(len(specs) / elapsed, 2))
+        LOGGER.info('plot_maps: %s maps with %s worker(s) in %.2f s', len(specs), workers, elapsed)
+        assert len(set(graphics)) == len(specs)
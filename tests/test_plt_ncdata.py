@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip('cartopy')
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+from netCDF4 import Dataset
+
+from eggshell.plot import plt_ncdata
+
+
+@pytest.fixture(autouse=True)
+def fieldmean_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(plt_ncdata, '_fieldmean_cache_dir', lambda: str(tmpdir.join('cache')))
+
+
+def _member(tmpdir, model, years=20, offset=0.):
+    filename = str(tmpdir.join('tas_EUR-44_{}_rcp45_r1i1p1_mon_2006-{}.nc'.format(model, 2005 + years)))
+    with Dataset(filename, 'w') as ds:
+        ds.frequency = 'mon'
+        ds.createDimension('time', None)
+        ds.createDimension('rlat', 4)
+        ds.createDimension('rlon', 5)
+        time = ds.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 2006-01-01'
+        time.calendar = 'standard'
+        time[:] = np.arange(years * 12) * 30.4
+        ds.createVariable('rlat', 'f8', ('rlat',))[:] = np.linspace(0, 75, 4)
+        ds.createVariable('rlon', 'f8', ('rlon',))[:] = np.arange(5)
+        tas = ds.createVariable('tas', 'f4', ('time', 'rlat', 'rlon'), fill_value=1e20)
+        tas[:] = 280 + offset + np.random.rand(years * 12, 4, 5)
+        tas[:, 0, 0] = np.ma.masked
+    return filename
+
+
+def test_fieldmean_series(tmpdir):
+    nc = _member(tmpdir, 'A')
+    ts = plt_ncdata._fieldmean_series(nc, 'tas', memory_limit=1e-3, cache=False)
+    assert ts.dtype == np.float64 and ts.index.dtype.kind == 'M'
+    with Dataset(nc) as ds:
+        expected = np.nanmean(np.nanmean(ds.variables['tas'][:].filled(np.nan), axis=1), axis=1)
+    np.testing.assert_allclose(ts.values, expected, rtol=1e-6)
+
+
+def test_plot_ts_uncertainty(tmpdir):
+    files = [_member(tmpdir, 'M{}'.format(i), offset=i) for i in range(5)]
+    png = plt_ncdata.plot_ts_uncertainty(files, delta=-273.15, window=3, dir_output=str(tmpdir), figsize=(3, 3))
+    assert open(png, 'rb').read(4) == b'\x89PNG'
+
+
+def test_fieldmean_cache(tmpdir, monkeypatch):
+    nc = _member(tmpdir, 'A', years=2)
+    ts = plt_ncdata._fieldmean_series(nc, 'tas')
+    weighted = plt_ncdata._fieldmean_series(nc, 'tas', weighted=True)
+    assert len(tmpdir.join('cache').listdir()) == 2
+    assert not np.allclose(ts.values, weighted.values)
+
+    def no_input(*args, **kwargs):
+        raise AssertionError('input data read')
+
+    monkeypatch.setattr(plt_ncdata, 'Dataset', no_input)
+    cached = plt_ncdata._fieldmean_series(nc, 'tas')
+    np.testing.assert_array_equal(cached.values, ts.values)
+    assert (cached.index == ts.index).all()
+    png = plt_ncdata.plot_ts_spaghetti([nc], variable='tas', delta=-273.15, dir_output=str(tmpdir))
+    assert open(png, 'rb').read(4) == b'\x89PNG'
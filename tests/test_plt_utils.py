@@ -0,0 +1,72 @@
+import pytest
+
+import matplotlib
+matplotlib.use('Agg')
+
+import io
+import os
+import numpy as np
+from matplotlib import pyplot as plt
+
+from eggshell.plot import plt_utils
+
+
+def _feature():
+    import cartopy.crs as ccrs
+    import cartopy.feature as cfeature
+    from shapely.geometry import LineString
+    lines = [LineString([(-20, 40), (0, 50), (30, 60)]), LineString([(100, -10), (120, 0)])]
+    return cfeature.ShapelyFeature(lines, ccrs.PlateCarree(), edgecolor='black', facecolor='never')
+
+
+def test_map_template():
+    pytest.importorskip('cartopy')
+    feature = _feature()
+    plt_utils.clear_map_templates()
+    template = plt_utils.get_map_template(extent=[-10, 20, 35, 55], features=(feature,), background=True)
+    assert plt_utils.get_map_template(extent=[-10., 20., 35., 55.], features=(feature,), background=True) is template
+
+    path = template.feature_path(feature)
+    # only the line in the extent is kept, clipped to the (slightly enlarged) extent
+    assert path.vertices[:, 0].min() >= -11.5 and path.vertices[:, 0].max() <= 21.5
+
+    for i in range(2):
+        fig = plt.figure(figsize=(4, 3))
+        ax = template.axes(fig, styles={feature: dict(linewidth=2, linestyle='--')})
+        ax.pcolormesh(np.linspace(-10, 20, 7), np.linspace(35, 55, 5), np.random.rand(4, 6))
+        fig.savefig(io.BytesIO(), format='png')
+        plt.close(fig)
+    assert template.feature_path(feature) is path
+    assert template._image is not None
+
+
+def _figure():
+    fig = plt.figure(figsize=(4, 3))
+    plt.pcolormesh(np.random.rand(40, 50))
+    return fig
+
+
+def test_fig2plot(tmpdir):
+    fig = _figure()
+    png = plt_utils.fig2plot(fig, dir_output=str(tmpdir))
+    web = plt_utils.fig2plot(fig, dir_output=str(tmpdir), profile='web')
+    assert os.path.getsize(png) > os.path.getsize(web)
+
+    from PIL import Image
+    buf = plt_utils.fig2plot(fig, file_extension='webp', as_buffer=True, profile=dict(dpi=50, quality=50))
+    with Image.open(buf) as img:
+        assert img.format == 'WEBP'
+        assert img.size[0] < 4 * 50  # tight bbox of the default
+    jpg = plt_utils.fig2plot(fig, file_extension='jpg', filename=str(tmpdir.join('map.jpg')), profile='preview')
+    with Image.open(jpg) as img:
+        assert img.format == 'JPEG' and img.size == (200, 150)
+    plt.close(fig)
+
+
+def test_fig2plot_async(tmpdir):
+    futures = [plt_utils.fig2plot_async(_figure(), dir_output=str(tmpdir), profile='preview') for i in range(3)]
+    graphics = [future.result() for future in futures]
+    assert len(set(graphics)) == 3
+    for graphic in graphics:
+        assert open(graphic, 'rb').read(4) == b'\x89PNG'
+    assert plt.get_fignums() == []
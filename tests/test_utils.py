@@ -21,6 +21,73 @@ def test_archive():
         utils.archive([], format='zip2')
 
 
+def test_archive_stream(tmpdir, monkeypatch):
+    import io
+    import os
+    import tarfile
+    files = []
+    for i in range(3):
+        tmpdir.join('f{}.txt'.format(i)).write_binary(bytes([i]) * 100000)
+        files.append(str(tmpdir.join('f{}.txt'.format(i))))
+    files.append(local_path(TESTDATA['cmip5_tasmax_2006_nc']))
+
+    chunks = list(utils.archive_stream(files, format='tar', mode='w:gz', workers=2, chunk_size=30000))
+    assert len(chunks) > 1
+    with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+        assert tar.getnames() == [basename(f) for f in files]
+        assert tar.extractfile('f1.txt').read() == bytes([1]) * 100000
+
+    # members which are compressed already are not compressed again at full level
+    png = tmpdir.join('map.png')
+    png.write_binary(os.urandom(50000))
+    levels = []
+    compress_block = utils._compress_block
+
+    def spy(data, codec, level, last=True):
+        levels.append((codec, level, len(data)))
+        return compress_block(data, codec, level, last)
+    monkeypatch.setattr(utils, '_compress_block', spy)
+    for mode in ('w|gz', 'w|bz2'):
+        del levels[:]
+        chunks = list(utils.archive_stream([str(png), files[0]], format='tar', mode=mode, level=9,
+                                           chunk_size=30000))
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+            assert tar.extractfile('map.png').read() == png.read_binary()
+        assert sum(n for codec, level, n in levels if level == 0) == 50000
+        assert sum(n for codec, level, n in levels if level == 9) >= 100000
+
+    result = utils.archive(files, format='zip', mode='w:deflated', workers=2)
+    with zipfile.ZipFile(result) as zf:
+        assert zf.testzip() is None
+        assert zf.getinfo('f2.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read(basename(files[3])) == open(files[3], 'rb').read()
+
+
+def test_archive_directory(tmpdir):
+    import os
+    import tarfile
+    data = tmpdir.mkdir('data')
+    data.join('a.txt').write('a')
+    data.mkdir('sub').join('b.txt').write('b')
+    os.symlink('a.txt', str(data.join('link.txt')))
+    single = tmpdir.join('c.txt')
+    single.write('c')
+
+    for mode in ['w', 'w:gz']:
+        with tarfile.open(utils.archive([str(data), str(single)], dir_output=str(tmpdir), mode=mode)) as tar:
+            assert sorted(tar.getnames()) == ['c.txt', 'data', 'data/a.txt', 'data/link.txt', 'data/sub',
+                                              'data/sub/b.txt']
+            assert tar.getmember('data/link.txt').issym()
+            assert tar.extractfile('data/sub/b.txt').read() == b'b'
+    for mode in ['w', 'w:deflated']:
+        with zipfile.ZipFile(utils.archive([str(data), str(single)], format='zip', dir_output=str(tmpdir),
+                                           mode=mode)) as zf:
+            assert zf.read('data/sub/b.txt') == b'b'
+            assert zf.read('c.txt') == b'c'
+    with pytest.raises(Exception):
+        list(utils.archive_stream([str(data)]))
+
+
 def test_extract_archive():
     files = utils.extract_archive([
         utils.archive([]),
@@ -37,6 +104,34 @@ def test_local_path():
     assert local_path('/tmp/test.nc') == '/tmp/test.nc'
 
 
+def test_extract_archive_members(tmpdir):
+    nc = local_path(TESTDATA['cmip5_tasmax_2006_nc'])
+    txt = tmpdir.join('readme.txt')
+    txt.write('text')
+    for format, mode in [('zip', 'w'), ('zip', 'w:deflated'), ('tar', 'w:gz')]:
+        arch = utils.archive([nc, str(txt)], format=format, mode=mode, dir_output=str(tmpdir))
+        out = tmpdir.mkdir('out_{}_{}'.format(format, mode.replace(':', '')))
+
+        files = utils.extract_archive(arch, dir_output=str(out), members='*.nc')
+        assert files == [str(out.join(basename(nc)))]
+        assert open(files[0], 'rb').read() == open(nc, 'rb').read()
+
+        files = utils.extract_archive(arch, dir_output=str(out), members=lambda name: name.endswith('.txt'))
+        assert [basename(f) for f in files] == ['readme.txt']
+
+        # nothing is extracted in lazy mode
+        files = utils.extract_archive(arch, members='*.nc', lazy=True)
+        assert files[0].startswith('/vsi')
+        with utils.open_dataset(files[0]) as ds:
+            assert 'tasmax' in ds.variables
+        content = utils.read_member(files[0])
+        assert isinstance(content, bytes) and content[:3] in (b'CDF', b'\x89HD')
+        with utils.map_member(files[0]) as view:
+            assert view.tobytes() == content
+        with pytest.raises(ValueError):
+            view.tobytes()  # released with the mapping
+
+
 @pytest.mark.skip(reason="no way of currently testing this")
 def test_download_with_cache():
     filename = utils.download(TESTDATA['cmip5_tasmax_2006_nc'], cache=paths.cache)
@@ -49,3 +144,65 @@ def test_archive_zip():
                            dir_output=tempfile.mkdtemp())
     zipf = zipfile.ZipFile(result)
     assert len(zipf.namelist()) == 1
+
+
+def test_download_files(tmpdir, monkeypatch):
+    from .common import serve_directory
+    data = tmpdir.mkdir('data')
+    for i in range(3):
+        data.join('f{}.nc'.format(i)).write_binary(bytes([i]) * 1000)
+    monkeypatch.chdir(tmpdir.mkdir('out'))
+
+    with serve_directory(data) as url:
+        files = utils.download_files(['{}/f{}.nc'.format(url, i) for i in range(3)], workers=2)
+    assert [basename(f) for f in files] == ['f0.nc', 'f1.nc', 'f2.nc']
+    assert open(files[2], 'rb').read() == bytes([2]) * 1000
+
+
+def test_download_file_resume(tmpdir):
+    from .common import serve_directory
+    content = bytes(range(256)) * 40
+    tmpdir.join('f.nc').write_binary(content)
+    out = str(tmpdir.join('out.nc'))
+
+    def partial(data, validator):
+        with open(out + '.part', 'wb') as fp:
+            fp.write(data)
+        if validator:
+            with open(out + '.part.validator', 'w') as fp:
+                fp.write(validator)
+
+    with serve_directory(tmpdir) as url:
+        utils.download_file(url + '/f.nc', out=out)
+        last_modified = utils.get_session().head(url + '/f.nc').headers['Last-Modified']
+        assert open(out, 'rb').read() == content
+
+        # partial file of an interrupted download, resumed: the wrong head is kept
+        partial(b'x' * 1000, last_modified)
+        utils.download_file(url + '/f.nc', out=out)
+        assert open(out, 'rb').read() == b'x' * 1000 + content[1000:]
+
+        # the remote file changed since the partial download, or there is no validator: restart
+        for validator in ('Thu, 01 Jan 1970 00:00:00 GMT', None):
+            partial(b'x' * 1000, validator)
+            utils.download_file(url + '/f.nc', out=out)
+            assert open(out, 'rb').read() == content
+
+        # range not satisfiable: a complete partial file is kept, a larger one is discarded
+        partial(content, last_modified)
+        utils.download_file(url + '/f.nc', out=out)
+        assert open(out, 'rb').read() == content
+        partial(content + b'x' * 1000, last_modified)
+        utils.download_file(url + '/f.nc', out=out)
+        assert open(out, 'rb').read() == content
+    assert not tmpdir.join('out.nc.part').exists()
+    assert not tmpdir.join('out.nc.part.validator').exists()
+
+
+def test_session():
+    session = utils.get_session()
+    assert utils.get_session() is session
+    utils.configure_session(retries=1, pool_maxsize=2)
+    assert utils.get_session() is not session
+    assert utils.get_session().get_adapter('https://example.org')._pool_maxsize == 2
+    utils.configure_session()